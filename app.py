@@ -2,14 +2,29 @@
 """
 import os
 import json
+import atexit
+import uuid
+import datetime
 import logging
-from flask import Flask, render_template, send_from_directory
-from flask import request, redirect, url_for
+import flask
+from flask import Flask, send_from_directory
+from flask import request, redirect, url_for, abort, jsonify, g
+from flask import Response, stream_with_context
 from werkzeug import secure_filename
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 
+import instrumentation
 import mongo_utilities
+import course_model
 import forms
-from parser import allowed_file, Parser
+import hooks
+import scoring
+from fetch_cache import FetchCache
+from ingestion import IngestionQueue
+from parser import allowed_file
+from predictions import load_season, predict, predict_meet, team_entries
+from view_cache import ViewCache, MemoryBackend, FileBackend
 
 
 #----------------------------------------
@@ -27,7 +42,149 @@ if os.path.exists(".creds"):
   )
 
 APP.config["UPLOAD_FOLDER"] = os.path.join(APP.root_path, "raw_data")
+APP.config["INGESTION_WORKERS"] = 2
+# more than one parses the races of each upload in a process pool
+APP.config["INGESTION_PROCESSES"] = 1
+APP.config["FETCH_CACHE_FOLDER"] = os.path.join(APP.root_path, "fetch_cache")
+APP.config["FETCH_CACHE_BYTES"] = 100*2**20
+# "memory" caches pages per process, "file" shares them on the host
+APP.config["VIEW_CACHE_BACKEND"] = "memory"
+APP.config["VIEW_CACHE_FOLDER"] = os.path.join(APP.root_path, "view_cache")
+APP.config["VIEW_CACHE_TIMEOUT"] = 300
+# most pages and query results the memory backend keeps
+APP.config["VIEW_CACHE_ENTRIES"] = 10000
+# template output chunks collected before each write when streaming
+APP.config["STREAM_BUFFER"] = 20
+APP.config["PREDICTION_SIMULATIONS"] = 20000
+# more than one runs the simulations of each prediction in a process pool
+APP.config["PREDICTION_PROCESSES"] = 1
+# requests slower than this are logged with where their time went
+APP.config["SLOW_REQUEST_SECONDS"] = 1.
+# fraction of requests and ingestion jobs run under cProfile
+APP.config["PROFILE_RATE"] = 0.
+APP.config["PROFILE_FOLDER"] = os.path.join(APP.root_path, "profiles")
 APP.logger.info(APP.config["UPLOAD_FOLDER"])
+if not os.path.exists(APP.config["UPLOAD_FOLDER"]):
+  os.makedirs(APP.config["UPLOAD_FOLDER"])
+
+hooks.register()
+
+PROFILER = instrumentation.Sampler(APP.config["PROFILE_RATE"],
+    APP.config["PROFILE_FOLDER"])
+
+INGESTION = IngestionQueue(
+    workers = APP.config["INGESTION_WORKERS"],
+    processes = APP.config["INGESTION_PROCESSES"],
+    profiler = PROFILER,
+    cache = FetchCache(APP.config["FETCH_CACHE_FOLDER"],
+      max_bytes = APP.config["FETCH_CACHE_BYTES"]))
+atexit.register(INGESTION.close)
+
+if APP.config["VIEW_CACHE_BACKEND"] == "file":
+  VIEW_CACHE_BACKEND = FileBackend(APP.config["VIEW_CACHE_FOLDER"])
+else:
+  VIEW_CACHE_BACKEND = MemoryBackend(APP.config["VIEW_CACHE_ENTRIES"])
+VIEW_CACHE = ViewCache(VIEW_CACHE_BACKEND,
+    timeout = APP.config["VIEW_CACHE_TIMEOUT"])
+
+# cached views to drop when each collection changes
+INVALIDATES = {
+    mongo_utilities.TEAM_COLLECTION: ["teams", "team_info", "results"],
+    mongo_utilities.RUNNER_COLLECTION: ["team_info", "results"],
+    mongo_utilities.RESULT_COLLECTION: ["results"],
+    mongo_utilities.MEET_RESULT_COLLECTION: ["results"],
+    mongo_utilities.MEET_COLLECTION: ["meets", "results"],
+    mongo_utilities.COURSE_COLLECTION: ["courses"],
+    mongo_utilities.COURSE_MODEL_COLLECTION: ["courses", "rankings"],
+    mongo_utilities.RUNNER_HISTORY_COLLECTION: ["runner"],
+    }
+
+@mongo_utilities.on_write
+def invalidate_views(*collections):
+  """Drops cached views that show the changed collections
+  """
+  VIEW_CACHE.invalidate(*set(namespace for collection in collections for
+    namespace in INVALIDATES.get(collection, [])))
+
+@APP.before_request
+def start_request():
+  """Traces the request, profiling it if it is sampled
+  """
+  instrumentation.start_trace(request.endpoint or "unknown")
+  g.profile = PROFILER.start()
+
+@APP.teardown_request
+def finish_request(_):
+  """Ends the request trace, logging it if the request was slow.
+  Streamed pages finish once the last of them is sent
+  """
+  PROFILER.stop(getattr(g, "profile", None), request.endpoint or "unknown")
+  trace = instrumentation.end_trace()
+  if trace and trace.seconds > APP.config["SLOW_REQUEST_SECONDS"]:
+    APP.logger.warning("Slow request %s took %.2fs: %s", request.path,
+        trace.seconds, trace.report())
+
+@APP.before_first_request
+def recover_jobs():
+  """Queues the ingestion jobs left unfinished by the last run.  This
+  waits for a request so the reloader's watching process does not
+  take them
+  """
+  queued = INGESTION.recover()
+  if queued:
+    APP.logger.info("Requeued %d unfinished ingestion jobs", queued)
+
+for collection, indexes in mongo_utilities.ensure_indexes().iteritems():
+  APP.logger.info("%s indexes created: %s, existing: %s", collection,
+      indexes["created"], indexes["existing"])
+  for name, error in indexes["failed"]:
+    APP.logger.error("%s index %s not created, run manage.py dedup "
+        "and then manage.py indexes: %s", collection, name, error)
+#----------------------------------------
+# helpers
+#----------------------------------------
+
+def upload_path(filename):
+  """Returns a path in the upload folder no other upload uses
+  """
+  return os.path.join(APP.config['UPLOAD_FOLDER'],
+      "%s_%s" % (uuid.uuid4().hex, filename))
+
+def render_template(template_name, **context):
+  """flask.render_template, timed as the render span
+  """
+  with instrumentation.span("render"):
+    return flask.render_template(template_name, **context)
+
+def stream_template(template_name, **context):
+  """Renders a template to the client as it is generated, so large
+  pages start arriving before they are finished
+  """
+  APP.update_template_context(context)
+  template = APP.jinja_env.get_template(template_name)
+  stream = template.stream(context)
+  stream.enable_buffering(APP.config["STREAM_BUFFER"])
+  return Response(stream_with_context(
+    instrumentation.timed_iter("render", stream)))
+
+@APP.template_filter("race_time")
+def race_time(time):
+  """Formats a stored finishing time as [h:]mm:ss.ss
+  """
+  centiseconds = mongo_utilities.time_to_centiseconds(time)
+  minutes, seconds = divmod(centiseconds/100., 60)
+  if minutes >= 60:
+    return "%d:%02d:%05.2f" % (minutes // 60, minutes % 60, seconds)
+  return "%d:%05.2f" % (minutes, seconds)
+
+def object_id(value):
+  """Converts a url parameter to an ObjectId, or 404s
+  """
+  try:
+    return ObjectId(value)
+  except (InvalidId, TypeError):
+    abort(404)
+
 #----------------------------------------
 # controllers
 #----------------------------------------
@@ -59,41 +216,87 @@ def index():
 
 @APP.route("/upload", methods = ["GET", "POST"])
 def uploads():
-  """ Handles file uploads
+  """ Handles file uploads by queueing them for ingestion
   """
   form = forms.UploadForm(request.form)
   if request.method == "POST" and form.validate():
     results = request.files['file_data']
     if results and allowed_file(results.filename):
-      filename = secure_filename(results.filename)
-      parser = Parser(
+      path = upload_path(secure_filename(results.filename))
+      results.save(path)
+      job_id = INGESTION.submit(
           meetname = form.meetname.data,
           date = form.date.data,
-          buff = results)
+          path = path,
+          course = form.course.data or None,
+          distance = form.distance.data or None)
     elif 'url' in form:
-      filename = "test.txt"
-      parser = Parser(
+      job_id = INGESTION.submit(
           meetname = form.meetname.data,
           date = form.date.data,
-          url = form.url.data)
-    parser.write(os.path.join(APP.config['UPLOAD_FOLDER'], filename))
-    return redirect(url_for('results', meet_id = parser.get_id()))
+          url = form.url.data,
+          output = upload_path("results.txt"),
+          course = form.course.data or None,
+          distance = form.distance.data or None)
+    return redirect(url_for('upload_status', job_id = job_id))
   return render_template("upload.html", form=form)
 
+@APP.route("/upload/<job_id>")
+def upload_status(job_id):
+  """Shows the progress of an upload, and its results once done
+  """
+  job = mongo_utilities.get_job(object_id(job_id))
+  if job is None:
+    abort(404)
+  if job["status"] == "done" and len(job.get("races", [])) < 2:
+    return redirect(url_for('results', meet_id = job["meet_id"]))
+  return render_template("upload_status.html", job = job)
+
 @APP.route("/teams")
 def teams():
-  """Team index page
+  """Team index page, a page at a time
   """
-  return render_template('teams.html', teams = mongo_utilities.get_teams())
+  after = request.args.get("after")
+  page, next_token = VIEW_CACHE.memoize("teams", "page:%s" % after,
+      mongo_utilities.get_teams_page, after)
+  return stream_template('teams.html', teams = page, next_token = next_token)
 
 @APP.route("/teams/<team_id>")
+@VIEW_CACHE.cached("team_info")
 def team_info(team_id):
   """Info for individual team
   """
-  info = mongo_utilities.get_team_info(team_id)
+  info = mongo_utilities.get_team_info(object_id(team_id))
   APP.logger.info("%s", info)
-  return render_template("team_info.html",
-      info = mongo_utilities.get_team_info(team_id))
+  return render_template("team_info.html", info = info)
+
+@APP.route("/runners/<runner_id>")
+@VIEW_CACHE.cached("runner")
+def runner(runner_id):
+  """A runner's races and bests
+  """
+  history = mongo_utilities.get_runner_history(object_id(runner_id))
+  if history is None:
+    abort(404)
+  return render_template("runner.html", history = history,
+      rolling = mongo_utilities.ROLLING_RACES)
+
+@APP.route("/merges", methods = ["GET", "POST"])
+def merges():
+  """Lists possible duplicate runners and teams, and merges or
+  dismisses them
+  """
+  if request.method == "POST":
+    mongo_utilities.resolve_merge(object_id(request.form["merge_id"]),
+        request.form.get("action") == "merge")
+    return redirect(url_for('merges'))
+  queue = list(mongo_utilities.get_merge_queue())
+  ids = [merge[key] for merge in queue for key in ("keep_id", "drop_id")]
+  names = dict((runner["_id"], "%s (%s)" % (runner["display_name"],
+    runner.get("class_year"))) for runner in mongo_utilities.get_runners(ids))
+  names.update((team["_id"], team["name"]) for
+      team in mongo_utilities.get_teams() if team["_id"] in set(ids))
+  return render_template("merges.html", queue = queue, names = names)
 
 @APP.route("/teams/new", methods = ["GET", "POST"])
 def add_team():
@@ -110,29 +313,89 @@ def add_team():
 
 @APP.route("/meets")
 def meets():
-  """Meet index page
+  """Meet index page, a page at a time
   """
-  return render_template('meets.html', meets = mongo_utilities.get_meets())
+  after = request.args.get("after")
+  page, next_token = VIEW_CACHE.memoize("meets", "page:%s" % after,
+      mongo_utilities.get_meets_page, after)
+  return stream_template('meets.html', meets = page, next_token = next_token)
 
 @APP.route("/meets/<meet_id>")
+@VIEW_CACHE.cached("results")
 def results(meet_id):
   """Print meet results
   """
-  return render_template('results.html',
-      results = mongo_utilities.get_meet_results(meet_id))
+  standings, results = scoring.score_meet(object_id(meet_id))
+  return render_template('results.html', results = results,
+      standings = standings)
 
 @APP.route("/courses")
+@VIEW_CACHE.cached("courses")
 def courses():
   """Course index page
   """
   return render_template('courses.html',
-      courses = mongo_utilities.get_courses())
+      courses = mongo_utilities.get_courses(),
+      factors = course_model.CourseModel.load().factors())
+
+@APP.route("/rankings")
+@VIEW_CACHE.cached("rankings")
+def rankings():
+  """Runners ranked by course-adjusted time
+  """
+  ranked = course_model.rankings()
+  runners = dict((runner["_id"], runner) for runner in
+      mongo_utilities.get_runners([runner_id for runner_id, _, _ in ranked]))
+  return render_template('rankings.html',
+      rankings = [(runners.get(runner_id, {}), seconds, races) for
+        runner_id, seconds, races in ranked],
+      team_names = dict((team["_id"], team["name"]) for
+        team in mongo_utilities.get_teams()))
+
+@APP.route("/stats/cache")
+def cache_stats():
+  """Hit rates for the view cache
+  """
+  return jsonify(VIEW_CACHE.stats())
+
+@APP.route("/metrics")
+def metrics():
+  """Request, span and mongo call timings since startup
+  """
+  return jsonify(instrumentation.snapshot())
 
 @APP.route("/predictions")
 def predictions():
-  """Front page for app
+  """Predicts a meet between the chosen teams, or a stored meet
+  again from its finishers
   """
-  return render_template('index.html')
+  options = {
+      "simulations": APP.config["PREDICTION_SIMULATIONS"],
+      "processes": APP.config["PREDICTION_PROCESSES"]}
+  team_ids = [object_id(team_id) for team_id in request.args.getlist("team")]
+  course_id = request.args.get("course")
+  course_id = object_id(course_id) if course_id else None
+  try:
+    date = datetime.datetime.strptime(request.args.get("date", ""),
+        mongo_utilities.DATE_FMT).date()
+  except ValueError:
+    date = datetime.date.today()
+  prediction = None
+  if request.args.get("meet"):
+    prediction = predict_meet(object_id(request.args["meet"]), **options)
+  elif team_ids:
+    season = load_season(date)
+    prediction = predict(team_entries(season, team_ids), date, course_id,
+        season = season, **options)
+  teams = list(mongo_utilities.get_teams())
+  return render_template('predictions.html',
+      prediction = prediction,
+      teams = teams,
+      team_names = dict((team["_id"], team["name"]) for team in teams),
+      courses = mongo_utilities.get_courses(),
+      selected = set(team_ids),
+      course_id = course_id,
+      date = date.strftime(mongo_utilities.DATE_FMT))
 
 #----------------------------------------
 # launch
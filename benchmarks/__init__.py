@@ -0,0 +1,3 @@
+"""Benchmarks for the parser and scoring code.  Run them from
+the repository root, e.g. python -m benchmarks.parser_bench
+"""
@@ -0,0 +1,109 @@
+"""Compares reading synthetic races with RaceParser, which slices
+lines at the columns the fixed-width engine finds, against the
+heuristic hier_parse/find_name path alone, for speed and for how
+many results each gets right.
+
+    python -m benchmarks.fixed_width_bench --sizes 100 1000 10000 \
+        --output fixed_width_bench.json
+"""
+import argparse
+import datetime
+import json
+import time
+
+import mongomock
+import pymongo
+# parser imports mongo_utilities, which connects when it is imported
+pymongo.MongoClient = mongomock.MongoClient
+
+from parser import LineTokens, RaceParser, class_year_words, split_races
+from benchmarks.synthetic import generate_meet
+
+DATE = datetime.date(2012, 11, 3)
+
+def expected(runners, class_column):
+  """Returns each runner as the (firstname, lastname, team,
+  class_year, time) both paths should read
+  """
+  class_years = class_year_words(DATE)
+  return [(first, last, team, class_years[class_word] if class_column else
+    None, datetime.timedelta(seconds = seconds)) for
+    first, last, team, class_word, seconds in runners]
+
+def heuristic(lines):
+  """Reads a race with the heuristic parser
+  """
+  return read_race(RaceParser(DATE, lines, detect = False))
+
+def engine(lines):
+  """Reads a race with RaceParser, by its columns where they are
+  found
+  """
+  return read_race(RaceParser(DATE, lines))
+
+def read_race(race):
+  """Returns the runners of a race with their times
+  """
+  results, runners = race.parse()
+  return [runner + (result.data["time"],) for
+      result, runner in zip(results, runners)]
+
+def accuracy(parsed, truth):
+  """Returns the fraction of results read entirely right
+  """
+  return sum(1 for row, right in zip(parsed, truth) if row == right) / \
+      float(len(truth))
+
+def run_case(finishers, teams, name_format, class_column, repeat):
+  """Returns the best time and the accuracy of each path for one
+  kind of race
+  """
+  text, runners = generate_meet(finishers, teams, name_format,
+      class_column, True, DATE)
+  _, _, lines = next(split_races(text.split("\n"), LineTokens))
+  truth = expected(runners, class_column)
+  record = {"finishers": finishers, "teams": teams,
+      "name_format": name_format, "class_column": class_column}
+  for name, read in (("heuristic", heuristic), ("engine", engine)):
+    best = None
+    for _ in range(repeat):
+      start = time.time()
+      parsed = read(lines)
+      seconds = time.time() - start
+      best = seconds if best is None else min(best, seconds)
+    record[name] = {"seconds": best, "accuracy": accuracy(parsed, truth)}
+  return record
+
+def main():
+  """Runs the benchmark grid and reports the results
+  """
+  arg_parser = argparse.ArgumentParser(description = __doc__,
+      formatter_class = argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--sizes", type = int, nargs = "+",
+      default = [100, 1000, 10000])
+  arg_parser.add_argument("--teams", type = int, default = 20)
+  arg_parser.add_argument("--name-formats", nargs = "+",
+      default = ["first_last", "last_first"])
+  arg_parser.add_argument("--repeat", type = int, default = 3)
+  arg_parser.add_argument("--no-class-column", action = "store_true")
+  arg_parser.add_argument("--output", help = "write results as json")
+  args = arg_parser.parse_args()
+
+  records = []
+  print "%8s %-11s %15s %15s %15s %15s" % ("runners", "names",
+      "heuristic", "accuracy", "engine", "accuracy")
+  for finishers in args.sizes:
+    for name_format in args.name_formats:
+      record = run_case(finishers, args.teams, name_format,
+          not args.no_class_column, args.repeat)
+      records.append(record)
+      print "%8d %-11s %15.4f %15.3f %15.4f %15.3f" % (finishers,
+          name_format, record["heuristic"]["seconds"],
+          record["heuristic"]["accuracy"], record["engine"]["seconds"],
+          record["engine"]["accuracy"])
+  if args.output:
+    with open(args.output, "w") as buff:
+      json.dump(records, buff, indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,205 @@
+"""Times each phase of Parser, and each span of MeetParser, which
+uploads go through, on synthetic meets against an in-memory mongo
+stand-in.
+
+    python -m benchmarks.parser_bench --sizes 100 1000 10000 \
+        --output parser_bench.json
+"""
+import argparse
+import datetime
+import json
+import time
+from StringIO import StringIO
+
+import mongomock
+import pymongo
+# mongo_utilities connects when it is imported, so the stand-in
+# has to be in place first
+pymongo.MongoClient = mongomock.MongoClient
+
+import hooks
+import identity_cache
+import instrumentation
+import layout
+import mongo_utilities
+from parser import MeetParser, Parser, class_year_words
+from benchmarks.synthetic import generate_meet
+
+PHASES = ["clean", "get_frequencies", "get_class_index", "hier_parse",
+    "set_results", "save"]
+# Instrumentation spans of MeetParser.  Reading is timed inside split
+MEET_SPANS = ["split", "diff", "parse", "resolve", "save"]
+DATE = datetime.date(2012, 11, 3)
+
+class TimedParser(Parser):
+  """Parser that records the time spent in each phase.  Time in
+  a phase called from inside another phase counts toward the
+  outer one
+  """
+  def __init__(self, *args, **kwargs):
+    self.timings = dict.fromkeys(PHASES, 0.)
+    self.active = None
+    Parser.__init__(self, *args, **kwargs)
+
+  def timed(self, phase, *args):
+    """Calls the Parser method for phase, timing it
+    """
+    method = getattr(Parser, phase)
+    if self.active:
+      return method(self, *args)
+    self.active = phase
+    start = time.time()
+    try:
+      return method(self, *args)
+    finally:
+      self.timings[phase] += time.time() - start
+      self.active = None
+
+  def clean(self):
+    return self.timed("clean")
+
+  def get_frequencies(self):
+    return self.timed("get_frequencies")
+
+  def get_class_index(self):
+    return self.timed("get_class_index")
+
+  def hier_parse(self, line):
+    return self.timed("hier_parse", line)
+
+  def set_results(self):
+    return self.timed("set_results")
+
+  def save(self):
+    return self.timed("save")
+
+def reset_database():
+  """Points mongo_utilities at an empty in-memory database
+  """
+  mongo_utilities.DB = mongomock.MongoClient()[mongo_utilities.DBNAME]
+  identity_cache.clear()
+  layout.LAYOUTS.clear()
+
+def accuracy(parser, runners):
+  """Returns the fraction of results whose name, team and class
+  year were parsed correctly
+  """
+  class_years = class_year_words(DATE)
+  correct = 0
+  for result, runner in zip(parser.results, runners):
+    parsed = parser.parse_result(result)
+    first, last, team, class_word, _ = runner
+    expected = (first, last, team,
+        class_years[class_word] if parser.class_index else None)
+    if parsed == expected:
+      correct += 1
+  return correct/float(len(runners))
+
+def stored_accuracy(runners):
+  """Returns the fraction of stored results, in place order, whose
+  runner has the right name, team and class year
+  """
+  class_years = class_year_words(DATE)
+  db = mongo_utilities.DB
+  results = list(db[mongo_utilities.RESULT_COLLECTION].find().sort("place"))
+  stored = dict((runner["_id"], runner) for runner in
+      db[mongo_utilities.RUNNER_COLLECTION].find())
+  teams = dict((team["_id"], team["name"]) for team in
+      db[mongo_utilities.TEAM_COLLECTION].find())
+  correct = 0
+  for result, (first, last, team, class_word, _) in zip(results, runners):
+    runner = stored[result["runner_id"]]
+    if (runner["first_name"].lower(), runner["last_name"].lower(),
+        teams[result["team_id"]].lower(), runner["class_year"]) == (first,
+          last, team, class_years[class_word] if class_word else None):
+      correct += 1
+  return correct/float(len(runners))
+
+def run_meet_parser(text, runners, repeat):
+  """Returns the best time and spans over repeat uploads of a meet
+  through MeetParser, each to an empty database
+  """
+  best = None
+  for _ in range(repeat):
+    reset_database()
+    with instrumentation.trace("bench") as trace:
+      parser = MeetParser(meetname = "Benchmark", date = DATE,
+          buff = StringIO(text))
+    if best is None or trace.seconds < best["total"]:
+      spans = trace.report()["spans"]
+      best = {"total": trace.seconds,
+          "spans": dict((span, spans.get(span, 0.)) for span in MEET_SPANS),
+          "parsed": parser.saved,
+          "accuracy": stored_accuracy(runners)}
+  return best
+
+def run_case(finishers, teams, name_format, class_column, noise, repeat):
+  """Returns the best timings over repeat runs for one kind of meet
+  """
+  text, runners = generate_meet(finishers, teams, name_format,
+      class_column, noise, DATE)
+  best = None
+  for _ in range(repeat):
+    reset_database()
+    start = time.time()
+    parser = TimedParser(meetname = "Benchmark", date = DATE,
+        buff = StringIO(text))
+    total = time.time() - start
+    if best is None or total < best["total"]:
+      best = {"total": total, "phases": parser.timings}
+  best.update({
+    "finishers": finishers,
+    "teams": teams,
+    "name_format": name_format,
+    "class_column": class_column,
+    "noise": noise,
+    "parsed": len(parser.results),
+    "accuracy": accuracy(parser, runners),
+    "meet_parser": run_meet_parser(text, runners, repeat)})
+  return best
+
+def main():
+  """Runs the benchmark grid and reports the results
+  """
+  arg_parser = argparse.ArgumentParser(description = __doc__,
+      formatter_class = argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--sizes", type = int, nargs = "+",
+      default = [100, 1000, 10000])
+  arg_parser.add_argument("--teams", type = int, default = 20)
+  arg_parser.add_argument("--name-formats", nargs = "+",
+      default = ["first_last", "last_first"])
+  arg_parser.add_argument("--repeat", type = int, default = 3)
+  arg_parser.add_argument("--no-class-column", action = "store_true")
+  arg_parser.add_argument("--no-noise", action = "store_true")
+  arg_parser.add_argument("--output", help = "write results as json")
+  args = arg_parser.parse_args()
+  # Saving includes storing columns and updating the course model,
+  # as it does in the app
+  hooks.register()
+
+  records = []
+  print "Parser"
+  print "%8s %-11s %8s %8s  %s" % ("runners", "names", "total", "accuracy",
+      "  ".join("%15s" % phase for phase in PHASES))
+  for finishers in args.sizes:
+    for name_format in args.name_formats:
+      record = run_case(finishers, args.teams, name_format,
+          not args.no_class_column, not args.no_noise, args.repeat)
+      records.append(record)
+      print "%8d %-11s %8.3f %8.3f  %s" % (finishers, name_format,
+          record["total"], record["accuracy"],
+          "  ".join("%15.4f" % record["phases"][phase] for phase in PHASES))
+  print "\nMeetParser"
+  print "%8s %-11s %8s %8s  %s" % ("runners", "names", "total", "accuracy",
+      "  ".join("%10s" % span for span in MEET_SPANS))
+  for record in records:
+    meet = record["meet_parser"]
+    print "%8d %-11s %8.3f %8.3f  %s" % (record["finishers"],
+        record["name_format"], meet["total"], meet["accuracy"],
+        "  ".join("%10.4f" % meet["spans"][span] for span in MEET_SPANS))
+  if args.output:
+    with open(args.output, "w") as buff:
+      json.dump(records, buff, indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,107 @@
+"""Times team scoring of a championship-sized race, and of many
+simulated finishes of it at once, against a plain loop scorer.
+
+    python -m benchmarks.scoring_bench --teams 40 --races 1 1000 10000 \
+        --output scoring_bench.json
+"""
+import argparse
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import mongomock
+import pymongo
+# scoring imports mongo_utilities, which connects when it is imported
+pymongo.MongoClient = mongomock.MongoClient
+
+import scoring
+
+def simulate(teams, runners, individuals, races, seed = 0):
+  """Returns finishes of one field as team codes, one race per row.
+  Each runner's time is their ability plus noise for the day
+  """
+  random = np.random.RandomState(seed)
+  codes = np.concatenate([np.repeat(np.arange(teams), runners),
+    np.full(individuals, scoring.NO_TEAM, dtype = int)])
+  ability = random.normal(0, 60, len(codes)) + \
+      np.where(codes >= 0, random.normal(0, 30, teams)[codes], 0)
+  times = ability + random.normal(0, 20, (races, len(codes)))
+  return codes[np.argsort(times, axis = 1)]
+
+def loop_winners(codes, teams):
+  """Scores each race with plain python, returning the winners
+  """
+  winners = []
+  for race in codes:
+    counts = defaultdict(int)
+    for code in race:
+      counts[code] += 1
+    seen = defaultdict(int)
+    places = defaultdict(list)
+    place = 0
+    for code in race:
+      if code == scoring.NO_TEAM or counts[code] < scoring.SCORERS:
+        continue
+      seen[code] += 1
+      if seen[code] > scoring.SCORERS + scoring.DISPLACERS:
+        continue
+      place += 1
+      places[code].append(place)
+    ranking = sorted(places, key = lambda code: (
+      sum(places[code][:scoring.SCORERS]),
+      places[code][scoring.SCORERS] if len(places[code]) > scoring.SCORERS
+      else float("inf")))
+    winners.append(ranking[0] if ranking else scoring.NO_TEAM)
+  return np.array(winners)
+
+def best_time(func, repeat):
+  """Returns (best seconds, result) over repeat calls of func
+  """
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+def main():
+  """Runs the benchmark and reports the results
+  """
+  arg_parser = argparse.ArgumentParser(description = __doc__,
+      formatter_class = argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--teams", type = int, default = 40)
+  arg_parser.add_argument("--runners", type = int, default = 7,
+      help = "runners per team")
+  arg_parser.add_argument("--individuals", type = int, default = 40)
+  arg_parser.add_argument("--races", type = int, nargs = "+",
+      default = [1, 1000, 10000])
+  arg_parser.add_argument("--repeat", type = int, default = 3)
+  arg_parser.add_argument("--output", help = "write results as json")
+  args = arg_parser.parse_args()
+
+  records = []
+  print "%8s %10s %10s %8s" % ("races", "vector", "loop", "speedup")
+  for races in args.races:
+    codes = simulate(args.teams, args.runners, args.individuals, races)
+    vector, winners = best_time(lambda: scoring.score_races(codes,
+      args.teams).winners(), args.repeat)
+    loop, expected = best_time(lambda: loop_winners(codes, args.teams),
+        args.repeat)
+    assert (winners == expected).all()
+    records.append({
+      "teams": args.teams,
+      "finishers": codes.shape[1],
+      "races": races,
+      "vector_seconds": vector,
+      "loop_seconds": loop})
+    print "%8d %10.4f %10.4f %8.1f" % (races, vector, loop, loop/vector)
+  if args.output:
+    with open(args.output, "w") as buff:
+      json.dump(records, buff, indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+  main()
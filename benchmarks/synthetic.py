@@ -0,0 +1,107 @@
+"""Generates synthetic result files that look like the text
+output of the timing companies we get results from
+"""
+import datetime
+import random
+
+FIRST_NAMES = ["john", "michael", "sam", "patrick", "chris", "alex",
+    "daniel", "joe", "tom", "matt", "nick", "ben", "kevin", "brian",
+    "ryan", "sean", "tim", "will", "andrew", "eric", "jake", "luke",
+    "owen", "henry", "colin", "liam", "noah", "evan", "adam", "paul"]
+LAST_NAMES = ["smith", "jones", "brown", "miller", "davis", "wilson",
+    "moore", "taylor", "clark", "hall", "young", "king", "wright",
+    "lopez", "hill", "scott", "green", "adams", "baker", "nelson",
+    "carter", "mitchell", "roberts", "turner", "phillips", "campbell",
+    "parker", "evans", "edwards", "collins", "stewart", "murphy",
+    "cook", "rogers", "morgan", "cooper", "peterson", "reed", "bailey",
+    "kelly", "howard", "ward", "cox", "richardson", "wood", "watson",
+    "brooks", "bennett", "gray", "hughes", "price", "sanders", "myers"]
+TEAM_PLACES = ["north", "south", "east", "west", "central", "new",
+    "saint", "mount", "lake", "port", "fort", "glen"]
+TEAM_TOWNS = ["andover", "haven", "field", "brook", "ridge", "wood",
+    "hampton", "bury", "ford", "dale", "ton", "worth", "stead",
+    "mouth", "chester", "land", "view", "shire"]
+TEAM_TYPES = ["state", "college", "tech", "university", "academy"]
+CLASS_WORDS = ["fr", "so", "jr", "sr"]
+
+HEADER = [
+    "%(meetname)s",
+    "%(date)s  -  Franklin Park, Boston MA",
+    "Men's 8K Championship",
+    "",
+    "Official results by Example Timing Co.  Posted 7:45 pm",
+    "",
+    "Place Name                      %(class_header)sTeam                    Time     Pace",
+    "===== ========================= %(class_rule)s======================= ======== =====",
+    ]
+FOOTER = [
+    "",
+    "Team scores available at the finish line tent after 5:30",
+    "1 Results are unofficial until 24 hours after the race",
+    "Timing and scoring by Example Timing Co. 800-555-0199",
+    ]
+
+def team_names(count, rand):
+  """Returns count distinct team names
+  """
+  names = set()
+  while len(names) < count:
+    names.add("%s %s%s %s" % (
+      rand.choice(TEAM_PLACES),
+      rand.choice(TEAM_PLACES[:4] + ["", "", ""]),
+      rand.choice(TEAM_TOWNS),
+      rand.choice(TEAM_TYPES)))
+  return sorted(names)
+
+def format_time(seconds):
+  """Formats seconds as m:ss.s
+  """
+  tenths = int(round(seconds*10))
+  return "%d:%02d.%d" % (tenths//600, tenths%600//10, tenths%10)
+
+def generate_meet(finishers = 300,
+    teams = 20,
+    name_format = "first_last",
+    class_column = True,
+    noise = True,
+    date = datetime.date(2012, 11, 3),
+    seed = 0):
+  """Returns (text, runners) for a synthetic meet.  name_format is
+  "first_last" or "last_first" ("Last, First").  runners is a list
+  of (first, last, team, class_word, seconds) in finishing order
+  """
+  rand = random.Random(seed)
+  teams = team_names(teams, rand)
+  seconds = 24*60.
+  # spread the field over about fifteen minutes, whatever its size
+  gap = 15*60./finishers
+  runners = []
+  lines = []
+  for place in range(1, finishers + 1):
+    seconds += rand.expovariate(1/gap)
+    first = rand.choice(FIRST_NAMES)
+    last = rand.choice(LAST_NAMES)
+    team = rand.choice(teams)
+    class_word = rand.choice(CLASS_WORDS)
+    runners.append((first, last, team, class_word, round(seconds, 1)))
+    if name_format == "last_first":
+      name = "%s, %s" % (last.title(), first.title())
+    else:
+      name = "%s %s" % (first.title(), last.title())
+    pace = format_time(seconds/5.)
+    lines.append("%5d %-25s %s%-23s %8s %5s" % (
+      place,
+      name,
+      "%-3s" % class_word.upper() if class_column else "",
+      team.title(),
+      format_time(seconds),
+      pace))
+
+  if noise:
+    values = {
+        "meetname": "Synthetic Invitational",
+        "date": date.strftime("%B %d, %Y"),
+        "class_header": "Yr " if class_column else "",
+        "class_rule": "== " if class_column else ""}
+    lines = [line % values for line in HEADER] + lines + FOOTER
+  return "\n".join(lines), runners
@@ -0,0 +1,219 @@
+"""Compact columns of finishing times and ids for each meet, so
+season-wide aggregations run over arrays instead of documents
+"""
+import numpy as np
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+import mongo_utilities
+
+SECONDS_DTYPE = np.dtype("<f8")
+# ObjectIds are kept as their raw 12 bytes
+ID_DTYPE = np.dtype("V12")
+
+def pack_ids(ids):
+  """Returns an array of raw ObjectId bytes
+  """
+  return np.frombuffer("".join(oid.binary for oid in ids), dtype = ID_DTYPE)
+
+def unpack_id(value):
+  """Returns the ObjectId for one element of a packed id array
+  """
+  return ObjectId(value.tobytes())
+
+class MeetColumns:
+  """The finishers of one meet as parallel arrays in place order
+  """
+  def __init__(self, meet_id, date, seconds, runner_ids, team_ids,
+      course_id = None):
+    self.meet_id = meet_id
+    self.date = date
+    self.course_id = course_id
+    self.seconds = seconds
+    self.runner_ids = runner_ids
+    self.team_ids = team_ids
+
+  def __len__(self):
+    return len(self.seconds)
+
+  @classmethod
+  def from_meet_results(cls, meet):
+    """Builds the columns from a denormalized meet results document
+    """
+    rows = meet["results"]
+    return cls(meet["_id"], meet.get("date"),
+        (mongo_utilities.decode_arrays(rows, ["time"])["time"]/100.).astype(
+          SECONDS_DTYPE),
+        pack_ids(row["runner_id"] for row in rows),
+        pack_ids(row["team_id"] for row in rows),
+        meet.get("course_id"))
+
+  @classmethod
+  def from_document(cls, doc):
+    """Loads stored columns.  The arrays share memory with the
+    document's binary fields rather than copying them
+    """
+    return cls(doc["_id"], doc.get("date"),
+        np.frombuffer(doc["seconds"], dtype = SECONDS_DTYPE),
+        np.frombuffer(doc["runner_ids"], dtype = ID_DTYPE),
+        np.frombuffer(doc["team_ids"], dtype = ID_DTYPE),
+        doc.get("course_id"))
+
+  def to_document(self):
+    """Returns the columns packed for storage
+    """
+    return {
+        "_id": self.meet_id,
+        "date": self.date,
+        "course_id": self.course_id,
+        "count": len(self),
+        "seconds": Binary(self.seconds.astype(SECONDS_DTYPE).tostring()),
+        "runner_ids": Binary(self.runner_ids.tostring()),
+        "team_ids": Binary(self.team_ids.tostring())}
+
+# Functions called with (replaced, stored) lists of MeetColumns after
+# columns are stored, for anything kept up to date from them
+STORE_HOOKS = []
+
+def on_store(hook):
+  """Registers hook(replaced, stored) to be called after columns are
+  stored.  replaced holds the previous columns of the stored meets
+  that had any
+  """
+  STORE_HOOKS.append(hook)
+  return hook
+
+def store_meet_columns(*meets):
+  """Replaces the stored columns of meets from their rebuilt
+  results documents.  hooks.register makes it a build hook
+  """
+  if not meets:
+    return
+  collection = mongo_utilities.DB[mongo_utilities.MEET_COLUMN_COLLECTION]
+  query = {"_id": {"$in": [meet["_id"] for meet in meets]}}
+  replaced = [MeetColumns.from_document(doc) for doc in
+      collection.find(query)] if STORE_HOOKS else []
+  stored = [MeetColumns.from_meet_results(meet) for meet in meets]
+  collection.remove(query)
+  collection.insert([columns.to_document() for columns in stored])
+  for hook in STORE_HOOKS:
+    hook(replaced, stored)
+
+def build_meet_columns(*meet_ids):
+  """Stores columns for meets from their results documents, building
+  those first where they are missing.  Returns the number stored
+  """
+  meets = mongo_utilities.DB[mongo_utilities.MEET_RESULT_COLLECTION].find(
+      {"_id": {"$in": list(meet_ids)}} if meet_ids else {})
+  meets = list(meets)
+  missing = set(meet_ids) - set(meet["_id"] for meet in meets)
+  if missing:
+    mongo_utilities.build_meet_results(*missing)
+  store_meet_columns(*meets)
+  return len(meets) + len(missing)
+
+def load_meet_columns(meet_ids = None, start = None, end = None):
+  """Returns MeetColumns for the given meets, or for every meet
+  between the start and end dates, oldest first
+  """
+  query = {}
+  if meet_ids is not None:
+    query["_id"] = {"$in": list(meet_ids)}
+  if start or end:
+    query["date"] = {}
+    if start:
+      query["date"]["$gte"] = mongo_utilities.to_datetime(start)
+    if end:
+      query["date"]["$lte"] = mongo_utilities.to_datetime(end)
+  docs = mongo_utilities.DB[mongo_utilities.MEET_COLUMN_COLLECTION].find(
+      query).sort("date")
+  return [MeetColumns.from_document(doc) for doc in docs]
+
+class Season:
+  """Many meets' columns joined end to end, with each runner and
+  team replaced by an integer code
+  """
+  def __init__(self, columns):
+    self.meet_ids = [meet.meet_id for meet in columns]
+    self.dates = [meet.date for meet in columns]
+    self.course_ids = [meet.course_id for meet in columns]
+    counts = [len(meet) for meet in columns]
+    self.meet = np.repeat(np.arange(len(columns)), counts)
+    self.place = np.concatenate([np.arange(1, count + 1) for
+      count in counts]) if columns else np.zeros(0, dtype = int)
+    self.seconds = np.concatenate([meet.seconds for meet in columns]) if \
+        columns else np.zeros(0, dtype = SECONDS_DTYPE)
+    self.runners, self.runner = unique_ids(
+        [meet.runner_ids for meet in columns])
+    self.teams, self.team = unique_ids([meet.team_ids for meet in columns])
+
+  def runner_code(self, runner_id):
+    """Returns the integer code for a runner, or None
+    """
+    return find_code(self.runners, runner_id)
+
+  def team_code(self, team_id):
+    """Returns the integer code for a team, or None
+    """
+    return find_code(self.teams, team_id)
+
+def unique_ids(arrays):
+  """Returns (unique ids, code of each element) for packed id arrays
+  """
+  if not arrays:
+    return np.zeros(0, dtype = ID_DTYPE), np.zeros(0, dtype = int)
+  return np.unique(np.concatenate(arrays), return_inverse = True)
+
+def find_code(ids, oid):
+  """Returns the position of an ObjectId in a sorted id array, or None
+  """
+  value = np.frombuffer(oid.binary, dtype = ID_DTYPE)[0]
+  code = np.searchsorted(ids, value)
+  if code < len(ids) and ids[code] == value:
+    return int(code)
+  return None
+
+def runner_history(season, runner_id):
+  """Returns (meet_ids, dates, places, seconds) for a runner
+  """
+  code = season.runner_code(runner_id)
+  if code is None:
+    return [], [], np.zeros(0, dtype = int), np.zeros(0)
+  mask = season.runner == code
+  meets = season.meet[mask]
+  return ([season.meet_ids[j] for j in meets],
+      [season.dates[j] for j in meets],
+      season.place[mask], season.seconds[mask])
+
+def team_averages(season, top = 5):
+  """Returns (meets, team codes, average seconds) of the top
+  finishers of each team at each meet, as parallel arrays
+  """
+  order = np.lexsort((season.seconds, season.team, season.meet))
+  meet = season.meet[order]
+  team = season.team[order]
+  seconds = season.seconds[order]
+  start = np.ones(len(order), dtype = bool)
+  start[1:] = (meet[1:] != meet[:-1]) | (team[1:] != team[:-1])
+  group = np.cumsum(start) - 1
+  first = np.flatnonzero(start)
+  rank = np.arange(len(order)) - first[group]
+  keep = rank < top
+  counts = np.bincount(group[keep], minlength = len(first))
+  totals = np.bincount(group[keep], seconds[keep], minlength = len(first))
+  return meet[first], team[first], totals/np.maximum(counts, 1)
+
+def course_comparison(season):
+  """Returns {course_id: (finishers, median, mean, best)} seconds
+  over every meet run on each course
+  """
+  courses = np.array([season.course_ids.index(course_id) for
+    course_id in season.course_ids])
+  course = courses[season.meet] if len(season.meet) else season.meet
+  comparison = {}
+  for code in np.unique(course):
+    seconds = season.seconds[course == code]
+    comparison[season.course_ids[code]] = (len(seconds),
+        float(np.median(seconds)), float(seconds.mean()),
+        float(seconds.min()))
+  return comparison
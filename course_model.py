@@ -0,0 +1,196 @@
+"""Course difficulty from runners who raced on more than one course.
+
+Log finishing times are fitted as runner ability plus course offset,
+by ridge regularized least squares.  Solving for the abilities leaves
+a small system in the course offsets alone, whose terms add up over
+runners: each result adds to its course's count and total, and each
+runner adds a correction from their counts and total on every course.
+Those statistics are kept in the database and updated as meets are
+stored, so the offsets can be solved again after every upload without
+reading old results.
+"""
+import threading
+
+import numpy as np
+
+import columnar
+import mongo_utilities
+
+RIDGE = 1.
+MODEL_ID = "course_offsets"
+# Serializes updates from concurrent ingestion workers
+LOCK = threading.Lock()
+
+class CourseModel:
+  """Normal equations for the course offsets: matrix.offsets = vector.
+  version counts the times the stored model has been saved
+  """
+  def __init__(self, courses = (), matrix = None, vector = None,
+      version = 0):
+    self.courses = list(courses)
+    self.version = version
+    self.index = dict((course_id, j) for j, course_id in
+        enumerate(self.courses))
+    size = len(self.courses)
+    self.matrix = np.zeros((size, size)) if matrix is None else \
+        np.array(matrix, dtype = float).reshape(size, size)
+    self.vector = np.zeros(size) if vector is None else \
+        np.array(vector, dtype = float)
+
+  @classmethod
+  def load(cls):
+    """Returns the stored model, or an empty one
+    """
+    collection = mongo_utilities.DB[mongo_utilities.COURSE_MODEL_COLLECTION]
+    doc = collection.find_one({"_id": MODEL_ID})
+    if doc is None:
+      return cls()
+    return cls(doc["courses"], doc["matrix"], doc["vector"],
+        doc.get("version", 0))
+
+  def save(self):
+    """Stores the model as a new version
+    """
+    self.version += 1
+    mongo_utilities.DB[mongo_utilities.COURSE_MODEL_COLLECTION].update(
+        {"_id": MODEL_ID},
+        {"_id": MODEL_ID,
+          "courses": self.courses,
+          "matrix": self.matrix.ravel().tolist(),
+          "vector": self.vector.tolist(),
+          "version": self.version},
+        upsert = True)
+    mongo_utilities.notify(mongo_utilities.COURSE_MODEL_COLLECTION)
+
+  def course_code(self, course_id):
+    """Returns the row for a course, adding one if it is new
+    """
+    if course_id not in self.index:
+      self.index[course_id] = len(self.courses)
+      self.courses.append(course_id)
+      size = len(self.courses)
+      matrix = np.zeros((size, size))
+      matrix[:-1, :-1] = self.matrix
+      self.matrix = matrix
+      self.vector = np.append(self.vector, 0.)
+    return self.index[course_id]
+
+  def add_runner(self, stats, sign):
+    """Adds (sign 1) or takes away (sign -1) a runner's correction
+    """
+    if not stats["races"]:
+      return
+    codes = np.array([self.course_code(course_id) for
+      course_id, _ in stats["courses"]], dtype = int)
+    counts = np.array([count for _, count in stats["courses"]], dtype = float)
+    self.matrix[np.ix_(codes, codes)] -= \
+        sign*np.outer(counts, counts)/stats["races"]
+    self.vector[codes] -= sign*counts*stats["total"]/stats["races"]
+
+  def update(self, replaced, stored):
+    """Takes the replaced meets' results out of the model and puts the
+    stored meets' results in.  Meets without a course are left out
+    """
+    rows = []
+    for meets, sign in ((replaced, -1.), (stored, 1.)):
+      for meet in meets:
+        if meet.course_id is not None and len(meet):
+          rows.append((meet.runner_ids, np.log(meet.seconds),
+            np.full(len(meet), sign),
+            np.full(len(meet), self.course_code(meet.course_id))))
+    if not rows:
+      return
+    runner_ids, logs, signs, codes = [np.concatenate(column) for
+        column in zip(*rows)]
+    np.add.at(self.matrix, (codes, codes), signs)
+    np.add.at(self.vector, codes, signs*logs)
+
+    runners, runner = np.unique(runner_ids, return_inverse = True)
+    size = len(self.courses)
+    counts = np.bincount(runner*size + codes, signs,
+        minlength = len(runners)*size).reshape(len(runners), size)
+    totals = np.bincount(runner, signs*logs, minlength = len(runners))
+    runner_ids = [columnar.unpack_id(value) for value in runners]
+
+    collection = mongo_utilities.DB[mongo_utilities.RUNNER_COURSE_COLLECTION]
+    old = dict((stats["_id"], stats) for stats in
+        collection.find({"_id": {"$in": runner_ids}}))
+    new = []
+    for j, runner_id in enumerate(runner_ids):
+      stats = old.get(runner_id,
+          {"_id": runner_id, "races": 0, "total": 0., "courses": []})
+      self.add_runner(stats, -1.)
+      courses = dict(stats["courses"])
+      for code in np.flatnonzero(counts[j]):
+        course_id = self.courses[code]
+        courses[course_id] = courses.get(course_id, 0) + int(counts[j, code])
+      stats = {
+          "_id": runner_id,
+          "races": sum(courses.values()),
+          "total": stats["total"] + totals[j],
+          "courses": [[course_id, count] for course_id, count in
+            courses.iteritems() if count]}
+      self.add_runner(stats, 1.)
+      if stats["races"]:
+        new.append(stats)
+    collection.remove({"_id": {"$in": runner_ids}})
+    if new:
+      collection.insert(new)
+
+  def offsets(self, ridge = RIDGE):
+    """Returns {course_id: offset} in log seconds.  Ridge pulls the
+    offsets of courses with few shared runners toward zero
+    """
+    if not self.courses:
+      return {}
+    offsets = np.linalg.solve(self.matrix + ridge*np.eye(len(self.courses)),
+        self.vector)
+    return dict(zip(self.courses, offsets))
+
+  def factors(self, ridge = RIDGE):
+    """Returns {course_id: how many times longer than average runners
+    take there}
+    """
+    return dict((course_id, float(np.exp(offset))) for course_id, offset in
+        self.offsets(ridge).iteritems())
+
+def update_model(replaced, stored):
+  """Updates the stored model as meet columns are stored.
+  hooks.register makes it a store hook
+  """
+  with LOCK:
+    model = CourseModel.load()
+    model.update(replaced, stored)
+    model.save()
+
+def refit():
+  """Rebuilds the model from every meet's stored columns
+  """
+  with LOCK:
+    mongo_utilities.DB[mongo_utilities.RUNNER_COURSE_COLLECTION].remove()
+    # Versions keep counting so predictions cached from the old model
+    # are not taken for the new one's
+    model = CourseModel(version = CourseModel.load().version)
+    model.update([], columnar.load_meet_columns())
+    model.save()
+  return model
+
+def abilities(stats, offsets):
+  """Returns each runner's time on an average course, in seconds,
+  from their statistics documents
+  """
+  return np.exp([(runner["total"] - sum(count*offsets.get(course_id, 0.) for
+    course_id, count in runner["courses"]))/runner["races"] for
+    runner in stats])
+
+def rankings(limit = mongo_utilities.PAGE_SIZE, min_races = 2):
+  """Returns [(runner_id, seconds, races)] for the fastest runners by
+  course-adjusted time
+  """
+  stats = list(mongo_utilities.DB[mongo_utilities.RUNNER_COURSE_COLLECTION]
+      .find({"races": {"$gte": min_races}}))
+  if not stats:
+    return []
+  seconds = abilities(stats, CourseModel.load().offsets())
+  return [(stats[j]["_id"], float(seconds[j]), stats[j]["races"]) for
+      j in np.argsort(seconds)[:limit]]
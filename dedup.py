@@ -0,0 +1,176 @@
+"""Batch search for duplicate runners and teams that are already
+stored.  Candidates are only compared within a blocking key, so the
+work grows with the size of the blocks rather than the square of the
+collection
+"""
+import itertools
+
+import mongo_utilities
+import similarity
+from mongo_utilities import (REVIEW_MERGE, TEAM_COLLECTION,
+    RUNNER_COLLECTION, RESULT_COLLECTION, MERGE_QUEUE_COLLECTION)
+
+def backfill_block_keys():
+  """Adds blocking keys to runners and teams stored without them.
+  Returns the number of documents updated
+  """
+  db = mongo_utilities.DB
+  updated = 0
+  for team in db[TEAM_COLLECTION].find({"block_keys": {"$exists": False}},
+      ["alias"]):
+    db[TEAM_COLLECTION].update({"_id": team["_id"]}, {"$set": {
+      "block_keys": sorted(set(block for alias in team["alias"] for
+        block in similarity.team_block_keys(alias)))}})
+    updated += 1
+  for runner in db[RUNNER_COLLECTION].find(
+      {"block_keys": {"$exists": False}},
+      ["first_name", "last_name", "team_id"]):
+    db[RUNNER_COLLECTION].update({"_id": runner["_id"]}, {"$set": {
+      "block_keys": similarity.runner_block_keys(runner["first_name"],
+        runner["last_name"], runner["team_id"])}})
+    updated += 1
+  return updated
+
+def candidate_pairs(collection, fields, score, same):
+  """Yields (keep_id, drop_id, similarity, same) for every pair of
+  documents sharing a blocking key, the older document kept
+  """
+  blocks = {}
+  for doc in mongo_utilities.DB[collection].find({},
+      fields + ["block_keys"]):
+    for block in doc.get("block_keys", []):
+      blocks.setdefault(block, []).append(doc)
+  seen = set()
+  for docs in blocks.itervalues():
+    for a, b in itertools.combinations(sorted(docs,
+        key = lambda doc: doc["_id"]), 2):
+      if (a["_id"], b["_id"]) not in seen:
+        seen.add((a["_id"], b["_id"]))
+        yield a["_id"], b["_id"], score(a, b), same(a, b)
+
+def team_score(a, b):
+  """Returns how alike two team documents are by any of their names
+  """
+  return max(similarity.team_similarity(x, y) for
+      x in a["alias"] for y in b["alias"])
+
+def team_same(a, b):
+  """Returns whether two team documents share a name but for case,
+  punctuation and abbreviations
+  """
+  return any(similarity.same_team(x, y) for
+      x in a["alias"] for y in b["alias"])
+
+def runner_fields(doc):
+  """Returns the (first_name, last_name, class_year) of a runner
+  document
+  """
+  return doc["first_name"], doc["last_name"], doc.get("class_year")
+
+def runner_score(a, b):
+  """Returns how alike two runner documents are
+  """
+  return similarity.runner_similarity(runner_fields(a), runner_fields(b))
+
+def runner_same(a, b):
+  """Returns whether two runner documents have the same names but for
+  case, punctuation or order
+  """
+  return similarity.same_runner(runner_fields(a), runner_fields(b))
+
+def queued_pairs():
+  """Returns the (keep_id, drop_id) pairs already in the merge queue
+  """
+  return set((merge["keep_id"], merge["drop_id"]) for merge in
+      mongo_utilities.DB[MERGE_QUEUE_COLLECTION].find({},
+        ["keep_id", "drop_id"]))
+
+def shared_meets(field, ids):
+  """Returns {id: set of meet_ids} for the runners or teams with ids,
+  field "runner_id" or "team_id"
+  """
+  meets = dict((doc_id, set()) for doc_id in ids)
+  for result in mongo_utilities.DB[RESULT_COLLECTION].find(
+      {field: {"$in": list(ids)}}, [field, "meet_id"]):
+    meets[result[field]].add(result["meet_id"])
+  return meets
+
+def find_root(parents, node):
+  """Returns the runner or team a merged one was folded into
+  """
+  while parents.get(node, node) != node:
+    node = parents[node]
+  return node
+
+def plan_merges(collection, fields, score, same, field, merge):
+  """Merges the pairs of a collection that are the same but for
+  case, punctuation or order, unless they raced in the same meet, and
+  returns (parents, reviews): the id each dropped one was folded into,
+  and (keep_id, drop_id, score) of the alike pairs to queue.  merge is
+  called with each pair to merge, or is None for a dry run
+  """
+  queued = queued_pairs()
+  merges = []
+  reviews = []
+  for keep_id, drop_id, pair_score, pair_same in candidate_pairs(
+      collection, fields, score, same):
+    if pair_same:
+      merges.append((keep_id, drop_id, pair_score))
+    elif pair_score >= REVIEW_MERGE and (keep_id, drop_id) not in queued:
+      reviews.append((keep_id, drop_id, pair_score))
+  meets = shared_meets(field, set(doc_id for pair in merges for
+    doc_id in pair[:2]))
+  parents = {}
+  for keep_id, drop_id, pair_score in merges:
+    keep_id = find_root(parents, keep_id)
+    drop_id = find_root(parents, drop_id)
+    if keep_id == drop_id:
+      continue
+    # Two runners or teams in one meet are not the same one
+    if meets[keep_id] & meets[drop_id]:
+      if (keep_id, drop_id) not in queued:
+        reviews.append((keep_id, drop_id, pair_score))
+      continue
+    if merge is not None:
+      merge(keep_id, drop_id)
+    parents[drop_id] = keep_id
+    meets[keep_id] |= meets.pop(drop_id)
+  return parents, reviews
+
+def queue_reviews(collection, parents, reviews):
+  """Queues the reviews whose runners or teams were not merged
+  """
+  for keep_id, drop_id, score in reviews:
+    if drop_id not in parents and keep_id not in parents:
+      mongo_utilities.queue_merge(collection, keep_id, drop_id, score)
+
+def dedup_teams(dry_run = False):
+  """Merges teams with the same name but for case, punctuation and
+  abbreviations, and queues alike ones for review.  Teams that raced
+  in the same meet are never merged.  Returns (merged, queued)
+  """
+  parents, reviews = plan_merges(TEAM_COLLECTION, ["alias"], team_score,
+      team_same, "team_id", None if dry_run else mongo_utilities.merge_teams)
+  if not dry_run:
+    queue_reviews(TEAM_COLLECTION, parents, reviews)
+  return len(parents), len(reviews)
+
+def dedup_runners(dry_run = False):
+  """Merges runners with the same names but for case, punctuation or
+  order, and queues alike ones for review.  Runners who raced in the
+  same meet are never merged.  Returns (merged, queued)
+  """
+  def merge(keep_id, drop_id):
+    """Merges two runners, rebuilding meet results once at the end
+    """
+    mongo_utilities.merge_runners(keep_id, drop_id, rebuild = False)
+  parents, reviews = plan_merges(RUNNER_COLLECTION,
+      ["first_name", "last_name", "class_year"], runner_score, runner_same,
+      "runner_id", None if dry_run else merge)
+  if dry_run:
+    return len(parents), len(reviews)
+  queue_reviews(RUNNER_COLLECTION, parents, reviews)
+  if parents:
+    mongo_utilities.rebuild_meet_results(runner_id = {"$in":
+      list(set(find_root(parents, keep_id) for keep_id in parents))})
+  return len(parents), len(reviews)
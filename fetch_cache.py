@@ -0,0 +1,156 @@
+"""On-disk cache of the result lines extracted from remote result
+pages, so re-imports skip both the download and the html parsing.
+Pages that are not cached are stored line by line as they stream in
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+# Bytes read from a page at a time
+CHUNK_SIZE = 16384
+
+class FetchCache:
+  """Stores the extracted text of each page under a hash of its url,
+  with the ETag and Last-Modified headers used to revalidate it.
+  The least recently used pages are evicted past max_bytes
+  """
+  def __init__(self, directory, max_bytes = 100*2**20, max_age = 0):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.revalidated = 0
+    self.misses = 0
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def paths(self, url):
+    """Returns the (metadata, text) paths for a url
+    """
+    key = os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+    return key + ".json", key + ".txt"
+
+  def load(self, url):
+    """Returns (metadata, lines) for a cached url, or (None, None)
+    """
+    meta_path, text_path = self.paths(url)
+    try:
+      with open(meta_path) as buff:
+        meta = json.load(buff)
+      with open(text_path, "rb") as buff:
+        lines = buff.read().decode("utf-8").split("\n")
+    except (IOError, ValueError):
+      return None, None
+    return meta, lines
+
+  def store(self, url, response, lines):
+    """Writes the lines for a page as they are read, then its cache
+    headers once they are all written.  Yields the lines
+    """
+    meta_path, text_path = self.paths(url)
+    meta = {
+        "url": url,
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "fetched": time.time()}
+    temp_path = "%s.%d.tmp" % (text_path, threading.current_thread().ident)
+    try:
+      with open(temp_path, "wb") as buff:
+        for j, line in enumerate(lines):
+          buff.write((u"\n" if j else u"").encode("utf-8") +
+              line.encode("utf-8"))
+          yield line
+    except BaseException:
+      os.remove(temp_path)
+      raise
+    with self.lock:
+      os.rename(temp_path, text_path)
+      write_file(meta_path, json.dumps(meta))
+      self.evict()
+
+  def fetch(self, url, extract, session = None, timeout = None):
+    """Returns an iterator over the lines of url.  Cached pages
+    younger than max_age seconds are used as they are, and older ones
+    are revalidated with a conditional request.  Otherwise the page
+    is streamed through extract, which takes an iterable of html
+    chunks and yields lines, and the lines are cached as they come.
+    A page is only cached once all its lines have been read
+    """
+    meta, lines = self.load(url)
+    headers = {}
+    if meta:
+      if time.time() - meta["fetched"] < self.max_age:
+        self.hits += 1
+        self.touch(url)
+        return iter(lines)
+      if meta["etag"]:
+        headers["If-None-Match"] = meta["etag"]
+      if meta["last_modified"]:
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = (session or requests).get(url, headers = headers,
+        timeout = timeout, stream = True)
+    if meta and response.status_code == 304:
+      self.revalidated += 1
+      meta["fetched"] = time.time()
+      with self.lock:
+        write_file(self.paths(url)[0], json.dumps(meta))
+      return iter(lines)
+    response.raise_for_status()
+    self.misses += 1
+    # Chunks are only decoded if the page's encoding is known
+    response.encoding = response.encoding or "utf-8"
+    return self.store(url, response, extract(response.iter_content(
+      CHUNK_SIZE, decode_unicode = True)))
+
+  def touch(self, url):
+    """Marks a page as recently used
+    """
+    for path in self.paths(url):
+      if os.path.exists(path):
+        os.utime(path, None)
+
+  def evict(self):
+    """Removes the least recently used pages until the cache fits
+    in max_bytes.  Callers hold the lock
+    """
+    pages = {}
+    for name in os.listdir(self.directory):
+      key, extension = os.path.splitext(name)
+      if extension not in (".json", ".txt"):
+        continue
+      stat = os.stat(os.path.join(self.directory, name))
+      used, size = pages.get(key, (0, 0))
+      pages[key] = (max(used, stat.st_mtime), size + stat.st_size)
+    total = sum(size for _, size in pages.itervalues())
+    for key, (_, size) in sorted(pages.iteritems(),
+        key = lambda page: page[1][0]):
+      if total <= self.max_bytes:
+        break
+      for extension in (".json", ".txt"):
+        path = os.path.join(self.directory, key + extension)
+        if os.path.exists(path):
+          os.remove(path)
+      total -= size
+
+  def stats(self):
+    """Returns hit, revalidation and miss counts
+    """
+    return {
+        "hits": self.hits,
+        "revalidated": self.revalidated,
+        "misses": self.misses}
+
+def write_file(path, data):
+  """Writes data to path by renaming a temporary file over it, so
+  readers never see a partial file
+  """
+  temp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+  with open(temp_path, "wb") as buff:
+    buff.write(data)
+  os.rename(temp_path, path)
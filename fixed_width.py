@@ -0,0 +1,175 @@
+"""Finds the columns of fixed-width result lines from how their
+characters line up, so every line can be read by slicing it at the
+same offsets instead of splitting it word by word.
+
+A gutter is a character position that is blank in almost every line.
+Positions are counted both from the start of each line and from its
+end, since a name or team too long for its column pushes the rest of
+its line right: columns before it still line up from the start, and
+the ones after it from the end.
+"""
+import datetime
+from collections import Counter
+
+import numpy as np
+
+import parser
+
+# Share of lines that must be blank at a position for it to be a gutter
+GUTTER_SHARE = 0.9
+# Share of a column's values that must have a type for it to take it,
+# out of the first ROLE_SAMPLE lines
+TYPE_SHARE = 0.9
+CLASS_SHARE = 0.5
+ROLE_SAMPLE = 500
+
+def char_array(lines, align):
+  """Returns the characters of lines as a 2-d array, each line padded
+  with spaces on the right for align "left" or on the left for "right"
+  """
+  width = max(len(line) for line in lines)
+  padded = np.array([line.ljust(width) if align == "left" else
+    line.rjust(width) for line in lines])
+  return padded.view(padded.dtype.char + "1").reshape(len(lines), width)
+
+def gutter_cuts(chars):
+  """Returns the positions where a column starts just after a gutter,
+  leaving out the gutter most lines start with
+  """
+  gutter = (chars == " ").sum(axis = 0) >= GUTTER_SHARE*len(chars)
+  starts = np.flatnonzero(gutter[:-1] & ~gutter[1:]) + 1
+  first = np.flatnonzero(~gutter)
+  return [int(start) for start in starts if len(first) and
+      start > first[0]]
+
+def split_name(name):
+  """Returns (firstname, lastname) for "First Last" or "Last, First"
+  """
+  if "," in name:
+    last, first = name.split(",", 1)
+    return first.strip(), last.strip()
+  words = name.split()
+  return (words[0] if words else ""), " ".join(words[1:])
+
+def read_time(value):
+  """Returns a time field as a timedelta, or None
+  """
+  match = parser.TIME_PATTERN.match(value)
+  if match is None or match.end() != len(value):
+    return None
+  minutes, seconds, fraction = match.groups()
+  return datetime.timedelta(0, int(minutes or 0)*60 + int(seconds) +
+      float(fraction or 0))
+
+def share(column, test):
+  """Returns the share of a column's values that pass test
+  """
+  return sum(1 for value in column if value and test(value)) / \
+      float(len(column))
+
+class Columns:
+  """Where the columns of a race's result lines start, and what each
+  holds.  boundaries is a list of (anchor, offset): an offset from the
+  start of the line for anchor "left", or back from its end for
+  "right".  roles has one more entry than boundaries, naming each
+  column "place", "name", "class", "team", "time" or "split", or None
+  """
+  def __init__(self, boundaries, roles, class_words):
+    self.boundaries = boundaries
+    self.roles = roles
+    self.class_words = class_words
+
+  @classmethod
+  def detect(cls, lines, class_words):
+    """Returns the Columns of result lines, or None if no place,
+    name and time columns are found.  class_words maps class words
+    to graduation years
+    """
+    lines = [line.rstrip() for line in lines]
+    if not lines:
+      return None
+    left = gutter_cuts(char_array(lines, "left"))
+    length = Counter(len(line) for line in lines).most_common(1)[0][0]
+    width = max(len(line) for line in lines)
+    # Lines line up from the end only after the last column that lines
+    # up from the start
+    right = [width - cut for cut in gutter_cuts(char_array(lines, "right"))
+        if length - (width - cut) > max(left or [0])]
+    boundaries = sorted([("left", cut) for cut in left] +
+        [("right", offset) for offset in right],
+        key = lambda boundary: boundary[1] if boundary[0] == "left" else
+          length - boundary[1])
+    columns = cls(boundaries, [None]*(len(boundaries) + 1), class_words)
+    columns.roles = columns.find_roles(lines[:ROLE_SAMPLE])
+    if not set(["place", "name", "time"]) <= set(columns.roles):
+      return None
+    return columns
+
+  def find_roles(self, lines):
+    """Returns the role of each column from the values in it.  The
+    first column of numbers is the place and the time column with the
+    largest times is the finish, the others being splits or pace.  The
+    first column of text is the name and the next the team
+    """
+    values = zip(*[self.slice(line) for line in lines])
+    roles = []
+    times = {}
+    for j, column in enumerate(values):
+      filled = [value for value in column if value]
+      role = None
+      if not filled:
+        pass
+      elif "place" not in roles and share(column,
+          parser.PLACE_PATTERN.match) >= TYPE_SHARE:
+        role = "place"
+      elif share(column, read_time) >= TYPE_SHARE:
+        role = "split"
+        times[j] = sum(filter(None, map(read_time, filled)),
+            datetime.timedelta())
+      elif "class" not in roles and sum(value in self.class_words for
+          value in filled) >= CLASS_SHARE*len(filled):
+        role = "class"
+      elif any(c.isalpha() for value in filled for c in value):
+        if "name" not in roles:
+          role = "name"
+        elif "team" not in roles:
+          role = "team"
+      roles.append(role)
+    if times:
+      roles[max(times, key = times.get)] = "time"
+    return roles
+
+  def slice(self, line):
+    """Returns the stripped text of each column of a line
+    """
+    line = line.rstrip()
+    starts = [0]
+    for anchor, offset in self.boundaries:
+      start = offset if anchor == "left" else len(line) - offset
+      starts.append(min(max(start, starts[-1]), len(line)))
+    return [line[start:end].strip() for start, end in
+        zip(starts, starts[1:] + [len(line)])]
+
+  def fields(self, line):
+    """Returns the typed fields of a result line: place, firstname,
+    lastname, team, class_year, time and splits, the times as
+    timedeltas.  Names and teams the line does not have are empty,
+    and other fields None
+    """
+    values = dict.fromkeys(["place", "name", "class", "team", "time"], "")
+    splits = []
+    for role, value in zip(self.roles, self.slice(line)):
+      if role == "split":
+        splits.append(read_time(value))
+      elif role:
+        values[role] = value
+    place = parser.PLACE_PATTERN.match(values["place"])
+    firstname, lastname = split_name(values["name"])
+    return {
+        "place": int(place.group(1)) if place else None,
+        "firstname": firstname,
+        "lastname": lastname,
+        "team": " ".join(values["team"].split()),
+        "class_year": self.class_words.get(values["class"]),
+        "time": read_time(values["time"]),
+        "splits": splits}
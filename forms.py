@@ -22,6 +22,7 @@ class UploadForm(Form):
   date = DateField('Date', format= "%Y-%m-%d", id="dp")
   meetname = TextField('Meet Name')
   course = TextField('Course Name')
-  distance = TextField('Course Distance')
+  distance = TextField('Course Distance (m)', [validators.Optional(),
+    validators.Regexp(r"^[0-9]+$", message = "Distance in meters")])
   url = TextField('Result URL')
   file_data = FileField('Upload file')
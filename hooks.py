@@ -0,0 +1,16 @@
+"""Registers the functions that keep data derived from meets up to
+date: each meet's columns as its results are built, and the course
+model as columns are stored.  Everything that saves results calls
+register() before it starts
+"""
+import columnar
+import course_model
+import mongo_utilities
+
+def register():
+  """Registers the hooks.  Calling it again changes nothing
+  """
+  if columnar.store_meet_columns not in mongo_utilities.BUILD_HOOKS:
+    mongo_utilities.on_build(columnar.store_meet_columns)
+  if course_model.update_model not in columnar.STORE_HOOKS:
+    columnar.on_store(course_model.update_model)
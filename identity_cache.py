@@ -0,0 +1,106 @@
+"""Bounded in-process caches for resolving team and
+runner identities without a database round trip
+"""
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+  """Least recently used mapping with a maximum size and
+  hit/miss counters.  Safe to share between threads
+  """
+  def __init__(self, maxsize = 10000):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the value for key, or None if it is not cached
+    """
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+      self.misses += 1
+      return None
+
+  def put(self, key, value):
+    """Stores a value, evicting the least recently used
+    entry if the cache is full
+    """
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last = False)
+
+  def discard(self, key):
+    """Removes a key if it is cached
+    """
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def discard_where(self, predicate):
+    """Removes every entry where predicate(key, value) is true
+    """
+    with self.lock:
+      for key, value in self.entries.items():
+        if predicate(key, value):
+          del self.entries[key]
+
+  def clear(self):
+    """Removes every entry and resets the counters
+    """
+    with self.lock:
+      self.entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    """Returns a dictionary of size and hit/miss counts
+    """
+    lookups = self.hits + self.misses
+    return {
+        "size": len(self.entries),
+        "maxsize": self.maxsize,
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits/float(lookups) if lookups else 0.0}
+
+# lowercase alias -> team_id
+TEAM_IDS = LRUCache()
+# (first_name, last_name, team_id, class_year) -> runner_id
+RUNNER_IDS = LRUCache(maxsize = 100000)
+# Generation of the stored identities the caches were filled from,
+# and when it was last compared with the stored one
+GENERATION = {"value": None, "checked": 0.}
+
+def stats():
+  """Returns the stats for both identity caches
+  """
+  return {"teams": TEAM_IDS.stats(), "runners": RUNNER_IDS.stats()}
+
+def clear():
+  """Empties both identity caches
+  """
+  TEAM_IDS.clear()
+  RUNNER_IDS.clear()
+
+def sync(generation):
+  """Empties both caches if the stored identities have changed since
+  they were filled.  generation is a counter that every process bumps
+  after merging runners or teams
+  """
+  GENERATION["checked"] = time.time()
+  if generation != GENERATION["value"]:
+    clear()
+    GENERATION["value"] = generation
+
+def synced_within(seconds):
+  """Returns whether sync was called in the last seconds
+  """
+  return time.time() - GENERATION["checked"] < seconds
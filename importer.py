@@ -0,0 +1,135 @@
+"""Imports many result pages at once.  Pages are fetched
+concurrently over one pooled HTTP session, and parsed one at a
+time as they arrive
+"""
+import threading
+import time
+import urlparse
+from Queue import Queue, Empty
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from parser import MeetParser, FETCH_TIMEOUT, fetch_lines, iter_lines
+
+class Importer:
+  """Fetches result pages with a limit on concurrent requests per
+  host, retrying server errors and dropped connections.  Pages go
+  through cache, a FetchCache, if one is given
+  """
+  def __init__(self,
+      workers = 8,
+      per_host = 2,
+      retries = 2,
+      backoff = 0.5,
+      timeout = FETCH_TIMEOUT,
+      cache = None):
+    self.cache = cache
+    self.workers = workers
+    self.per_host = per_host
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = workers, pool_maxsize = workers)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self.host_limits = {}
+    self.lock = threading.Lock()
+
+  def host_limit(self, url):
+    """Returns the semaphore limiting requests to url's host
+    """
+    host = urlparse.urlparse(url).netloc
+    with self.lock:
+      if host not in self.host_limits:
+        self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+      return self.host_limits[host]
+
+  def fetch(self, url):
+    """Returns a report with the result lines extracted from the
+    page, or the error if it could not be fetched or read.  Only
+    server errors and dropped connections are retried
+    """
+    report = {"url": url, "attempts": 0, "lines": None, "error": None}
+    start = time.time()
+    while True:
+      report["attempts"] += 1
+      try:
+        with self.host_limit(url):
+          if self.cache:
+            lines = self.cache.fetch(url, iter_lines, self.session,
+                self.timeout)
+          else:
+            lines = fetch_lines(url, self.session, self.timeout)
+          # Pages are read while they download, so the host is busy
+          # until the last line
+          report["lines"] = list(lines)
+        break
+      except requests.RequestException as err:
+        response = getattr(err, "response", None)
+        retry = response is None or response.status_code >= 500
+        if not retry or report["attempts"] > self.retries:
+          report["error"] = str(err)
+          break
+        time.sleep(self.backoff*2**(report["attempts"] - 1))
+      except Exception as err:
+        # Anything else, such as a page that cannot be read, is
+        # reported so the other pages still arrive
+        report["error"] = "fetch failed: %s" % err
+        break
+    report["fetch_seconds"] = time.time() - start
+    return report
+
+  def fetch_all(self, urls):
+    """Yields a fetch report for each url as soon as it is done
+    """
+    urls = list(urls)
+    todo = Queue()
+    done = Queue()
+    for url in urls:
+      todo.put(url)
+
+    def work():
+      """Fetches urls until there are none left
+      """
+      while True:
+        try:
+          url = todo.get_nowait()
+        except Empty:
+          return
+        done.put(self.fetch(url))
+
+    threads = [threading.Thread(target = work) for
+        _ in range(min(self.workers, len(urls)))]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for _ in urls:
+      yield done.get()
+
+  def import_meets(self, meets):
+    """Fetches and parses a list of meets, each a dictionary with
+    url, meetname and date.  Returns a report per meet, in order
+    """
+    order = [meet["url"] for meet in meets]
+    meets = {meet["url"]: meet for meet in meets}
+    reports = {}
+    for report in self.fetch_all(meets):
+      meet = meets[report["url"]]
+      report["meetname"] = meet["meetname"]
+      if report["lines"] is not None:
+        start = time.time()
+        try:
+          parser = MeetParser(
+              meetname = meet["meetname"],
+              date = meet["date"],
+              lines = report["lines"])
+          report["meet_ids"] = parser.get_ids()
+          report["results"] = parser.saved
+        except Exception as err:
+          report["error"] = "parse failed: %s" % err
+        report["parse_seconds"] = time.time() - start
+      del report["lines"]
+      reports[report["url"]] = report
+    return [reports[url] for url in order]
@@ -0,0 +1,171 @@
+"""Background ingestion of uploaded result files and URLs, so
+that web requests only have to queue the work
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from Queue import Queue
+
+import instrumentation
+import mongo_utilities
+from parser import Course, MeetParser
+
+LOGGER = logging.getLogger(__name__)
+
+class IngestionQueue:
+  """Runs ingestion jobs on a pool of worker threads.  Job status
+  and progress are kept in the jobs collection so any web worker
+  can report on them.  With processes above 1 the races of every job
+  are parsed in one process pool, made before any thread starts
+  """
+  def __init__(self, workers = 2, cache = None, processes = 1,
+      profiler = None):
+    self.workers = workers
+    self.cache = cache
+    self.pool = multiprocessing.Pool(processes) if processes > 1 else None
+    self.profiler = profiler or instrumentation.Sampler()
+    self.queue = Queue()
+    self.threads = []
+    self.lock = threading.Lock()
+
+  def start(self):
+    """Starts the worker threads if they are not running
+    """
+    with self.lock:
+      while len(self.threads) < self.workers:
+        thread = threading.Thread(target = self.work,
+            name = "ingestion-%d" % len(self.threads))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+  def close(self):
+    """Lets the process pool finish the races it was given and waits
+    for its processes to exit
+    """
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+
+  def submit(self, meetname, date, path = None, url = None, output = None,
+      course = None, distance = None):
+    """Queues a result file at path, or a results page at url, and
+    returns the job id.  Parsed URL results are written to output.
+    The meet is recorded as run on course if given
+    """
+    job_id = mongo_utilities.create_job(
+        meetname = meetname,
+        date = date,
+        path = path,
+        url = url,
+        output = output,
+        course = course,
+        distance = distance)
+    self.start()
+    self.queue.put(job_id)
+    return job_id
+
+  def recover(self):
+    """Queues the jobs left unfinished when the app last stopped.
+    Jobs that were running start again, which is safe since saving
+    a race that is already stored only changes what differs.  Jobs
+    whose uploaded file is gone are failed.  Returns the number of
+    jobs queued
+    """
+    queued = 0
+    for job in mongo_utilities.get_unfinished_jobs():
+      if job.get("path") and not os.path.exists(job["path"]):
+        mongo_utilities.update_job(job["_id"], status = "failed",
+            error = "uploaded file is missing")
+        continue
+      if job["status"] == "running":
+        mongo_utilities.update_job(job["_id"], status = "queued")
+      self.start()
+      self.queue.put(job["_id"])
+      queued += 1
+    return queued
+
+  def work(self):
+    """Runs queued jobs forever
+    """
+    while True:
+      job_id = self.queue.get()
+      try:
+        run_job(job_id, self.cache, self.pool, self.profiler)
+      except Exception as err:
+        # Errors outside the parse, such as in saving the job's
+        # report, fail the job instead of stopping the worker
+        LOGGER.error("Ingestion job %s failed\n%s", job_id,
+            traceback.format_exc())
+        try:
+          mongo_utilities.update_job(job_id, status = "failed",
+              error = str(err))
+        except Exception:
+          LOGGER.error("Could not mark ingestion job %s failed\n%s",
+              job_id, traceback.format_exc())
+      finally:
+        self.queue.task_done()
+
+def run_job(job_id, cache = None, pool = None, profiler = None):
+  """Parses and saves the results for a job, recording its
+  progress and outcome.  Each race in the results is saved as its
+  own meet, parsed in the process pool if given.  Pages are fetched
+  through cache if given, and the job is profiled if profiler
+  samples it.  How long each phase took is kept on the meets it
+  changed.  Races already stored are only changed where their lines
+  differ.  Jobs another worker has taken are skipped
+  """
+  job = mongo_utilities.claim_job(job_id)
+  if job is None:
+    return
+
+  def progress(stage, **counts):
+    """Records the parser's progress on the job
+    """
+    mongo_utilities.update_job(job_id, stage = stage, **counts)
+
+  course = Course(job["course"], job.get("distance")) if \
+      job.get("course") else None
+  profiler = profiler or instrumentation.Sampler()
+  try:
+    with instrumentation.trace("ingestion") as trace, \
+        profiler.sample("ingestion"):
+      if job.get("path"):
+        with open(job["path"], "rb") as buff:
+          parser = MeetParser(
+              meetname = job["meetname"],
+              date = job["date"],
+              lines = buff,
+              progress = progress,
+              course = course,
+              pool = pool)
+      else:
+        parser = MeetParser(
+            meetname = job["meetname"],
+            date = job["date"],
+            url = job["url"],
+            progress = progress,
+            cache = cache,
+            course = course,
+            pool = pool,
+            output = job.get("output"))
+  except Exception as err:
+    LOGGER.error("Ingestion job %s failed\n%s", job_id,
+        traceback.format_exc())
+    mongo_utilities.update_job(job_id, status = "failed", error = str(err))
+    return
+  report = trace.report()
+  report["results"] = parser.saved
+  report["removed"] = parser.removed
+  if parser.saved_ids:
+    mongo_utilities.set_ingestion_report(parser.saved_ids, report)
+  LOGGER.info("Ingestion job %s took %.2fs: %s", job_id, trace.seconds,
+      report)
+  races = []
+  for (name, meet_id), change in zip(parser.races, parser.changes):
+    change.update(meet_id = meet_id, name = name)
+    races.append(change)
+  mongo_utilities.update_job(job_id, status = "done",
+      meet_id = parser.get_id(), races = races)
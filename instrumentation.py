@@ -0,0 +1,268 @@
+"""Timing and counting of the hot paths of ingestion and views.
+
+Code is timed in named spans, and every call on a mongo collection is
+counted and timed.  Totals since startup are kept for /metrics, and a
+trace collects the spans and mongo calls of one request or ingestion
+job in the thread running it.  A Sampler can also run cProfile over a
+random fraction of requests and jobs.
+"""
+import contextlib
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+
+LOCAL = threading.local()
+
+class Stats:
+  """Count, total and slowest seconds of something timed
+  """
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.
+    self.slowest = 0.
+
+  def add(self, seconds):
+    """Counts one more call taking seconds
+    """
+    self.count += 1
+    self.seconds += seconds
+    self.slowest = max(self.slowest, seconds)
+
+  def to_dict(self):
+    """Returns the stats as a dictionary
+    """
+    return {"count": self.count, "seconds": self.seconds,
+        "slowest": self.slowest}
+
+class Metrics:
+  """Stats by name, shared between threads
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.stats = {}
+
+  def add(self, name, seconds):
+    """Counts a call to name taking seconds
+    """
+    with self.lock:
+      stats = self.stats.get(name)
+      if stats is None:
+        stats = self.stats[name] = Stats()
+      stats.add(seconds)
+
+  def snapshot(self):
+    """Returns {name: stats dictionary}
+    """
+    with self.lock:
+      return dict((name, stats.to_dict()) for
+          name, stats in self.stats.iteritems())
+
+  def clear(self):
+    """Forgets every stat
+    """
+    with self.lock:
+      self.stats = {}
+
+# Totals since startup, by span name, "collection.method" and trace
+# name
+SPANS = Metrics()
+MONGO = Metrics()
+TRACES = Metrics()
+
+class Trace:
+  """The spans and mongo calls of one request or ingestion job.  A
+  span inside another counts toward both
+  """
+  def __init__(self, name):
+    self.name = name
+    self.start = time.time()
+    self.seconds = None
+    self.spans = {}
+    self.mongo = {}
+
+  def finish(self):
+    """Stops the clock
+    """
+    self.seconds = time.time() - self.start
+
+  def report(self):
+    """Returns the trace as a document: {seconds, spans: {name:
+    seconds}, mongo: {collection: {method: calls}}}
+    """
+    mongo = {}
+    for (collection, method), stats in self.mongo.iteritems():
+      mongo.setdefault(collection, {})[method] = stats.count
+    return {
+        "seconds": self.seconds,
+        "spans": dict((name, stats.seconds) for
+          name, stats in self.spans.iteritems()),
+        "mongo": mongo}
+
+def current():
+  """Returns the trace of this thread, or None
+  """
+  return getattr(LOCAL, "trace", None)
+
+def start_trace(name):
+  """Starts a trace for this thread and returns it
+  """
+  LOCAL.trace = Trace(name)
+  return LOCAL.trace
+
+def end_trace():
+  """Finishes and returns this thread's trace, or None if there is
+  none, counting it in TRACES
+  """
+  trace = current()
+  if trace is None:
+    return None
+  LOCAL.trace = None
+  trace.finish()
+  TRACES.add(trace.name, trace.seconds)
+  return trace
+
+@contextlib.contextmanager
+def trace(name):
+  """Traces the code inside, yielding the Trace
+  """
+  started = start_trace(name)
+  try:
+    yield started
+  finally:
+    end_trace()
+
+def record(metrics, table, name, seconds):
+  """Adds a timing to the totals and to this thread's trace
+  """
+  metrics.add(".".join(name) if isinstance(name, tuple) else name,
+      seconds)
+  trace_ = current()
+  if trace_ is not None:
+    stats = getattr(trace_, table).get(name)
+    if stats is None:
+      stats = getattr(trace_, table)[name] = Stats()
+    stats.add(seconds)
+
+@contextlib.contextmanager
+def span(name):
+  """Times the code inside as the span name
+  """
+  start = time.time()
+  try:
+    yield
+  finally:
+    record(SPANS, "spans", name, time.time() - start)
+
+def timed(name = None):
+  """Decorator timing every call to a function as a span, named
+  after the function unless name is given
+  """
+  def decorate(function):
+    span_name = name or function.__name__
+    @functools.wraps(function)
+    def call(*args, **kwargs):
+      with span(span_name):
+        return function(*args, **kwargs)
+    return call
+  return decorate
+
+def timed_iter(name, iterable):
+  """Yields from iterable, timing the time spent making its items
+  as one call to the span name
+  """
+  iterator = iter(iterable)
+  seconds = 0.
+  try:
+    while True:
+      start = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        seconds += time.time() - start
+      yield item
+  finally:
+    record(SPANS, "spans", name, seconds)
+
+class CountingCollection:
+  """Wraps a mongo collection to count and time every method call.
+  find only makes a cursor, so its time leaves out reading results
+  """
+  def __init__(self, collection):
+    self.collection = collection
+
+  def __getattr__(self, name):
+    attr = getattr(self.collection, name)
+    if not callable(attr):
+      return attr
+    key = (self.collection.name, name)
+    def call(*args, **kwargs):
+      start = time.time()
+      try:
+        return attr(*args, **kwargs)
+      finally:
+        record(MONGO, "mongo", key, time.time() - start)
+    return call
+
+class CountingDatabase:
+  """Wraps a mongo database so its collections count their calls
+  """
+  def __init__(self, database):
+    self.database = database
+
+  def __getitem__(self, name):
+    return CountingCollection(self.database[name])
+
+  def __getattr__(self, name):
+    return getattr(self.database, name)
+
+def snapshot():
+  """Returns the totals since startup
+  """
+  return {"traces": TRACES.snapshot(), "spans": SPANS.snapshot(),
+      "mongo": MONGO.snapshot()}
+
+class Sampler:
+  """Runs cProfile over a random fraction rate of the calls it is
+  asked to sample, writing each profile to folder for pstats
+  """
+  def __init__(self, rate = 0., folder = "profiles"):
+    self.rate = rate
+    self.folder = folder
+
+  def start(self):
+    """Returns a running profile, or None if this call is not sampled
+    """
+    if not self.rate or random.random() >= self.rate:
+      return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+  def stop(self, profile, name):
+    """Stops a profile from start and writes it out, returning its
+    path
+    """
+    if profile is None:
+      return None
+    profile.disable()
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+    path = os.path.join(self.folder, "%s-%d.prof" % (
+      name.replace("/", "_"), time.time()*1000))
+    profile.dump_stats(path)
+    return path
+
+  @contextlib.contextmanager
+  def sample(self, name):
+    """Profiles the code inside if it is sampled
+    """
+    profile = self.start()
+    try:
+      yield
+    finally:
+      self.stop(profile, name)
@@ -0,0 +1,190 @@
+"""Learned layouts of the fixed-width result files that timing
+companies print.
+
+A race's column headings and rules, with their spacing, fingerprint
+its layout.  The first time a layout is seen its columns are found
+from the headings, and lines sliced at those columns are checked
+against the heuristic parser.  If they agree the layout is stored,
+and later races with the same headings are read by slicing alone.
+"""
+import hashlib
+
+import fixed_width
+import mongo_utilities
+import parser
+from mongo_utilities import LAYOUT_COLLECTION
+
+# Heading words naming each column the extractor reads
+ROLE_WORDS = {
+    "place": set(["pl", "place", "pos", "overall"]),
+    "name": set(["name", "athlete", "runner"]),
+    "class": set(["yr", "year", "class", "cl", "gr", "grade"]),
+    "team": set(["team", "school", "affiliation", "club"]),
+    "time": set(["time", "final", "finish"]),
+    }
+REQUIRED_ROLES = set(["place", "name", "time"])
+# Share of lines the heuristic parser must agree on to store a layout,
+# and how many lines of a race are compared
+AGREEMENT = 0.9
+VERIFY_SAMPLE = 200
+
+# Stored layouts by fingerprint.  Layouts never change once stored
+LAYOUTS = {}
+
+def fingerprint(header):
+  """Returns the fingerprint of a race's header lines
+  """
+  return hashlib.sha1("\n".join(line.rstrip() for
+    line in header).encode("utf-8")).hexdigest()
+
+def column_starts(header):
+  """Returns the offsets where columns start: the starts of the
+  segments of the last rule line, or else of the heading words
+  """
+  rules = [line for line in header if parser.is_rule(line)]
+  line = rules[-1] if rules else next((line for line in header if
+    parser.is_column_heading(line)), "")
+  return [j for j, c in enumerate(line) if c != " " and
+      (j == 0 or line[j - 1] == " ")]
+
+def role(words):
+  """Returns the role of a column from its heading words, or None
+  """
+  for name, role_words in ROLE_WORDS.iteritems():
+    if role_words & set(words):
+      return name
+  return None
+
+class Layout:
+  """Column offsets and roles of a fixed-width layout.  columns is a
+  list of (start, role), role None for columns that are not read
+  """
+  def __init__(self, fingerprint, header, columns, name_format = None,
+      verified = False):
+    self.fingerprint = fingerprint
+    self.header = header
+    self.columns = columns
+    self.name_format = name_format
+    self.verified = verified
+
+  @classmethod
+  def from_header(cls, header):
+    """Returns the unverified Layout read from header lines, or None
+    if they do not name the columns needed
+    """
+    heading = next((line for line in header if
+      parser.is_column_heading(line)), None)
+    if heading is None:
+      return None
+    starts = column_starts(header)
+    ends = starts[1:] + [None]
+    columns = [(start, role(heading[start:end].split())) for
+        start, end in zip(starts, ends)]
+    if not REQUIRED_ROLES <= set(name for _, name in columns):
+      return None
+    return cls(fingerprint(header), header, columns)
+
+  @classmethod
+  def from_document(cls, doc):
+    """Loads a stored layout
+    """
+    return cls(doc["_id"], doc["header"],
+        [(column["start"], column["role"]) for column in doc["columns"]],
+        doc.get("name_format"), verified = True)
+
+  def to_document(self):
+    """Returns the layout for storage
+    """
+    return {
+        "_id": self.fingerprint,
+        "header": self.header,
+        "columns": [{"start": start, "role": name} for
+          start, name in self.columns],
+        "name_format": self.name_format}
+
+  def fields(self, line):
+    """Returns {role: text} for a line sliced at the column starts,
+    or None if it does not fit.  A field that runs over the space
+    before the next column pushes that column and the ones after it
+    right by as much
+    """
+    starts = []
+    shift = 0
+    for start, _ in self.columns:
+      start += shift
+      if start and line[start - 1:start] not in ("", " "):
+        gap = line.find(" ", start)
+        if gap < 0:
+          return None
+        shift += gap + 1 - start
+        start = gap + 1
+      starts.append(start)
+    return dict((name, line[start:end].strip()) for
+        (_, name), start, end in zip(self.columns, starts,
+          starts[1:] + [None]) if name)
+
+  def extract(self, line, class_words):
+    """Returns (place, time, runner) for a result line, runner a
+    (firstname, lastname, team, class_year) tuple like the heuristic
+    parser's, or None if the line does not fit the layout.
+    class_words maps class words to graduation years
+    """
+    fields = self.fields(line)
+    if fields is None:
+      return None
+    place = parser.PLACE_PATTERN.match(fields["place"])
+    time = parser.LineTokens(fields["time"]).time
+    name = fields["name"]
+    if not (place and time and name):
+      return None
+    if self.name_format == "last_first" and "," not in name:
+      return None
+    first, last = fixed_width.split_name(name)
+    return (int(place.group(1)), time, (first, last,
+      " ".join(fields.get("team", "").split()),
+      class_words.get(fields.get("class"))))
+
+  def verify(self, lines, expected, class_words):
+    """Checks the layout against the heuristic parser's (place,
+    time, runner) for the first VERIFY_SAMPLE lines, learning the
+    name format.  Lines that do not fit are left to the heuristic
+    parser, so only the others are compared.  Returns whether most
+    lines fit and enough of them agree
+    """
+    fitted = 0
+    agree = 0
+    commas = 0
+    lines = lines[:VERIFY_SAMPLE]
+    for line, parsed in zip(lines, expected):
+      extracted = self.extract(line, class_words)
+      if extracted is None:
+        continue
+      fitted += 1
+      agree += extracted == parsed
+      commas += "," in self.fields(line)["name"]
+    self.name_format = "last_first" if 2*commas > fitted else \
+        "first_last"
+    self.verified = fitted >= max(parser.RUN_LENGTH, len(lines)/2) and \
+        agree >= AGREEMENT*fitted
+    return self.verified
+
+def find_layout(header):
+  """Returns the stored Layout for header lines, else an unverified
+  one to learn from them, else None
+  """
+  if not header:
+    return None
+  key = fingerprint(header)
+  if key not in LAYOUTS:
+    doc = mongo_utilities.DB[LAYOUT_COLLECTION].find_one({"_id": key})
+    if doc is None:
+      return Layout.from_header(header)
+    LAYOUTS[key] = Layout.from_document(doc)
+  return LAYOUTS[key]
+
+def save_layout(layout):
+  """Stores a verified layout
+  """
+  mongo_utilities.DB[LAYOUT_COLLECTION].update(
+      {"_id": layout.fingerprint}, layout.to_document(), upsert = True)
+  LAYOUTS[layout.fingerprint] = layout
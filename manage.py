@@ -0,0 +1,145 @@
+"""Command line tasks for the app
+"""
+import argparse
+import datetime
+import sys
+
+import hooks
+import mongo_utilities
+
+def indexes(_):
+  """Creates any missing indexes and prints what was done
+  """
+  failures = 0
+  for collection, report in sorted(mongo_utilities.ensure_indexes().items()):
+    for name in report["created"]:
+      print "%s: created %s" % (collection, name)
+    for name in report["existing"]:
+      print "%s: exists %s" % (collection, name)
+    for name, error in report["failed"]:
+      failures += 1
+      print "%s: FAILED %s: %s" % (collection, name, error)
+  if failures:
+    print "merge duplicates with manage.py dedup and run this again"
+    sys.exit(1)
+
+def columns(args):
+  """Stores the compact results columns of the given meets, or of
+  every meet
+  """
+  import columnar
+  from bson.objectid import ObjectId
+  print "stored columns for %d meets" % columnar.build_meet_columns(
+      *[ObjectId(meet_id) for meet_id in args.meet_ids])
+
+def course_model(_):
+  """Refits the course model from every meet and prints the courses'
+  difficulty
+  """
+  import course_model
+  factors = course_model.refit().factors()
+  for course in mongo_utilities.get_courses():
+    if course["_id"] in factors:
+      print "%s: %+.1f%%" % (course["name"],
+          100*(factors[course["_id"]] - 1))
+
+def dedup(args):
+  """Merges duplicate teams and runners and queues likely ones for
+  review
+  """
+  import dedup
+  print "added blocking keys to %d documents" % dedup.backfill_block_keys()
+  for name, task in (("teams", dedup.dedup_teams),
+      ("runners", dedup.dedup_runners)):
+    merged, queued = task(dry_run = args.dry_run)
+    print "%s: %d merged, %d queued for review" % (name, merged, queued)
+  if not args.dry_run:
+    # The unique indexes can only be built once duplicates are merged
+    indexes(args)
+
+def migrate(args):
+  """Converts times and dates stored as strings to centiseconds and
+  datetimes
+  """
+  converted = mongo_utilities.migrate_codecs(args.batch)
+  for collection, count in sorted(converted.items()):
+    print "%s: converted %d documents" % (collection, count)
+
+def import_meets(args):
+  """Imports the result pages listed in a file, one per line as
+  date (YYYY-MM-DD), meet name and url separated by tabs
+  """
+  from importer import Importer
+  from fetch_cache import FetchCache
+  meets = []
+  for line in (sys.stdin if args.meets == "-" else open(args.meets)):
+    if line.strip() and not line.startswith("#"):
+      date, meetname, url = line.rstrip("\n").split("\t")
+      meets.append({
+        "date": datetime.datetime.strptime(date,
+          mongo_utilities.DATE_FMT).date(),
+        "meetname": meetname,
+        "url": url})
+  importer = Importer(
+      workers = args.workers,
+      per_host = args.per_host,
+      retries = args.retries,
+      cache = FetchCache(args.cache, max_age = args.cache_max_age) if
+        args.cache else None)
+  failures = 0
+  for report in importer.import_meets(meets):
+    if report["error"]:
+      failures += 1
+      print "FAIL %s (%d attempts, %.2fs): %s" % (report["url"],
+          report["attempts"], report["fetch_seconds"], report["error"])
+    else:
+      print "ok   %s: %d results in %d races (fetch %.2fs, parse %.2fs)" % (
+          report["url"], report["results"], len(report["meet_ids"]),
+          report["fetch_seconds"], report["parse_seconds"])
+  if failures:
+    sys.exit(1)
+
+def main():
+  """Parses the command line and runs a task
+  """
+  arg_parser = argparse.ArgumentParser(description = __doc__)
+  tasks = arg_parser.add_subparsers()
+
+  task = tasks.add_parser("indexes", help = "create database indexes")
+  task.set_defaults(func = indexes)
+
+  task = tasks.add_parser("columns", help = "store results columns")
+  task.add_argument("meet_ids", nargs = "*", help = "meets to store, or all")
+  task.set_defaults(func = columns)
+
+  task = tasks.add_parser("course-model", help = "refit the course model")
+  task.set_defaults(func = course_model)
+
+  task = tasks.add_parser("dedup", help = "merge duplicate runners and teams")
+  task.add_argument("--dry-run", action = "store_true",
+      help = "count the merges without making them")
+  task.set_defaults(func = dedup)
+
+  task = tasks.add_parser("migrate",
+      help = "store times as centiseconds and dates as datetimes")
+  task.add_argument("--batch", type = int, default = 500,
+      help = "meets to rebuild at a time")
+  task.set_defaults(func = migrate)
+
+  task = tasks.add_parser("import", help = "import result pages")
+  task.add_argument("meets", help = "file of meets to import, or -")
+  task.add_argument("--workers", type = int, default = 8)
+  task.add_argument("--per-host", type = int, default = 2)
+  task.add_argument("--retries", type = int, default = 2)
+  task.add_argument("--cache", help = "directory to cache pages in")
+  task.add_argument("--cache-max-age", type = float, default = 0,
+      help = "seconds to use cached pages without revalidating")
+  task.set_defaults(func = import_meets)
+
+  args = arg_parser.parse_args()
+  # Rebuilt meets store their columns and update the course model
+  hooks.register()
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
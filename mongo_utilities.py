@@ -1,57 +1,296 @@
 """Utilities for reading/writing
 to the mongodb
 """
+import base64
 import datetime
-from pymongo import MongoClient
+import json
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import identity_cache
+from identity_cache import TEAM_IDS, RUNNER_IDS
+import instrumentation
+import similarity
 
 DATE_FMT = "%Y-%m-%d"
+# Datetimes in page tokens
+TOKEN_DATE_FMT = "%Y-%m-%dT%H:%M:%S"
+# Number of races in the rolling average on runner histories
+ROLLING_RACES = 3
+# Default number of documents in a page of a listing
+PAGE_SIZE = 50
 
 CLIENT = MongoClient()
 DBNAME = "cross_tracker"
-DB = CLIENT[DBNAME]
+# Counts and times every collection call for instrumentation
+DB = instrumentation.CountingDatabase(CLIENT[DBNAME])
 
 TEAM_COLLECTION = "teams"
 MEET_COLLECTION = "meets"
 COURSE_COLLECTION = "courses"
 RESULT_COLLECTION = "results"
 RUNNER_COLLECTION = "runners"
+JOB_COLLECTION = "jobs"
+# One denormalized document of display rows per meet, keyed by meet_id
+MEET_RESULT_COLLECTION = "meet_results"
+# Packed arrays of times and ids per meet, keyed by meet_id
+MEET_COLUMN_COLLECTION = "meet_columns"
+# Course difficulty model, and each runner's counts and times by course
+COURSE_MODEL_COLLECTION = "course_model"
+RUNNER_COURSE_COLLECTION = "runner_courses"
+# Each runner's races in date order with bests, keyed by runner_id
+RUNNER_HISTORY_COLLECTION = "runner_history"
+# Possible duplicate runners and teams waiting for review
+MERGE_QUEUE_COLLECTION = "merge_queue"
+# Column layouts learned from result files, keyed by header fingerprint
+LAYOUT_COLLECTION = "layouts"
+# Counters shared between processes, keyed by name
+COUNTER_COLLECTION = "counters"
+# Bumped whenever stored runner or team identities change under the
+# identity caches
+IDENTITY_GENERATION = "identity_generation"
+# Seconds a process trusts its identity caches before checking the
+# generation again, outside of batches which always check it
+IDENTITY_SYNC_SECONDS = 5
+
+# Runners and teams are only merged, at ingestion or by manage.py
+# dedup, when their names are the same but for case, punctuation or
+# swapped first and last names.  Ones this alike are queued for review
+REVIEW_MERGE = 0.85
+
+# (keys, options) for every index we rely on, by collection.  The
+# runner index leads with team_id so it also serves roster lookups
+INDEXES = {
+    TEAM_COLLECTION: [
+      ([("alias", ASCENDING)], {"unique": True}),
+      ([("name", ASCENDING), ("_id", ASCENDING)], {}),
+      ([("block_keys", ASCENDING)], {}),
+      ],
+    MEET_COLLECTION: [
+      ([("date", DESCENDING), ("_id", DESCENDING)], {}),
+      ([("name", ASCENDING), ("date", ASCENDING)], {}),
+      ],
+    RUNNER_COLLECTION: [
+      ([("team_id", ASCENDING),
+        ("last_name", ASCENDING),
+        ("first_name", ASCENDING),
+        ("class_year", ASCENDING)], {"unique": True}),
+      ([("block_keys", ASCENDING)], {}),
+      ],
+    RESULT_COLLECTION: [
+      ([("meet_id", ASCENDING)], {}),
+      ([("runner_id", ASCENDING)], {}),
+      ([("team_id", ASCENDING)], {}),
+      ],
+    MEET_COLUMN_COLLECTION: [
+      ([("date", ASCENDING)], {}),
+      ],
+    MERGE_QUEUE_COLLECTION: [
+      ([("status", ASCENDING), ("score", DESCENDING)], {}),
+      ],
+    }
+
+# Functions called with the names of collections after they change
+WRITE_HOOKS = []
+
+def on_write(hook):
+  """Registers hook(*collections) to be called after writes
+  """
+  WRITE_HOOKS.append(hook)
+  return hook
+
+def notify(*collections):
+  """Tells the write hooks which collections changed
+  """
+  for hook in WRITE_HOOKS:
+    hook(*collections)
+
+# Functions called with the denormalized meet documents after
+# build_meet_results, for anything else derived from them
+BUILD_HOOKS = []
+
+def on_build(hook):
+  """Registers hook(*meet_docs) to be called after meet results
+  documents are rebuilt
+  """
+  BUILD_HOOKS.append(hook)
+  return hook
+
+def index_name(keys):
+  """Returns the default mongo name for an index on keys
+  """
+  return "_".join("%s_%s" % key for key in keys)
+
+def ensure_indexes():
+  """Creates any missing indexes.  Returns a dictionary of
+  collection -> {"created": [...], "existing": [...], "failed":
+  [(name, error), ...]}.  A unique index fails on a database that
+  already holds duplicates, which manage.py dedup merges
+  """
+  report = {}
+  for collection, indexes in INDEXES.iteritems():
+    existing = DB[collection].index_information()
+    report[collection] = {"created": [], "existing": [], "failed": []}
+    for keys, options in indexes:
+      name = index_name(keys)
+      if name in existing:
+        report[collection]["existing"].append(name)
+        continue
+      try:
+        DB[collection].create_index(keys, name = name, **options)
+      except OperationFailure as error:
+        report[collection]["failed"].append((name, str(error)))
+      else:
+        report[collection]["created"].append(name)
+  return report
+
+def time_to_centiseconds(time):
+  """Returns a parsed or stored finishing time in whole
+  centiseconds.  Times stored before they were numbers are
+  "H:M:S" strings
+  """
+  if isinstance(time, datetime.timedelta):
+    return int(round(time.total_seconds()*100))
+  if isinstance(time, basestring):
+    hours, minutes, seconds = time.split(":")
+    return int(round((int(hours)*3600 + int(minutes)*60 +
+      float(seconds))*100))
+  return int(time)
+
+def time_to_seconds(time):
+  """Returns a parsed or stored finishing time in seconds
+  """
+  if isinstance(time, datetime.timedelta):
+    return time.total_seconds()
+  return time_to_centiseconds(time)/100.
 
-def time_to_string(*results):
-  """Checks for a time field and changes it to 
-  a string
+def encode_times(*results):
+  """Changes any time field to centiseconds for storing
   """
   for result in results:
-    if 'time' in result:
-      result['time'] = str(result['time'])
+    if result.get("time") is not None:
+      result["time"] = time_to_centiseconds(result["time"])
 
-def string_to_time(*results):
-  """Checks for a time field and changes it to 
-  a time object
+def decode_times(*results):
+  """Changes any stored time field to a timedelta
   """
   for result in results:
-    if "time" in result:
-      time = result["time"].split(":")
+    if result.get("time") is not None:
       result["time"] = datetime.timedelta(
-          hours = int(time[0]),
-          minutes = int(time[1]),
-          seconds = float(time[2]))
+          milliseconds = 10*time_to_centiseconds(result["time"]))
 
-def date_to_string(*results):
-  """Checks for a date field and changes it to 
-  a string
+def to_datetime(date):
+  """Returns a date as the datetime it is stored as.  Dates stored
+  before they were datetimes are DATE_FMT strings
   """
-  for result in results:
-    if 'date' in result:
-      result['date'] = result['date'].strftime(DATE_FMT)
+  if isinstance(date, basestring):
+    return datetime.datetime.strptime(date, DATE_FMT)
+  if isinstance(date, datetime.datetime):
+    return date
+  return datetime.datetime(date.year, date.month, date.day)
 
-def string_to_date(*results):
-  """Checks for a date field and changes it to 
-  a date object
+def to_date(date):
+  """Returns a stored date as a date
   """
-  for result in results:
-    if "date" in result:
-      result['date'] = datetime.datetime.strptime(result['date'],
-          DATE_FMT).date()
+  if isinstance(date, basestring):
+    return datetime.datetime.strptime(date, DATE_FMT).date()
+  if isinstance(date, datetime.datetime):
+    return date.date()
+  return date
+
+def encode_dates(*docs):
+  """Changes any date field to a datetime for storing
+  """
+  for doc in docs:
+    if doc.get("date") is not None:
+      doc["date"] = to_datetime(doc["date"])
+
+def decode_dates(*docs):
+  """Changes any stored date field to a date
+  """
+  for doc in docs:
+    if doc.get("date") is not None:
+      doc["date"] = to_date(doc["date"])
+
+def decode_arrays(rows, fields = ("time", "place", "date")):
+  """Returns {field: numpy array} for rows such as a cursor of
+  results, without parsing each row: times in centiseconds, places
+  with -1 where missing and dates as datetime64 days
+  """
+  columns = dict((field, []) for field in fields)
+  for row in rows:
+    for field in fields:
+      columns[field].append(row.get(field))
+  arrays = {}
+  for field, values in columns.iteritems():
+    if field == "time":
+      try:
+        arrays[field] = np.array(values, dtype = np.int64)
+      except (TypeError, ValueError):
+        # times stored as strings before migrate_codecs
+        arrays[field] = np.array([time_to_centiseconds(value) for
+          value in values], dtype = np.int64)
+    elif field == "place":
+      arrays[field] = np.array([-1 if value is None else value for
+        value in values], dtype = np.int64)
+    elif field == "date":
+      # numpy reads both datetimes and DATE_FMT strings
+      arrays[field] = np.array(values, dtype = "datetime64[D]")
+    else:
+      arrays[field] = np.array(values, dtype = object)
+  return arrays
+
+# Paging utilities
+
+def encode_page_token(doc, fields):
+  """Returns an opaque token for the position of doc in a listing
+  sorted on fields, the last of which is _id
+  """
+  values = [{"$date": doc[field].strftime(TOKEN_DATE_FMT)} if
+      isinstance(doc[field], datetime.datetime) else doc[field] for
+      field in fields[:-1]] + [str(doc["_id"])]
+  return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_page_token(token):
+  """Returns the sort values stored in a page token, or None if
+  the token is missing or malformed
+  """
+  if not token:
+    return None
+  try:
+    values = [datetime.datetime.strptime(value["$date"], TOKEN_DATE_FMT) if
+        isinstance(value, dict) else value for
+        value in json.loads(base64.urlsafe_b64decode(str(token)))]
+    values[-1] = ObjectId(values[-1])
+  except Exception:
+    return None
+  return values
+
+def get_page(collection, sort, after = None, limit = PAGE_SIZE, query = None):
+  """Returns (documents, next_token) for one page of a collection,
+  ordered by sort, a list of (field, direction) ending with _id.
+  Pages are found by the sort values of the last document seen
+  rather than by skipping, so every page costs the same
+  """
+  query = dict(query or {})
+  values = decode_page_token(after)
+  if values:
+    # documents after the token: equal on the leading fields and
+    # past it on the next one
+    clauses = []
+    for j, (field, direction) in enumerate(sort):
+      clause = {f: v for (f, _), v in zip(sort[:j], values[:j])}
+      clause[field] = {"$gt" if direction == ASCENDING else "$lt": values[j]}
+      clauses.append(clause)
+    query["$or"] = clauses
+  docs = [d for d in DB[collection].find(query).sort(sort).limit(limit + 1)]
+  next_token = None
+  if len(docs) > limit:
+    docs = docs[:limit]
+    next_token = encode_page_token(docs[-1], [field for field, _ in sort])
+  return docs, next_token
 
 # Result utilities
 
@@ -60,9 +299,44 @@ def add_result(**kwargs):
   """
   if 'team' in kwargs:
     create_team(kwargs['team'])
-  date_to_string(kwargs)
-  time_to_string(kwargs)
-  return DB[RESULT_COLLECTION].insert(kwargs)
+  encode_dates(kwargs)
+  encode_times(kwargs)
+  result_id = DB[RESULT_COLLECTION].insert(kwargs)
+  notify(RESULT_COLLECTION)
+  return result_id
+
+@instrumentation.timed()
+def add_results(*results):
+  """Creates many results with a single batch insert.  Returns
+  a list of the new ids
+  """
+  results = [dict(result) for result in results]
+  if not results:
+    return []
+  encode_dates(*results)
+  encode_times(*results)
+  result_ids = DB[RESULT_COLLECTION].insert(results)
+  notify(RESULT_COLLECTION)
+  return result_ids
+
+def get_result_lines(meet_id):
+  """Returns [(result_id, raw_data)] for a meet's stored results
+  """
+  return [(result["_id"], result["raw_data"]) for result in
+      DB[RESULT_COLLECTION].find({"meet_id": meet_id}, ["raw_data"])]
+
+def remove_results(*result_ids):
+  """Removes results.  Returns the ids of their runners
+  """
+  result_ids = list(result_ids)
+  if not result_ids:
+    return []
+  runner_ids = list(set(result["runner_id"] for result in
+      DB[RESULT_COLLECTION].find({"_id": {"$in": result_ids}},
+        ["runner_id"])))
+  DB[RESULT_COLLECTION].remove({"_id": {"$in": result_ids}})
+  notify(RESULT_COLLECTION)
+  return runner_ids
 
 def get_results(**kwargs):
   """Returns a list of all results
@@ -72,32 +346,189 @@ def get_results(**kwargs):
   else:
     results = DB[RESULT_COLLECTION].find()
   results = [r for r in results]
-  string_to_date(*results)
-  string_to_time(*results)
+  decode_dates(*results)
+  decode_times(*results)
   return results
 
-def get_meet_results(meet_id):
-  """Return results for a particular meet
+def get_result_arrays(fields = ("time", "place", "date"), **kwargs):
+  """Returns {field: numpy array} for the results matching kwargs,
+  decoded in one batch by decode_arrays
+  """
+  return decode_arrays(DB[RESULT_COLLECTION].find(kwargs, list(fields)),
+      fields)
+
+@instrumentation.timed()
+def build_meet_results(*meet_ids):
+  """Rebuilds the denormalized results documents for meets, with
+  one query per collection however many meets there are
   """
-  results = [r for r in DB[RESULT_COLLECTION].find({'meet_id': meet_id})]
-  runners = {r['_id']: r for r in 
+  meet_ids = list(set(meet_ids))
+  if not meet_ids:
+    return
+  results = [r for r in DB[RESULT_COLLECTION].find(
+    {'meet_id': {'$in': meet_ids}})]
+  runners = {r['_id']: r for r in
       DB[RUNNER_COLLECTION].find(
         {'_id': {'$in':
-          [result['runner_id'] for result in results]}})}
-  teams = {t['_id']: t for t in 
+          list(set(result['runner_id'] for result in results))}})}
+  teams = {t['_id']: t for t in
       DB[TEAM_COLLECTION].find(
         {'_id': {'$in':
-          [result['team_id'] for result in results]}})}
-  results = [r for r in results]
+          list(set(result['team_id'] for result in results))}})}
+  meets = {m['_id']: {
+    '_id': m['_id'],
+    'name': m['name'],
+    'date': to_datetime(m['date']) if m.get('date') else None,
+    'course_id': m.get('course_id'),
+    'results': []} for m in
+    DB[MEET_COLLECTION].find({'_id': {'$in': meet_ids}})}
   for r in results:
-    r['team'] = teams[r['team_id']]['name']
-    r['runner'] = runners[r['runner_id']]['display_name']
-    r['class'] = runners[r['runner_id']]['class_year']
-  string_to_date(*results)
-  return results
+    runner = runners.get(r['runner_id'], {})
+    meets[r['meet_id']]['results'].append({
+      'place': r.get('place'),
+      'runner_id': r['runner_id'],
+      'runner': runner.get('display_name'),
+      'class': runner.get('class_year'),
+      'team_id': r['team_id'],
+      'team': teams.get(r['team_id'], {}).get('name'),
+      'time': r['time']})
+  for meet in meets.itervalues():
+    meet['results'].sort(key = lambda row: (row['place'] is None, row['place']))
+  DB[MEET_RESULT_COLLECTION].remove({'_id': {'$in': meet_ids}})
+  if meets:
+    DB[MEET_RESULT_COLLECTION].insert(meets.values())
+  for hook in BUILD_HOOKS:
+    hook(*meets.values())
+  notify(MEET_RESULT_COLLECTION)
+  build_runner_history(*runners.keys())
+
+def build_runner_history(*runner_ids):
+  """Rebuilds the history documents of runners, with one query per
+  collection however many runners there are
+  """
+  runner_ids = list(set(runner_ids))
+  if not runner_ids:
+    return
+  results = [r for r in DB[RESULT_COLLECTION].find(
+    {'runner_id': {'$in': runner_ids}},
+    ['runner_id', 'meet_id', 'time', 'place'])]
+  meets = {m['_id']: m for m in
+      DB[MEET_COLLECTION].find(
+        {'_id': {'$in': list(set(r['meet_id'] for r in results))}})}
+  runners = {r['_id']: r for r in
+      DB[RUNNER_COLLECTION].find({'_id': {'$in': runner_ids}})}
+  teams = {t['_id']: t for t in
+      DB[TEAM_COLLECTION].find(
+        {'_id': {'$in': list(set(r.get('team_id') for r in
+          runners.itervalues()))}})}
+  races = dict((runner_id, []) for runner_id in runners)
+  for r in results:
+    meet = meets.get(r['meet_id'])
+    if meet is None or r['runner_id'] not in races:
+      continue
+    races[r['runner_id']].append({
+      'date': to_datetime(meet['date']) if meet.get('date') else None,
+      'meet_id': meet['_id'],
+      'meet': meet['name'],
+      'course_id': meet.get('course_id'),
+      'seconds': time_to_seconds(r['time']),
+      'place': r.get('place')})
+  histories = []
+  for runner_id, runner_races in races.iteritems():
+    runner = runners[runner_id]
+    runner_races.sort(key = lambda race: (race['date'], race['meet_id']))
+    bests = {}
+    for j, race in enumerate(runner_races):
+      recent = runner_races[max(0, j - ROLLING_RACES + 1):j + 1]
+      race['rolling'] = sum(r['seconds'] for r in recent)/len(recent)
+      season = str(race['date'].year) if race['date'] else ''
+      if season not in bests or race['seconds'] < bests[season]:
+        bests[season] = race['seconds']
+    histories.append({
+      '_id': runner_id,
+      'name': runner.get('display_name'),
+      'class': runner.get('class_year'),
+      'team_id': runner.get('team_id'),
+      'team': teams.get(runner.get('team_id'), {}).get('name'),
+      'races': runner_races,
+      'season_bests': [{'season': season, 'seconds': seconds} for
+        season, seconds in sorted(bests.items())],
+      'best': min(bests.values()) if bests else None})
+  DB[RUNNER_HISTORY_COLLECTION].remove({'_id': {'$in': runner_ids}})
+  if histories:
+    DB[RUNNER_HISTORY_COLLECTION].insert(histories)
+  notify(RUNNER_HISTORY_COLLECTION)
+
+def get_runner_history(runner_id):
+  """Returns a runner's history document, or None if there is no
+  such runner
+  """
+  history = DB[RUNNER_HISTORY_COLLECTION].find_one({'_id': runner_id})
+  if history is None:
+    build_runner_history(runner_id)
+    history = DB[RUNNER_HISTORY_COLLECTION].find_one({'_id': runner_id})
+  return history
+
+def rebuild_meet_results(**query):
+  """Rebuilds the results documents of every meet with a result
+  matching query
+  """
+  build_meet_results(*[r['meet_id'] for r in
+    DB[RESULT_COLLECTION].find(query, ['meet_id'])])
+
+def get_results_page(after = None, limit = PAGE_SIZE, **kwargs):
+  """Returns (results, next_token) for a page of results matching
+  kwargs, in the order they were added
+  """
+  results, next_token = get_page(RESULT_COLLECTION,
+      [("_id", ASCENDING)], after, limit, kwargs)
+  decode_dates(*results)
+  decode_times(*results)
+  return results, next_token
+
+@instrumentation.timed()
+def get_meet_results(meet_id):
+  """Return results for a particular meet
+  """
+  meet = DB[MEET_RESULT_COLLECTION].find_one({'_id': meet_id})
+  if meet is None:
+    build_meet_results(meet_id)
+    meet = DB[MEET_RESULT_COLLECTION].find_one({'_id': meet_id})
+    if meet is None:
+      return []
+  decode_dates(meet)
+  for row in meet['results']:
+    row['meet_id'] = meet_id
+    row['date'] = meet['date']
+  return meet['results']
+
+# Identity cache utilities
+
+def bump_identity_generation():
+  """Tells every process that cached runner and team ids may be stale
+  """
+  DB[COUNTER_COLLECTION].update({"_id": IDENTITY_GENERATION},
+      {"$inc": {"value": 1}}, upsert = True)
+
+def sync_identity_caches(max_age = IDENTITY_SYNC_SECONDS):
+  """Empties the identity caches if another process has merged
+  runners or teams since they were filled.  The stored generation is
+  only read if it was not read in the last max_age seconds, so cache
+  hits do not go to the database
+  """
+  if identity_cache.synced_within(max_age):
+    return
+  counter = DB[COUNTER_COLLECTION].find_one({"_id": IDENTITY_GENERATION})
+  identity_cache.sync(counter["value"] if counter else 0)
 
 # Runner utilities
 
+def runner_key(runner):
+  """Returns the identity cache key for a runner document
+  """
+  return (runner["first_name"], runner["last_name"],
+      runner["team_id"], runner.get("class_year"))
+
 def create_runner(first_name, last_name, team, class_year):
   """Creates a new runner
   """
@@ -109,21 +540,183 @@ def create_runner(first_name, last_name, team, class_year):
       "team_id" : create_team(team),
       "class_year" : class_year
       }
+  key = runner_key(runner)
+  runner_id = RUNNER_IDS.get(key)
+  if runner_id:
+    return runner_id
   exists = get_runner(runner)
   if exists:
-    return exists['_id']
-  return DB[RUNNER_COLLECTION].insert(runner)
+    runner_id = exists['_id']
+  else:
+    match_id, score, same = match_runners([key]).get(key,
+        (None, 0., False))
+    if same:
+      runner_id = match_id
+    else:
+      runner["block_keys"] = similarity.runner_block_keys(
+          runner["first_name"], runner["last_name"], runner["team_id"])
+      runner_id = DB[RUNNER_COLLECTION].insert(runner)
+      notify(RUNNER_COLLECTION)
+      if score >= REVIEW_MERGE:
+        queue_merge(RUNNER_COLLECTION, match_id, runner_id, score)
+  RUNNER_IDS.put(key, runner_id)
+  return runner_id
+
+@instrumentation.timed()
+def create_runners(runners):
+  """Creates many runners at once.  runners is a list of
+  (first_name, last_name, team, class_year) tuples.  Teams and
+  runners are resolved with one query each, and the missing ones
+  are inserted in one batch, so the number of round trips does
+  not depend on the number of runners.  Returns a list of
+  (runner_id, team_id) tuples in the same order
+  """
+  team_ids = create_teams(*[runner[2] for runner in runners])
+  keys = [(first_name.title(), last_name.title(),
+    team_ids[team.lower()], class_year) for
+    first_name, last_name, team, class_year in runners]
+
+  found = {}
+  for key in keys:
+    runner_id = RUNNER_IDS.get(key)
+    if runner_id:
+      found[key] = runner_id
+  lookup = [key for key in keys if key not in found]
+  if lookup:
+    existing = DB[RUNNER_COLLECTION].find({
+      "team_id": {"$in": list(set(key[2] for key in lookup))},
+      "last_name": {"$in": list(set(key[1] for key in lookup))}})
+    for runner in existing:
+      found[runner_key(runner)] = runner["_id"]
+      RUNNER_IDS.put(runner_key(runner), runner["_id"])
+
+  missing = []
+  for key in keys:
+    if key not in found:
+      found[key] = None
+      missing.append(key)
+  matches = match_runners(missing) if missing else {}
+  # Two runners in the same batch are never the same person
+  taken = set(found[key] for key in keys) - set([None])
+  for key in missing:
+    match_id, score, same = matches.get(key, (None, 0., False))
+    if same and match_id not in taken:
+      found[key] = match_id
+      taken.add(match_id)
+      RUNNER_IDS.put(key, match_id)
+  missing = [key for key in missing if found[key] is None]
+  if missing:
+    new_ids = insert_new(RUNNER_COLLECTION, [{
+      "first_name" : first_name,
+      "last_name" : last_name,
+      "display_name" : "%s %s" % (first_name, last_name),
+      "team_id" : team_id,
+      "class_year" : class_year,
+      "block_keys" : similarity.runner_block_keys(first_name, last_name,
+        team_id)} for
+      first_name, last_name, team_id, class_year in missing],
+      lambda runner: {"team_id": runner["team_id"],
+        "last_name": runner["last_name"],
+        "first_name": runner["first_name"],
+        "class_year": runner["class_year"]})
+    found.update(zip(missing, new_ids))
+    for key, runner_id in zip(missing, new_ids):
+      RUNNER_IDS.put(key, runner_id)
+      match_id, score, _ = matches.get(key, (None, 0., False))
+      if score >= REVIEW_MERGE:
+        queue_merge(RUNNER_COLLECTION, match_id, runner_id, score)
+    notify(RUNNER_COLLECTION)
+  return [(found[key], key[2]) for key in keys]
+
+def insert_new(collection, docs, query):
+  """Inserts docs in one batch and returns their ids.  Another worker
+  can insert the same runner or team between our lookup and this
+  insert, so if the unique index turns one away, each doc is looked
+  up with query(doc) and the ones not found are inserted again
+  """
+  try:
+    return DB[collection].insert(docs, continue_on_error = True)
+  except DuplicateKeyError:
+    ids = []
+    for doc in docs:
+      stored = DB[collection].find_one(query(doc), ["_id"])
+      ids.append(stored["_id"] if stored else
+          insert_new(collection, [doc], query)[0])
+    return ids
+
+def match_runners(keys):
+  """Finds the most alike existing runner on the same team for each
+  runner key, looking candidates up through the blocking index.
+  Returns {key: (runner_id, score, same)} for keys with any
+  candidates, same telling whether the runner is the same but for
+  spelling, and preferred over more alike ones that are not
+  """
+  blocks = dict((key, similarity.runner_block_keys(key[0], key[1], key[2]))
+      for key in keys)
+  candidates = {}
+  for runner in DB[RUNNER_COLLECTION].find(
+      {"block_keys": {"$in": list(set(block for key_blocks in
+        blocks.itervalues() for block in key_blocks))}},
+      ["first_name", "last_name", "class_year", "block_keys"]):
+    for block in runner["block_keys"]:
+      candidates.setdefault(block, []).append(runner)
+  matches = {}
+  for key, key_blocks in blocks.iteritems():
+    for block in key_blocks:
+      for runner in candidates.get(block, []):
+        stored = (runner["first_name"], runner["last_name"],
+            runner.get("class_year"))
+        score = similarity.runner_similarity((key[0], key[1], key[3]),
+            stored)
+        same = similarity.same_runner((key[0], key[1], key[3]), stored)
+        best = matches.get(key)
+        if best is None or (same, score) > (best[2], best[1]):
+          matches[key] = (runner["_id"], score, same)
+  return matches
 
 def get_runner(kwargs):
   """Gets runner if it exists
   """
   return DB[RUNNER_COLLECTION].find_one(kwargs)
 
-def get_runners():
-  """Returns a list of all runners
+def get_runners(runner_ids = None):
+  """Returns a list of all runners, or of those with the given ids
   """
+  if runner_ids is not None:
+    return DB[RUNNER_COLLECTION].find({"_id": {"$in": list(runner_ids)}})
   return DB[RUNNER_COLLECTION].find()
 
+def update_runner(runner_id, **kwargs):
+  """Sets fields on a runner
+  """
+  runner = DB[RUNNER_COLLECTION].find_one({"_id": runner_id})
+  if runner:
+    RUNNER_IDS.discard(runner_key(runner))
+    runner.update(kwargs)
+    kwargs["block_keys"] = similarity.runner_block_keys(
+        runner["first_name"], runner["last_name"], runner["team_id"])
+  DB[RUNNER_COLLECTION].update({"_id": runner_id}, {"$set": kwargs})
+  bump_identity_generation()
+  notify(RUNNER_COLLECTION)
+  rebuild_meet_results(runner_id = runner_id)
+
+def merge_runners(keep_id, drop_id, rebuild = True):
+  """Moves all results from one runner to another and
+  removes the duplicate runner
+  """
+  DB[RESULT_COLLECTION].update({"runner_id": drop_id},
+      {"$set": {"runner_id": keep_id}}, multi = True)
+  DB[RUNNER_COLLECTION].remove({"_id": drop_id})
+  DB[RUNNER_HISTORY_COLLECTION].remove({"_id": drop_id})
+  DB[MERGE_QUEUE_COLLECTION].remove({"$or": [
+    {"keep_id": drop_id}, {"drop_id": drop_id}]})
+  RUNNER_IDS.discard_where(lambda key, value: value == drop_id)
+  bump_identity_generation()
+  notify(RUNNER_COLLECTION, RESULT_COLLECTION)
+  if rebuild:
+    rebuild_meet_results(runner_id = keep_id)
+  return keep_id
+
 
 # Team utilities
 
@@ -131,11 +724,110 @@ def create_team(team_name, **kwargs):
   """Creates a new team
   """
   kwargs["name"] = team_name.title()
+  sync_identity_caches()
+  team_id = TEAM_IDS.get(team_name.lower())
+  if team_id:
+    return team_id
   exists = get_team(team_name)
   if exists:
-    return exists['_id']
-  kwargs["alias"] = [team_name.lower()]
-  return DB[TEAM_COLLECTION].insert(kwargs)
+    team_id = exists['_id']
+  else:
+    match_id, score, same = match_teams([team_name]).get(team_name,
+        (None, 0., False))
+    if same:
+      team_id = match_id
+      add_team_aliases(team_id, team_name)
+    else:
+      kwargs["alias"] = [team_name.lower()]
+      kwargs["block_keys"] = similarity.team_block_keys(team_name)
+      team_id = DB[TEAM_COLLECTION].insert(kwargs)
+      if score >= REVIEW_MERGE:
+        queue_merge(TEAM_COLLECTION, match_id, team_id, score)
+    notify(TEAM_COLLECTION)
+  TEAM_IDS.put(team_name.lower(), team_id)
+  return team_id
+
+def create_teams(*team_names):
+  """Creates many teams at once, with one query for the teams
+  that already exist and one batch insert for the rest.  Returns
+  a dictionary of lowercase alias -> team_id
+  """
+  sync_identity_caches(0)
+  aliases = {}
+  for team_name in team_names:
+    aliases.setdefault(team_name.lower(), team_name)
+  found = {}
+  for alias in aliases:
+    team_id = TEAM_IDS.get(alias)
+    if team_id:
+      found[alias] = team_id
+  lookup = [alias for alias in aliases if alias not in found]
+  if lookup:
+    for team in DB[TEAM_COLLECTION].find({"alias": {"$in": lookup}}):
+      for alias in team["alias"]:
+        TEAM_IDS.put(alias, team["_id"])
+        if alias in aliases:
+          found[alias] = team["_id"]
+  missing = [alias for alias in aliases if alias not in found]
+  matches = match_teams(missing) if missing else {}
+  for alias in missing:
+    match_id, score, same = matches.get(alias, (None, 0., False))
+    if same:
+      found[alias] = match_id
+      TEAM_IDS.put(alias, match_id)
+      add_team_aliases(match_id, alias)
+  missing = [alias for alias in missing if alias not in found]
+  if missing:
+    new_ids = insert_new(TEAM_COLLECTION, [{
+      "name": aliases[alias].title(),
+      "alias": [alias],
+      "block_keys": similarity.team_block_keys(alias)} for
+      alias in missing], lambda team: {"alias": team["alias"][0]})
+    found.update(zip(missing, new_ids))
+    for alias, team_id in zip(missing, new_ids):
+      TEAM_IDS.put(alias, team_id)
+      match_id, score, _ = matches.get(alias, (None, 0., False))
+      if score >= REVIEW_MERGE:
+        queue_merge(TEAM_COLLECTION, match_id, team_id, score)
+  if matches or missing:
+    notify(TEAM_COLLECTION)
+  return found
+
+def match_teams(team_names):
+  """Finds the most alike existing team for each name, looking
+  candidates up through the blocking index.  Returns {team_name:
+  (team_id, score, same)} for names with any candidates, same telling
+  whether one of the team's names is the same but for spelling
+  """
+  blocks = dict((name, similarity.team_block_keys(name)) for
+      name in team_names)
+  candidates = {}
+  for team in DB[TEAM_COLLECTION].find(
+      {"block_keys": {"$in": list(set(block for name_blocks in
+        blocks.itervalues() for block in name_blocks))}},
+      ["alias", "block_keys"]):
+    for block in team["block_keys"]:
+      candidates.setdefault(block, []).append(team)
+  matches = {}
+  for name, name_blocks in blocks.iteritems():
+    for block in name_blocks:
+      for team in candidates.get(block, []):
+        score = max(similarity.team_similarity(name, alias) for
+            alias in team["alias"])
+        same = any(similarity.same_team(name, alias) for
+            alias in team["alias"])
+        best = matches.get(name)
+        if best is None or (same, score) > (best[2], best[1]):
+          matches[name] = (team["_id"], score, same)
+  return matches
+
+def add_team_aliases(team_id, *team_names):
+  """Adds other names a team goes by
+  """
+  DB[TEAM_COLLECTION].update({"_id": team_id}, {"$addToSet": {
+    "alias": {"$each": [name.lower() for name in team_names]},
+    "block_keys": {"$each": list(set(block for name in team_names for
+      block in similarity.team_block_keys(name)))}}})
 
 def get_team(team_name):
   """Gets team if it exists
@@ -147,6 +839,55 @@ def get_teams():
   """
   return DB[TEAM_COLLECTION].find()
 
+def merge_teams(keep_id, drop_id):
+  """Folds one team into another: its aliases, runners and
+  results all move to the team that is kept
+  """
+  drop = DB[TEAM_COLLECTION].find_one({"_id": drop_id})
+  for runner in DB[RUNNER_COLLECTION].find({"team_id": drop_id}):
+    moved = dict(runner, team_id = keep_id)
+    exists = DB[RUNNER_COLLECTION].find_one({
+      "team_id": keep_id,
+      "first_name": runner["first_name"],
+      "last_name": runner["last_name"],
+      "class_year": runner.get("class_year")})
+    if exists:
+      merge_runners(exists["_id"], runner["_id"], rebuild = False)
+    else:
+      DB[RUNNER_COLLECTION].update({"_id": runner["_id"]},
+          {"$set": {"team_id": keep_id,
+            "block_keys": similarity.runner_block_keys(runner["first_name"],
+              runner["last_name"], keep_id)}})
+      RUNNER_IDS.discard(runner_key(runner))
+      RUNNER_IDS.put(runner_key(moved), runner["_id"])
+  DB[RESULT_COLLECTION].update({"team_id": drop_id},
+      {"$set": {"team_id": keep_id}}, multi = True)
+  DB[TEAM_COLLECTION].remove({"_id": drop_id})
+  DB[MERGE_QUEUE_COLLECTION].remove({"$or": [
+    {"keep_id": drop_id}, {"drop_id": drop_id}]})
+  if drop:
+    add_team_aliases(keep_id, *drop["alias"])
+  TEAM_IDS.discard_where(lambda key, value: value == drop_id)
+  bump_identity_generation()
+  notify(TEAM_COLLECTION, RUNNER_COLLECTION, RESULT_COLLECTION)
+  rebuild_meet_results(team_id = keep_id)
+  return keep_id
+
+def update_team(team_id, **kwargs):
+  """Sets fields on a team
+  """
+  DB[TEAM_COLLECTION].update({"_id": team_id}, {"$set": kwargs})
+  if "alias" in kwargs:
+    bump_identity_generation()
+  notify(TEAM_COLLECTION)
+  rebuild_meet_results(team_id = team_id)
+
+def get_teams_page(after = None, limit = PAGE_SIZE):
+  """Returns (teams, next_token) for a page of teams by name
+  """
+  return get_page(TEAM_COLLECTION,
+      [("name", ASCENDING), ("_id", ASCENDING)], after, limit)
+
 def get_team_info(team_id):
   """Returns all info associated with a team
   """
@@ -161,26 +902,181 @@ def create_meet(meet_name, **kwargs):
   """
   kwargs["name"] = meet_name
 
-  date_to_string(kwargs)
-  return DB[MEET_COLLECTION].insert(kwargs)
+  encode_dates(kwargs)
+  meet_id = DB[MEET_COLLECTION].insert(kwargs)
+  notify(MEET_COLLECTION)
+  return meet_id
+
+def find_meets(names, date):
+  """Returns the meets held on date with any of names, oldest first
+  """
+  meets = [meet for meet in DB[MEET_COLLECTION].find({
+    "name": {"$in": list(names)},
+    # matches meets stored before migrate_codecs too
+    "date": {"$in": [to_datetime(date), date.strftime(DATE_FMT)]}}).sort(
+      "_id", ASCENDING)]
+  decode_dates(*meets)
+  return meets
+
+def update_meet(meet_id, **kwargs):
+  """Sets fields on a meet
+  """
+  encode_dates(kwargs)
+  DB[MEET_COLLECTION].update({"_id": meet_id}, {"$set": kwargs})
+  notify(MEET_COLLECTION)
 
 def get_meets():
   """Returns a list of all meets
   """
   meets =  [m for m in DB[MEET_COLLECTION].find()]
-  string_to_date(*meets)
+  decode_dates(*meets)
   return meets
 
+def get_meets_page(after = None, limit = PAGE_SIZE):
+  """Returns (meets, next_token) for a page of meets, newest first
+  """
+  meets, next_token = get_page(MEET_COLLECTION,
+      [("date", DESCENDING), ("_id", DESCENDING)], after, limit)
+  decode_dates(*meets)
+  return meets, next_token
+
 # Course utilities
 
 def create_course(course_name, **kwargs):
   """Creates a new course
   """
   kwargs["name"] = course_name
-  return DB[COURSE_COLLECTION].insert(kwargs)
+  course_id = DB[COURSE_COLLECTION].insert(kwargs)
+  notify(COURSE_COLLECTION)
+  return course_id
+
+def get_course_id(course_name, distance = None):
+  """Returns the id of a course, creating it if it is new
+  """
+  course = DB[COURSE_COLLECTION].find_one(
+      {"name": course_name, "distance": distance}, ["_id"])
+  if course:
+    return course["_id"]
+  return create_course(course_name, distance = distance)
 
 def get_courses():
   """Returns a list of all courses
   """
   return DB[COURSE_COLLECTION].find()
 
+# Duplicate review utilities
+
+def queue_merge(collection, keep_id, drop_id, score):
+  """Queues two runners or teams that may be the same for review
+  """
+  DB[MERGE_QUEUE_COLLECTION].insert({
+    "collection": collection,
+    "keep_id": keep_id,
+    "drop_id": drop_id,
+    "score": score,
+    "status": "pending"})
+  notify(MERGE_QUEUE_COLLECTION)
+
+def get_merge_queue(limit = PAGE_SIZE):
+  """Returns the pending merges, most alike first
+  """
+  return DB[MERGE_QUEUE_COLLECTION].find({"status": "pending"}).sort(
+      "score", DESCENDING).limit(limit)
+
+def resolve_merge(merge_id, accept):
+  """Merges a queued pair, or marks it as two different runners or
+  teams so it is not queued again
+  """
+  merge = DB[MERGE_QUEUE_COLLECTION].find_one({"_id": merge_id})
+  if merge is None:
+    return
+  if accept:
+    if merge["collection"] == TEAM_COLLECTION:
+      merge_teams(merge["keep_id"], merge["drop_id"])
+    else:
+      merge_runners(merge["keep_id"], merge["drop_id"])
+  else:
+    DB[MERGE_QUEUE_COLLECTION].update({"_id": merge_id},
+        {"$set": {"status": "rejected"}})
+  notify(MERGE_QUEUE_COLLECTION)
+
+# Ingestion job utilities
+
+def set_ingestion_report(meet_ids, report):
+  """Records how long ingesting meets took, and where, on the meet
+  documents
+  """
+  DB[MEET_COLLECTION].update({"_id": {"$in": list(meet_ids)}},
+      {"$set": {"ingestion": report}}, multi = True)
+  notify(MEET_COLLECTION)
+
+def create_job(**kwargs):
+  """Creates a new ingestion job
+  """
+  kwargs.setdefault("status", "queued")
+  kwargs["created"] = datetime.datetime.utcnow()
+  encode_dates(kwargs)
+  return DB[JOB_COLLECTION].insert(kwargs)
+
+def update_job(job_id, **kwargs):
+  """Sets fields on an ingestion job
+  """
+  kwargs["updated"] = datetime.datetime.utcnow()
+  DB[JOB_COLLECTION].update({"_id": job_id}, {"$set": kwargs})
+
+def claim_job(job_id):
+  """Marks a queued job running and returns it, or returns None if
+  another worker has already taken it
+  """
+  job = DB[JOB_COLLECTION].find_and_modify(
+      {"_id": job_id, "status": "queued"},
+      {"$set": {"status": "running",
+        "updated": datetime.datetime.utcnow()}},
+      new = True)
+  if job:
+    decode_dates(job)
+  return job
+
+def get_unfinished_jobs():
+  """Returns the jobs still queued or running
+  """
+  jobs = list(DB[JOB_COLLECTION].find(
+    {"status": {"$in": ["queued", "running"]}}).sort("created", ASCENDING))
+  decode_dates(*jobs)
+  return jobs
+
+def get_job(job_id):
+  """Returns an ingestion job, or None
+  """
+  job = DB[JOB_COLLECTION].find_one({"_id": job_id})
+  if job:
+    decode_dates(job)
+  return job
+
+# Migrations
+
+def migrate_codecs(batch = 500):
+  """Converts times and dates stored as strings to centiseconds and
+  datetimes, then rebuilds the meet results and runner histories
+  from them, batch meets at a time.  Returns {collection: number of
+  documents converted}
+  """
+  converted = {}
+  for collection in (RESULT_COLLECTION, MEET_COLLECTION, JOB_COLLECTION):
+    count = 0
+    for doc in DB[collection].find({}, ["date", "time"]):
+      changes = {}
+      if isinstance(doc.get("date"), basestring):
+        changes["date"] = to_datetime(doc["date"])
+      if isinstance(doc.get("time"), basestring):
+        changes["time"] = time_to_centiseconds(doc["time"])
+      if changes:
+        DB[collection].update({"_id": doc["_id"]}, {"$set": changes})
+        count += 1
+    converted[collection] = count
+    notify(collection)
+  meet_ids = [meet["_id"] for meet in DB[MEET_COLLECTION].find({}, ["_id"])]
+  for start in range(0, len(meet_ids), batch):
+    build_meet_results(*meet_ids[start:start + batch])
+  return converted
+
@@ -1,13 +1,45 @@
 """Module for reading and handling result files
 """
 import datetime
+import hashlib
+import itertools
+import multiprocessing
 import re
+import tempfile
 import requests
-from collections import Counter
-from bs4 import BeautifulSoup
+from collections import Counter, deque
+from HTMLParser import HTMLParser, HTMLParseError
+import fixed_width
+import instrumentation
+import layout
 import mongo_utilities
 
 ALLOWED_EXTENSIONS = set(["txt"])
+# Number of consecutive places that marks the start of the results
+RUN_LENGTH = 14
+# Number of result lines used to guess which field holds the name
+NAME_SAMPLE = 500
+# Seconds to wait on a results page
+FETCH_TIMEOUT = 30
+# Bytes of a results page to read at a time
+FETCH_CHUNK = 16384
+# Result lines MeetParser gathers before parsing and saving a batch of
+# races, so memory does not grow with the size of a file
+BATCH_LINES = 5000
+
+TIME_PATTERN = re.compile(r"([0-9]{1,2})?(?::)([0-9]{1,2})(.[0-9]{1,2})?")
+PLACE_PATTERN = re.compile(r"^(\d+)(?:\.)?(?<=$)")
+# A whole whitespace separated field with a time in it
+TIME_FIELD_PATTERN = re.compile(r"(?<!\S)\S*:[0-9]\S*")
+SPACES_PATTERN = re.compile(r"\s{2,}")
+WORD_PATTERN = re.compile(r"[a-z',-. ()-]+$")
+# Words of the line naming a results table's columns, which is not
+# taken as the title of a race
+COLUMN_WORDS = set(["pl", "place", "name", "yr", "year", "team", "school",
+  "time", "pace", "points", "bib"])
+# Titles of team score tables, whose places are not runners'
+TEAM_SCORES_PATTERN = re.compile(r"\bteam (scores|results|standings)\b")
+
 def allowed_file(filename):
   """Makes sure file is in the allowed list
   """
@@ -20,14 +52,325 @@ def find_all(regex, string):
   """
   return [m.start() for m in re.finditer(regex, string)]
 
+def clean_lines(lines, tokenize):
+  """Yields the lowercased result lines from an iterable of lines,
+  dropping empty lines and any headers/footers.  Results start
+  at the first run of RUN_LENGTH consecutive places, so only the
+  lines just before a run are held in memory.  tokenize is called
+  with each lowercased line and returns its LineTokens
+  """
+  recent = deque(maxlen = RUN_LENGTH - 1)
+  counter = 1
+  beginning_found = False
+  for line in lines:
+    line = line.lower()
+    tokens = tokenize(line)
+    if not (tokens.has_time and
+        tokens.place is not None and
+        any(c.isalpha() for c in line)):
+      continue
+    if counter == tokens.place:
+      counter += 1
+      if counter > RUN_LENGTH:
+        if not beginning_found:
+          beginning_found = True
+          for previous in recent:
+            yield previous
+        yield line
+    elif not beginning_found:
+      counter = 1
+    if not beginning_found:
+      recent.append(line)
+
+def is_column_heading(line):
+  """Checks whether a line names the columns of a results table,
+  such as "place name yr team time"
+  """
+  return sum(word in COLUMN_WORDS for word in
+      re.findall(r"[a-z]+", line)) >= 2
+
+def is_team_scores(title):
+  """Checks whether a race title heads a table of team scores
+  """
+  return bool(title and TEAM_SCORES_PATTERN.search(title))
+
+def is_rule(line):
+  """Checks whether a line is a rule of = or - under column headings
+  """
+  return bool(line.strip()) and not line.strip(" =-")
+
+def split_races(lines, tokenize):
+  """Yields (title, header, result lines) for every race in an
+  iterable of lowercased lines.  A race is a run of at least
+  RUN_LENGTH consecutive places, and a place of 1 starts a new one,
+  so files with several races keep all of them.  The title is the
+  last line of text before the race that is not a column heading,
+  or None if there is none since the race before, and the header is
+  the column headings and rules after it, with their spacing.
+  tokenize is called with each line and returns its LineTokens
+  """
+  title = None
+  header = []
+  race_title = None
+  race_header = []
+  race = []
+  found = False
+  for line in lines:
+    line = line.lower()
+    tokens = tokenize(line)
+    if not (tokens.has_time and
+        tokens.place is not None and
+        any(c.isalpha() for c in line)):
+      text = line.strip()
+      if is_column_heading(text) or is_rule(text):
+        header.append(line.rstrip())
+      elif any(c.isalpha() for c in text):
+        title = text
+        header = []
+      continue
+    if tokens.place == 1:
+      if found and not is_team_scores(race_title):
+        yield race_title, race_header, race
+      race_title = title
+      race_header = header
+      title = None
+      header = []
+      race = [line]
+      found = False
+    elif tokens.place == len(race) + 1:
+      race.append(line)
+    elif not found:
+      race = []
+    found = found or len(race) >= RUN_LENGTH
+  if found and not is_team_scores(race_title):
+    yield race_title, race_header, race
+
+def race_name(meetname, title, number):
+  """Returns the meet name for one race of a file with several
+  """
+  return "%s - %s" % (meetname, " ".join(word.capitalize() for
+    word in title.split()) if title else "Race %d" % number)
+
+def named_races(meetname, races):
+  """Yields (name, title, header, result lines) for the races of a
+  file as split_races yields them, named from their titles.  A file
+  of one race keeps meetname, and names that repeat are numbered, as
+  in "ECAC - Men's 8k (2)", so every race of a file has a name of its
+  own.  Only one race is read ahead
+  """
+  races = iter(races)
+  first = next(races, None)
+  second = next(races, None)
+  if second is None:
+    if first is not None:
+      yield (meetname,) + first
+    return
+  used = set()
+  for number, (title, header, lines) in enumerate(
+      itertools.chain([first, second], races), 1):
+    name = base = race_name(meetname, title, number)
+    copy = 1
+    # A title may itself end in a number, as in "5K Run (2)"
+    while name in used:
+      copy += 1
+      name = "%s (%d)" % (base, copy)
+    used.add(name)
+    yield name, title, header, lines
+
+def class_year_words(date):
+  """Returns every word that could mark a class year in
+  results from date, mapped to the graduation year
+  """
+  this_year = date.year
+  class_words = {str(j):j for j in range(this_year+1, this_year+5)}
+  class_words.update({
+    "fr": this_year + 4,
+    "so": this_year + 3,
+    "jr": this_year + 2,
+    "sr": this_year + 1})
+  return class_words
+
+def common_index(counts):
+  """Returns the (index, count) of the most common index in
+  counts if it accounts for most of them
+  """
+  most_common = counts.most_common(1)
+  if most_common and most_common[0][1]/float(sum(counts.values())) > 0.5:
+    return most_common[0]
+  return None
+
+class ResultTextExtractor(HTMLParser):
+  """Pulls candidate result lines out of html as it is fed, without
+  building a document.  Text in <pre> blocks is split on newlines,
+  and any other text is split on <br> tags.  Once a <pre> block is
+  found only <pre> blocks are kept, since pages with several races
+  often give each its own
+  """
+  def __init__(self):
+    HTMLParser.__init__(self)
+    self.lines = []
+    self.current = []
+    self.in_pre = False
+    self.pre_found = False
+    self.closed = False
+    self.skip = 0
+
+  def end_line(self):
+    """Finishes the line being built
+    """
+    line = "".join(self.current)
+    if not self.in_pre:
+      line = re.sub(r"[\r\n]+", " ", line)
+    self.lines.append(line)
+    self.current = []
+
+  def outside(self):
+    """Checks whether text is being dropped for being outside of
+    the <pre> blocks
+    """
+    return self.pre_found and not self.in_pre
+
+  def handle_starttag(self, tag, attrs):
+    if tag == "pre" and not self.in_pre:
+      if not self.pre_found:
+        self.lines = []
+      self.current = []
+      self.in_pre = True
+      self.pre_found = True
+    elif tag in ("script", "style"):
+      self.skip += 1
+    elif self.in_pre or self.outside():
+      return
+    elif tag == "br":
+      self.end_line()
+    else:
+      self.current.append(" ")
+
+  def handle_startendtag(self, tag, attrs):
+    self.handle_starttag(tag, attrs)
+
+  def handle_endtag(self, tag):
+    if tag == "pre" and self.in_pre:
+      self.end_line()
+      self.in_pre = False
+    elif tag in ("script", "style"):
+      self.skip = max(self.skip - 1, 0)
+    elif not (self.in_pre or self.outside()):
+      self.current.append(" ")
+
+  def handle_data(self, data):
+    if self.skip or self.outside():
+      return
+    if self.in_pre:
+      pieces = data.split("\n")
+      for piece in pieces[:-1]:
+        self.current.append(piece)
+        self.end_line()
+      self.current.append(pieces[-1])
+    else:
+      self.current.append(data)
+
+  def handle_entityref(self, name):
+    self.handle_data(self.unescape("&%s;" % name))
+
+  def handle_charref(self, name):
+    self.handle_data(self.unescape("&#%s;" % name))
+
+  def parse_marked_section(self, i, report = 1):
+    """Skips marked sections HTMLParser cannot read, such as
+    <![foo[ x ]]> or <![ [x]]>, rather than failing the page
+    """
+    try:
+      return HTMLParser.parse_marked_section(self, i, report)
+    except HTMLParseError:
+      return self.skip_markup(i)
+
+  def skip_markup(self, i):
+    """Returns where the markup starting at i ends, just after the
+    next >, or -1 if the rest of it has not been fed yet
+    """
+    end = self.rawdata.find(">", i)
+    return -1 if end < 0 else end + 1
+
+  def drain(self):
+    """Returns and forgets the lines finished so far.  Lines outside
+    <pre> blocks are held back until a <pre> block is found, which
+    drops them, or the page ends without one
+    """
+    if not (self.pre_found or self.closed):
+      return []
+    lines, self.lines = self.lines, []
+    return lines
+
+  def close(self):
+    try:
+      HTMLParser.close(self)
+    except HTMLParseError:
+      # Only a reference cut off by the end of the page is left
+      pass
+    if self.current and not self.outside():
+      self.end_line()
+    self.closed = True
+
+def iter_lines(chunks):
+  """Yields candidate result lines from an iterable of html chunks,
+  as soon as each line is complete
+  """
+  extractor = ResultTextExtractor()
+  for chunk in chunks:
+    extractor.feed(chunk)
+    for line in extractor.drain():
+      yield line
+  extractor.close()
+  for line in extractor.drain():
+    yield line
+
+def fetch_lines(url, session = None, timeout = FETCH_TIMEOUT):
+  """Yields the candidate result lines of a page while it downloads,
+  using session if given
+  """
+  response = (session or requests).get(url, timeout = timeout,
+      stream = True)
+  response.raise_for_status()
+  # Chunks are only decoded if the page's encoding is known
+  response.encoding = response.encoding or "utf-8"
+  return iter_lines(response.iter_content(FETCH_CHUNK,
+    decode_unicode = True))
+
+def read_lines(buff = None, url = None, html = None, session = None,
+    cache = None):
+  """Returns an iterator over the lines of buff, or the candidate
+  result lines of html or of the page at url, fetched through cache
+  if given.  Lines are read as they are needed
+  """
+  if buff:
+    return (line.rstrip("\n") for line in buff)
+  elif html is None and cache:
+    return cache.fetch(url, iter_lines, session, FETCH_TIMEOUT)
+  elif html:
+    return iter_lines([html])
+  return fetch_lines(url, session)
+
+def spool(lines):
+  """Returns a seekable file holding lines, so they can be read
+  more than once.  Seekable files are used as they are
+  """
+  if hasattr(lines, "seek"):
+    return lines
+  buff = tempfile.TemporaryFile()
+  for line in lines:
+    if isinstance(line, unicode):
+      line = line.encode("utf-8")
+    buff.write(line.rstrip("\n") + "\n")
+  buff.seek(0)
+  return buff
+
 class NumParser:
   """Helper class to parse time and place fields
   """
   def __init__(self):
-    self.time_pattern = re.compile(
-        r"([0-9]{1,2})?(?::)([0-9]{1,2})(.[0-9]{1,2})?")
-    self.place_pattern = re.compile(
-        r"^(\d+)(?:\.)?(?<=$)")
+    self.time_pattern = TIME_PATTERN
+    self.place_pattern = PLACE_PATTERN
 
   def has_time(self, string):
     """Checks whether the given string has a timestamp in it
@@ -38,8 +381,15 @@ class NumParser:
   def return_time(self, string):
     """Returns largest timestamp from the string
     """
+    return self.largest_time(field for _, field in
+        self.get_timefields(string))
+
+  @staticmethod
+  def largest_time(matches):
+    """Returns the largest timestamp from time pattern matches
+    """
     timestamp = datetime.timedelta(seconds = 0)
-    for _, field in self.get_timefields(string):
+    for field in matches:
       group = field.groups()
       times = {
           "minutes": int(group[0] or 0),
@@ -61,8 +411,7 @@ class NumParser:
   def split_on_times(self, string):
     """Splits a string on time fields.  Returns a list of strings
     """
-    return re.split("|".join([field[1].string for
-      field in self.get_timefields(string)]), string)
+    return TIME_FIELD_PATTERN.split(string)
 
   def has_place(self, string):
     """Checks whether the given string has a (possible)
@@ -79,6 +428,31 @@ class NumParser:
       if field:
         return int(field.group(1))
 
+class LineTokens:
+  """The fields of a result line, found once and shared by every
+  parsing step.  class_info and fields depend on the class column
+  of the whole file, so the parser fills them in later
+  """
+  def __init__(self, line):
+    self.line = line
+    self.words = line.split()
+    self.has_time = False
+    self.place = None
+    self.times = []
+    for word in self.words:
+      match = TIME_PATTERN.search(word)
+      if match:
+        self.times.append(match)
+        if match.start() == 0:
+          self.has_time = True
+      elif self.place is None:
+        place = PLACE_PATTERN.match(word)
+        if place:
+          self.place = int(place.group(1))
+    self.time = NumParser.largest_time(self.times)
+    self.class_info = None
+    self.fields = None
+
 class Parser:
   """Handles file parsing operations
   """
@@ -86,53 +460,101 @@ class Parser:
       meetname,
       date,
       buff = None,
-      url = "http://www.coolrunning.com/results/12/ma/Nov3_ECACDi_set1.shtml"):
+      url = "http://www.coolrunning.com/results/12/ma/Nov3_ECACDi_set1.shtml",
+      bulk = True,
+      progress = None,
+      html = None,
+      session = None,
+      cache = None,
+      course = None):
 
     self.num_parser = NumParser()
+    self.tokens = {}
     self.date = date
+    self.bulk = bulk
+    self.progress = progress
+    self.report("reading")
+    self.read(buff, url, html, session, cache)
+    self.report("parsing")
+    self.clean()
+    self.analyze()
+    self.meet_id = mongo_utilities.create_meet(meetname, date = date,
+        course_id = course.get_id() if course else None)
+    self.results = [Result(line, self.meet_id, date) for line in self.data_lines]
+    self.report("resolving", total = len(self.results))
+    self.set_results()
+    self.report("saving", total = len(self.results))
+    self.save()
+    self.report("saved", saved = len(self.results))
+
+  def get_id(self):
+    """Returns meet_id
+    """
+    return self.meet_id
+
+  @instrumentation.timed("read")
+  def read(self, buff, url, html, session, cache):
+    """Reads raw_data and data_lines from buff, html or url
+    """
     if buff:
       self.raw_data = buff.read()
       self.data_lines = self.raw_data.split("\n")
-    elif url:
-      data = requests.get(url).text
-      soup = BeautifulSoup(data)
-      if soup.find("pre"):
-        self.raw_data = soup.find("pre").get_text()
-        self.data_lines = self.raw_data.split("\n")
-      else:
-        self.raw_data = soup.prettify()
-        self.data_lines = re.split(ur"(?:<[Bb][Rr]\s*?/?>)", self.raw_data)
-        self.data_lines = [re.sub(ur"[\r\n]+", " ", line) for
-            line in self.data_lines]
+    else:
+      self.data_lines = list(read_lines(url = url, html = html,
+        session = session, cache = cache))
+      self.raw_data = u"\n".join(self.data_lines)
 
-    self.clean()
+  @instrumentation.timed("analyze")
+  def analyze(self):
+    """Finds the class year column and name field of the cleaned
+    data_lines
+    """
+    self.line_count = len(self.data_lines)
     self.frequencies = self.get_frequencies()
     self.class_words = self.get_class_words()
     self.class_index = self.get_class_index()
     self.hier_lines = [self.hier_parse(line) for line in self.data_lines]
-    self.meet_id = mongo_utilities.create_meet(meetname, date = date)
-    self.results = [Result(line, self.meet_id, date) for line in self.data_lines]
-    self.set_results()
-    self.save()
+    self.name_index = self.find_name_index()
 
-  def get_id(self):
-    """Returns meet_id
+  def report(self, stage, **counts):
+    """Passes the current stage and any counts to the progress
+    callback, if there is one
     """
-    return self.meet_id
+    if self.progress:
+      self.progress(stage, **counts)
 
   def set_results(self):
-    """Sets properties of the result objects
-    """
-    for result in self.results:
-      result_line = result.data['raw_data']
-      result.set_time(self.num_parser.return_time(result_line))
-      textfields = self.find_name(result_line)
-      result.set_runner(
-          textfields["firstname"],
-          textfields["lastname"],
-          textfields["team"],
-          self.get_class(result_line)['class_year'])
-      result.set_team(textfields["team"])
+    """Sets properties of the result objects.  In bulk mode all
+    of the teams and runners are resolved together
+    """
+    if not self.bulk:
+      with instrumentation.span("resolve"):
+        for result in self.results:
+          runner = self.parse_result(result)
+          result.set_runner(*runner)
+          result.set_team(runner[2])
+      return
+    with instrumentation.span("parse"):
+      runners = [self.parse_result(result) for result in self.results]
+    with instrumentation.span("resolve"):
+      ids = mongo_utilities.create_runners(runners)
+    for result, (runner_id, team_id) in zip(self.results, ids):
+      result.set_ids(runner_id, team_id)
+
+  def parse_result(self, result):
+    """Sets the time of a result and returns its runner as a
+    (firstname, lastname, team, class_year) tuple
+    """
+    result_line = result.data['raw_data']
+    tokens = self.tokenize(result_line)
+    result.set_time(tokens.time)
+    result.set_place(tokens.place)
+    textfields = self.find_name(result_line)
+    return (
+        textfields["firstname"],
+        textfields["lastname"],
+        textfields["team"],
+        self.get_class(result_line)['class_year'])
 
   def write(self, path):
     """Writes data back out
@@ -140,33 +562,31 @@ class Parser:
     with open(path, 'wb') as buff:
       buff.write("\n".join(str(result) for result in self.results))
 
+  @instrumentation.timed("save")
   def save(self):
     """Saves data to mongo database
     """
-    for result in self.results:
-      mongo_utilities.add_result(**result.data)
+    if self.bulk:
+      mongo_utilities.add_results(*[result.data for result in self.results])
+    else:
+      for result in self.results:
+        mongo_utilities.add_result(**result.data)
+    mongo_utilities.build_meet_results(self.meet_id)
 
+  @instrumentation.timed("clean")
   def clean(self):
     """Removes empty lines, and any headers/footers
     """
-    self.data_lines = [line.lower() for
-        line in self.data_lines if
-        self.num_parser.has_time(line) and
-        self.num_parser.has_place(line) and
-        any(c.isalpha() for c in line)]
-    counter = 1
-    beginning_found = False
-    for j, line in enumerate(self.data_lines):
-      if counter == self.num_parser.return_place(line):
-        counter += 1
-        if counter > 14:
-          if not beginning_found:
-            beginning_found = True
-            good_lines = self.data_lines[j-13:j]
-          good_lines.append(line)
-      elif not beginning_found:
-        counter = 1
-    self.data_lines = good_lines
+    self.data_lines = list(clean_lines(self.data_lines, self.tokenize))
+
+  def tokenize(self, line):
+    """Returns the LineTokens for a line, splitting it only
+    the first time it is seen
+    """
+    tokens = self.tokens.get(line)
+    if tokens is None:
+      tokens = self.tokens[line] = LineTokens(line)
+    return tokens
 
   def hier_parse(self, line):
     """Performs some heirarchical clustering on the strings in
@@ -174,28 +594,27 @@ class Parser:
     time fields, then splitting by 2+ whitespaces, then by
     single white spaces.
     """
-    splitfields = [field[1].string for
-        field in self.num_parser.get_timefields(line)]
-    splt = self.class_split(line)
-    splt = reduce(lambda x, y:x+y, [re.split("|".join([field for field in
-      splitfields if field]), line)
-        for line in splt])
-    splt = [re.split(r"\s{2,}", field.strip()) for
-        field in splt if len(field) > 0]
-    splt = [j.split() for field in splt for j in field if len(field) > 0]
-    strings = [[word for word in field if
-      re.match("[a-z',-. ()-]+$",word)] for field in splt]
-    return [string for string in strings if len(string)>0]
+    tokens = self.tokenize(line)
+    if tokens.fields is None:
+      splt = [field for part in self.class_split(line) for
+          field in TIME_FIELD_PATTERN.split(part)]
+      splt = [SPACES_PATTERN.split(field.strip()) for
+          field in splt if len(field) > 0]
+      splt = [j.split() for field in splt for j in field if len(field) > 0]
+      strings = [[word for word in field if
+        WORD_PATTERN.match(word)] for field in splt]
+      tokens.fields = [string for string in strings if len(string)>0]
+    return tokens.fields
 
   def find_name(self, line):
     """Returns a firstname, lastname, team tuple for a line
     """
-    name_index = self.find_name_index()
+    name_index = self.name_index
     hier = self.hier_parse(line)
-    if "," in [j for j in hier[name_index]]:
-      name = " ".join(hier[name_index]).split(",")
+    if any("," in word for word in hier[name_index]):
+      name = " ".join(hier[name_index]).split(",", 1)
       return {"firstname": name[1].strip(),
-          "lastname": name[0].strip(), 
+          "lastname": name[0].strip(),
           "team": " ".join(hier[1])}
     return {"firstname": hier[name_index][0],
         "lastname": " ".join(hier[name_index][1:]),
@@ -222,23 +641,17 @@ class Parser:
     """Returns frequency counts of all words in the results
     """
     count = Counter()
-    for field in "\n".join(self.data_lines).split():
-      count[field] += 1
+    for line in self.data_lines:
+      count.update(self.tokenize(line).words)
     return count
 
   def get_class_words(self):
     """ Checks for class year existence
     """
-    this_year = self.date.year
-    class_words = {str(j):j for j in range(this_year+1, this_year+5)}
-    class_words.update({
-      "fr": this_year + 4,
-      "so": this_year + 3,
-      "jr": this_year + 2,
-      "sr": this_year + 1})
     counts = self.frequencies
-    class_words = {key:value for key, value in class_words.iteritems() if
-        0.1 < counts[key]/float(len(self.data_lines)) < 0.5}
+    class_words = {key:value for key, value in
+        class_year_words(self.date).iteritems() if
+        0.1 < counts[key]/float(self.line_count) < 0.5}
     return class_words
 
   def get_class_index(self):
@@ -253,22 +666,23 @@ class Parser:
           counts[line.index(word)] += 1
         except ValueError:
           pass
-    most_common = counts.most_common()
-    if most_common and most_common[0][1]/float(sum(counts.values())) > 0.5:
-      return most_common[0]
-    return None
+    return common_index(counts)
 
   def get_class(self, line):
     """ Sets the class year of a result
     """
-    if self.class_index:
-      for class_word, class_year in self.class_words.iteritems():
-        if self.class_index[0] in find_all(class_word, line):
-          return {
-              'word': class_word,
-              'class_year': class_year,
-              'index': self.class_index[0]}
-    return {'word': None, 'class_year': None, 'index': None}
+    tokens = self.tokenize(line)
+    if tokens.class_info is None:
+      tokens.class_info = {'word': None, 'class_year': None, 'index': None}
+      if self.class_index:
+        for class_word, class_year in self.class_words.iteritems():
+          if line.startswith(class_word, self.class_index[0]):
+            tokens.class_info = {
+                'word': class_word,
+                'class_year': class_year,
+                'index': self.class_index[0]}
+            break
+    return tokens.class_info
 
   def class_split(self, line):
     """ Splits a line by the class year, if exists.  Returns
@@ -280,12 +694,505 @@ class Parser:
           line[class_info['index']+len(class_info['word']):]]
     return [line]
 
+class RaceParser(Parser):
+  """Parses the result lines of one race without using the
+  database, so races can be parsed in separate processes.  Lines are
+  sliced at the columns fixed_width finds from how the race lines up,
+  and the heuristic parser reads the lines that do not fit them, or
+  every line if no columns are found or detect is False.  The race
+  is only analyzed for the heuristic parser if it is needed.  Races
+  of at most layout.VERIFY_SAMPLE lines are read heuristically, as
+  checking their columns would cost as much
+  """
+  def __init__(self, date, lines, detect = True):
+    self.num_parser = NumParser()
+    self.tokens = {}
+    self.date = date
+    self.progress = None
+    self.data_lines = lines
+    self.analyzed = False
+    self.columns = None
+    if detect and len(lines) > layout.VERIFY_SAMPLE:
+      columns = fixed_width.Columns.detect(lines, class_year_words(date))
+      if columns is not None and self.agrees(columns):
+        self.columns = columns
+
+  def agrees(self, columns):
+    """Returns whether columns read the first layout.VERIFY_SAMPLE
+    lines as the heuristic parser does, for most of them.  This
+    catches gutters found inside a column, as when every first name
+    is as long
+    """
+    sample = self.data_lines[:layout.VERIFY_SAMPLE]
+    results, runners = RaceParser(self.date, sample, detect = False).parse()
+    agree = sum(1 for result, runner in zip(results, runners) if
+        extract_columns(columns, result.data["raw_data"]) ==
+        (result.data["place"], result.data["time"], runner))
+    return agree >= layout.AGREEMENT*len(sample)
+
+  def parse(self, lines = None):
+    """Returns (results, runners) for the race, or for only lines
+    of it if given, each runner a (firstname, lastname, team,
+    class_year) tuple.  The results have no meet, runner or team ids
+    yet
+    """
+    results = [Result(line, None, self.date) for
+        line in (self.data_lines if lines is None else lines)]
+    return results, [self.read_result(result) for result in results]
+
+  def read_result(self, result):
+    """Sets the place and time of a result and returns its runner,
+    from the race's columns if its line has a place, name and time
+    in them
+    """
+    extracted = extract_columns(self.columns, result.data["raw_data"]) if \
+        self.columns is not None else None
+    if extracted is None:
+      return self.parse_result(result)
+    place, time, runner = extracted
+    result.set_place(place)
+    result.set_time(time)
+    return runner
+
+  def parse_result(self, result):
+    """Parses a result heuristically, analyzing the race first if it
+    has not been
+    """
+    if not self.analyzed:
+      self.analyze()
+      self.analyzed = True
+    return Parser.parse_result(self, result)
+
+def parse_race(args):
+  """Parses a (date, lines, changed lines, layout) race for a process
+  pool, which passes one argument.  Returns (results, runners,
+  learned), learned the layout if the race taught a new one.  Races
+  with a stored layout are sliced at its columns, and the heuristic
+  parser only reads the lines that do not fit
+  """
+  date, lines, changed, race_layout = args
+  if race_layout is not None and race_layout.verified:
+    return extract_race(date, lines, changed, race_layout) + (None,)
+  results, runners = RaceParser(date, lines).parse(changed)
+  if race_layout is None or not race_layout.verify(
+      [result.data["raw_data"] for result in results],
+      [(result.data["place"], result.data["time"], runner) for
+        result, runner in zip(results, runners)],
+      class_year_words(date)):
+    return results, runners, None
+  return results, runners, race_layout
+
+def extract_columns(columns, line):
+  """Returns (place, time, runner) for a line sliced at fixed_width
+  columns, like Layout.extract, or None if it has no place, name or
+  time in them
+  """
+  fields = columns.fields(line)
+  if fields["place"] is None or not (fields["time"] and
+      fields["firstname"]):
+    return None
+  return fields["place"], fields["time"], (fields["firstname"],
+      fields["lastname"], fields["team"], fields["class_year"])
+
+def extract_race(date, lines, changed, race_layout):
+  """Returns (results, runners) like RaceParser.parse for a race
+  with a stored layout
+  """
+  class_words = class_year_words(date)
+  heuristic = None
+  results = []
+  runners = []
+  for line in lines if changed is None else changed:
+    result = Result(line, None, date)
+    extracted = race_layout.extract(line, class_words)
+    if extracted is None:
+      if heuristic is None:
+        heuristic = RaceParser(date, lines, detect = False)
+      runner = heuristic.parse_result(result)
+    else:
+      place, time, runner = extracted
+      result.set_place(place)
+      result.set_time(time)
+    results.append(result)
+    runners.append(runner)
+  return results, runners
+
+def normalize_line(line):
+  """Returns a result line with its spacing made regular, so spacing
+  changes do not count as changed results
+  """
+  return " ".join(line.split())
+
+def content_hash(name, date, course_id, title, lines):
+  """Returns a hash of a race's result lines and the meet they are
+  stored as
+  """
+  digest = hashlib.sha1(repr((name, date.strftime(
+    mongo_utilities.DATE_FMT), str(course_id), title)))
+  for line in lines:
+    digest.update("\n" + normalize_line(line).encode("utf-8"))
+  return digest.hexdigest()
+
+def diff_lines(stored, lines):
+  """Compares a race's lines with its stored results, a list of
+  (result_id, raw_data).  Returns (added lines, removed result ids),
+  leaving out results whose line is unchanged
+  """
+  unmatched = Counter(normalize_line(line) for line in lines)
+  removed = []
+  for result_id, raw_data in stored:
+    line = normalize_line(raw_data)
+    if unmatched[line]:
+      unmatched[line] -= 1
+    else:
+      removed.append(result_id)
+  added = []
+  for line in lines:
+    if unmatched[normalize_line(line)]:
+      unmatched[normalize_line(line)] -= 1
+      added.append(line)
+  return added, removed
+
+class MeetParser(Parser):
+  """Parses every race in a result file and stores each as its own
+  meet.  Races are split off as the file is read and handled in
+  batches of about BATCH_LINES result lines: the races of a batch
+  are parsed in pool, if given, then their runners are resolved and
+  saved together, so memory does not grow with the size of the file.
+  lines may be given instead of buff, html or url, such as an open
+  file, and only the result lines are kept from it.  Saved results
+  are written to output if given.
+
+  Meets are keyed by name and date, and hold a hash of their lines.
+  Uploading a race again with the same hash does nothing, and a
+  revised race is diffed against its stored results so only the
+  changed lines are parsed and saved.  Races whose column headings
+  match a learned layout are read by slicing at its columns
+  """
+  def __init__(self,
+      meetname,
+      date,
+      buff = None,
+      url = None,
+      html = None,
+      lines = None,
+      session = None,
+      cache = None,
+      progress = None,
+      course = None,
+      processes = 1,
+      pool = None,
+      output = None):
+
+    self.num_parser = NumParser()
+    self.date = date
+    self.bulk = True
+    self.progress = progress
+    self.course_id = course.get_id() if course else None
+    self.races = []
+    self.changes = []
+    self.saved_ids = []
+    self.saved = 0
+    self.removed = 0
+    self.report("reading")
+    if lines is None:
+      lines = read_lines(buff, url, html, session, cache)
+    # A pool is made here only if the caller has none to share
+    own_pool = pool is None and processes > 1
+    self.pool = multiprocessing.Pool(processes) if own_pool else pool
+    self.output = open(output, "wb") if output else None
+    try:
+      batch = []
+      size = 0
+      races = named_races(meetname, split_races(
+        instrumentation.timed_iter("read", lines), LineTokens))
+      # Reading happens while splitting, so its time is in both spans
+      for race in instrumentation.timed_iter("split", races):
+        batch.append(race)
+        size += len(race[3])
+        if size >= BATCH_LINES:
+          self.save_batch(batch)
+          batch = []
+          size = 0
+      if batch:
+        self.save_batch(batch)
+    finally:
+      if own_pool:
+        self.pool.close()
+        self.pool.join()
+      if self.output:
+        self.output.close()
+    if not self.races:
+      raise ValueError("no results found")
+    self.report("saved", saved = self.saved)
+
+  def save_batch(self, races):
+    """Diffs a batch of (name, title, header, result lines) races
+    against their stored meets, then parses and saves the ones that
+    changed
+    """
+    date = self.date
+    # A name stored more than once, as uploads through Parser can
+    # leave, always matches its oldest meet
+    stored = {}
+    for meet in mongo_utilities.find_meets(
+        [name for name, _, _, _ in races], date):
+      stored.setdefault(meet["name"], meet)
+    # (number, name, title, lines, hash, stored meet, added lines,
+    # removed ids, layout) of the races that changed
+    changed = []
+    with instrumentation.span("diff"):
+      for name, title, header, race in races:
+        j = len(self.races)
+        race_hash = content_hash(name, date, self.course_id, title, race)
+        meet = stored.get(name)
+        self.races.append((name, meet["_id"] if meet else None))
+        self.changes.append({"status": "unchanged", "added": 0,
+          "removed": 0})
+        if meet is not None and meet.get("content_hash") == race_hash:
+          continue
+        added, removed = diff_lines(
+            mongo_utilities.get_result_lines(meet["_id"]) if meet else [],
+            race)
+        changed.append((j, name, title, race, race_hash, meet, added,
+          removed, layout.find_layout(header)))
+    if not changed:
+      return
+
+    self.report("parsing", races = len(self.races))
+    with instrumentation.span("parse"):
+      parsed = self.parse_races([(date, race, added, race_layout) for
+        _, _, _, race, _, _, added, _, race_layout in changed])
+
+    results = []
+    removed_ids = []
+    meet_ids = []
+    runners = []
+    for (j, name, title, _, race_hash, meet, added, removed, _), \
+        (race_results, race_runners, learned) in zip(changed, parsed):
+      if learned is not None:
+        layout.save_layout(learned)
+      fields = {"date": date, "course_id": self.course_id, "race": title}
+      if meet is None:
+        meet_id = mongo_utilities.create_meet(name, **fields)
+      else:
+        meet_id = meet["_id"]
+        mongo_utilities.update_meet(meet_id, **fields)
+      for result in race_results:
+        result.set_meet(meet_id)
+      self.races[j] = (name, meet_id)
+      self.changes[j] = {"status": "updated" if meet else "created",
+          "added": len(added), "removed": len(removed)}
+      meet_ids.append(meet_id)
+      results.extend(race_results)
+      removed_ids.extend(removed)
+      runners.extend(race_runners)
+
+    self.report("resolving", saved = self.saved,
+        total = self.saved + len(results))
+    with instrumentation.span("resolve"):
+      ids = mongo_utilities.create_runners(runners)
+    for result, (runner_id, team_id) in zip(results, ids):
+      result.set_ids(runner_id, team_id)
+    self.report("saving", saved = self.saved,
+        total = self.saved + len(results))
+    self.save(results, removed_ids, meet_ids)
+    # Only races saved in full are skipped when uploaded again
+    for (_, _, _, _, race_hash, _, _, _, _), meet_id in zip(changed,
+        meet_ids):
+      mongo_utilities.update_meet(meet_id, content_hash = race_hash)
+    self.saved_ids.extend(meet_ids)
+    self.saved += len(results)
+    self.removed += len(removed_ids)
+    if self.output and results:
+      if self.output.tell():
+        self.output.write("\n")
+      self.output.write("\n".join(str(result) for result in results))
+
+  def parse_races(self, races):
+    """Returns parse_race for each (date, lines, changed lines,
+    layout) race, in order
+    """
+    if self.pool is not None and len(races) > 1:
+      return self.pool.map(parse_race, races)
+    return [parse_race(race) for race in races]
+
+  def get_id(self):
+    """Returns the meet_id of the first race
+    """
+    return self.races[0][1]
+
+  def get_ids(self):
+    """Returns the meet_id of every race, in file order
+    """
+    return [meet_id for _, meet_id in self.races]
+
+  @instrumentation.timed("save")
+  def save(self, results, removed, meet_ids):
+    """Saves the new results of changed races to the mongo database
+    and removes their results that are gone
+    """
+    mongo_utilities.add_results(*[result.data for result in results])
+    removed_runners = mongo_utilities.remove_results(*removed)
+    mongo_utilities.build_meet_results(*meet_ids)
+    # Runners left out of a revised race are no longer in its results
+    mongo_utilities.build_runner_history(*removed_runners)
+
+class StreamingParser(Parser):
+  """Parses a result file from a file-like object or line iterator
+  in two passes.  The first pass only keeps the statistics needed
+  to find fields, and the second saves results in batches, so
+  memory use does not grow with the size of the file
+  """
+  def __init__(self,
+      meetname,
+      date,
+      lines,
+      path = None,
+      batch_size = 500,
+      progress = None,
+      course = None):
+
+    self.num_parser = NumParser()
+    self.last_tokens = None
+    self.date = date
+    self.bulk = True
+    self.batch_size = batch_size
+    self.progress = progress
+    self.report("reading")
+    self.source = spool(lines)
+    self.start = self.source.tell()
+    self.report("parsing")
+    self.first_pass()
+    self.meet_id = mongo_utilities.create_meet(meetname, date = date,
+        course_id = course.get_id() if course else None)
+    self.save(path)
+
+  def lines(self):
+    """Yields the cleaned result lines from the start of the source
+    """
+    self.source.seek(self.start)
+    return clean_lines((line.rstrip("\n") for line in self.source),
+        self.tokenize)
+
+  def tokenize(self, line):
+    """Returns the LineTokens for a line, only remembering the
+    most recent line so memory stays flat
+    """
+    if self.last_tokens is None or self.last_tokens.line != line:
+      self.last_tokens = LineTokens(line)
+    return self.last_tokens
+
+  @instrumentation.timed("analyze")
+  def first_pass(self):
+    """Collects word frequencies, class year positions and a
+    sample of lines to find the name field
+    """
+    self.line_count = 0
+    self.frequencies = Counter()
+    positions = {word: Counter() for word in class_year_words(self.date)}
+    sample = []
+    for line in self.lines():
+      self.line_count += 1
+      self.frequencies.update(line.split())
+      for word, counts in positions.iteritems():
+        index = line.find(word)
+        if index >= 0:
+          counts[index] += 1
+      if len(sample) < NAME_SAMPLE:
+        sample.append(line)
+
+    self.class_words = self.get_class_words() if self.line_count else {}
+    counts = Counter()
+    for word in self.class_words:
+      counts.update(positions[word])
+    self.class_index = common_index(counts)
+    self.hier_lines = [self.hier_parse(line) for line in sample]
+    self.name_index = self.find_name_index() if sample else 0
+
+  def iter_batches(self):
+    """Yields lists of at most batch_size results, with their
+    runners and teams resolved
+    """
+    batch = []
+    runners = []
+    for line in self.lines():
+      result = Result(line, self.meet_id, self.date)
+      runners.append(self.parse_result(result))
+      batch.append(result)
+      if len(batch) == self.batch_size:
+        self.resolve(batch, runners)
+        yield batch
+        batch = []
+        runners = []
+    if batch:
+      self.resolve(batch, runners)
+      yield batch
+
+  def iter_results(self):
+    """Yields results one at a time
+    """
+    for batch in self.iter_batches():
+      for result in batch:
+        yield result
+
+  @staticmethod
+  @instrumentation.timed("resolve")
+  def resolve(batch, runners):
+    """Sets runner and team ids for a batch of results
+    """
+    ids = mongo_utilities.create_runners(runners)
+    for result, (runner_id, team_id) in zip(batch, ids):
+      result.set_ids(runner_id, team_id)
+
+  @instrumentation.timed("save")
+  def save(self, path = None):
+    """Saves results to the mongo database a batch at a time,
+    also writing them out to path if given
+    """
+    buff = open(path, 'wb') if path else None
+    saved = 0
+    self.report("saving", saved = saved, total = self.line_count)
+    try:
+      for batch in self.iter_batches():
+        mongo_utilities.add_results(*[result.data for result in batch])
+        if buff:
+          self.write_batch(buff, batch, saved)
+        saved += len(batch)
+        self.report("saving", saved = saved, total = self.line_count)
+    finally:
+      if buff:
+        buff.close()
+    mongo_utilities.build_meet_results(self.meet_id)
+    self.report("saved", saved = saved)
+
+  def write(self, path):
+    """Writes the results out, parsing the source again a batch at a
+    time.  Passing path to the parser writes them while saving, which
+    saves the second pass
+    """
+    written = 0
+    with open(path, 'wb') as buff:
+      for batch in self.iter_batches():
+        self.write_batch(buff, batch, written)
+        written += len(batch)
+
+  @staticmethod
+  def write_batch(buff, batch, written):
+    """Writes a batch of results to buff after the written results
+    before it
+    """
+    if written:
+      buff.write("\n")
+    buff.write("\n".join(str(result) for result in batch))
+
 class Result:
   """ Handles individual runners in a result
   """
   def __init__(self, data, meet_id, date):
     self.data = {
         "raw_data": data,
+        "place": None,
         "time": None,
         "team_id": None,
         "runner_id": None,
@@ -297,6 +1204,11 @@ class Result:
     """
     self.data['time'] = time
 
+  def set_place(self, place):
+    """ Set finishing place, as printed in the results
+    """
+    self.data['place'] = place
+
   def set_team(self, team):
     """ Set team
     """
@@ -311,6 +1223,12 @@ class Result:
         team,
         class_year)
 
+  def set_ids(self, runner_id, team_id):
+    """ Set runner and team ids that were already resolved
+    """
+    self.data['runner_id'] = runner_id
+    self.data['team_id'] = team_id
+
   def set_meet(self, meet_id):
     """ Set meet
     """
@@ -328,9 +1246,14 @@ class Course:
   """
   def __init__(self,
       name,
-      distance):
+      distance = None):
     self.name = name
-    self.distance = int(distance)
+    self.distance = int(distance) if distance else None
+
+  def get_id(self):
+    """Returns the id of the stored course
+    """
+    return mongo_utilities.get_course_id(self.name, self.distance)
 
 def startup():
   """Convenience function to have some initial data
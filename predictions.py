@@ -0,0 +1,217 @@
+"""Meet predictions by Monte Carlo simulation.
+
+Each runner's recent times, scaled to an average course by the
+course model, are fitted to a normal distribution of finishing times.
+An upcoming meet is run many times over by drawing every entrant's
+time at once, and each simulated finish is scored with
+scoring.score_races.
+"""
+import datetime
+import multiprocessing
+
+import numpy as np
+
+import columnar
+import course_model
+import mongo_utilities
+import scoring
+from identity_cache import LRUCache
+
+SIMULATIONS = 20000
+# Simulations drawn at once, to bound the memory of the time arrays
+CHUNK = 5000
+# Days of results used to fit runner models
+HISTORY_DAYS = 400
+# Weight of each race relative to the one after it
+DECAY = 0.8
+# Spread of a runner's times as a fraction of their mean, assumed
+# before any races are seen, and how many races it counts for
+SPREAD = 0.03
+PRIOR_RACES = 2.
+TEAM_SIZE = 7
+
+# (mean seconds on an average course, spread) by (runner_id, meet_id
+# of the runner's last result, course model version), so a model is
+# refit only once the runner has raced again or the course factors
+# its times are scaled by have changed
+MODELS = LRUCache(maxsize = 100000)
+
+def load_season(date, days = HISTORY_DAYS):
+  """Returns the Season of results in the days before date
+  """
+  return columnar.Season(columnar.load_meet_columns(
+    start = date - datetime.timedelta(days = days),
+    end = date - datetime.timedelta(days = 1)))
+
+def fit_runners(season, codes, factors):
+  """Returns (means, spreads, last meets) for runner codes in a
+  season, with times scaled by each meet's course factor.  Recent
+  races weigh more, and the spread is pulled toward SPREAD for
+  runners with few races.  Runners with no races get nan
+  """
+  scale = np.array([factors.get(course_id, 1.) for
+    course_id in season.course_ids])
+  wanted = np.zeros(len(season.runners), dtype = bool)
+  wanted[codes] = True
+  rows = np.flatnonzero(wanted[season.runner])
+  # Seasons are in date order, so a stable sort by runner leaves each
+  # runner's races in order too
+  rows = rows[np.argsort(season.runner[rows], kind = "mergesort")]
+  runner = season.runner[rows]
+  seconds = season.seconds[rows]/scale[season.meet[rows]]
+
+  count = len(season.runners)
+  races = np.bincount(runner, minlength = count)
+  ends = np.cumsum(races)
+  after = ends[runner] - np.arange(len(rows)) - 1
+  weight = DECAY**after
+  total = np.bincount(runner, weight, minlength = count)
+  with np.errstate(invalid = "ignore", divide = "ignore"):
+    mean = np.bincount(runner, weight*seconds, minlength = count)/total
+    residual = seconds/mean[runner] - 1
+    spread = np.sqrt((np.bincount(runner, weight*residual**2,
+      minlength = count) + PRIOR_RACES*SPREAD**2)/(total + PRIOR_RACES))
+  last = np.full(count, -1, dtype = int)
+  np.maximum.at(last, runner, season.meet[rows])
+  return mean[codes], spread[codes], last[codes]
+
+def runner_models(season, runner_ids, factors, version = None):
+  """Returns (means, spreads) for runners, using cached models for
+  runners who have not raced since they were fitted with the course
+  model version that gave factors
+  """
+  codes = [season.runner_code(runner_id) for runner_id in runner_ids]
+  # Meets are in date order, so the latest is the highest index
+  last = np.full(len(season.runners), -1, dtype = int)
+  np.maximum.at(last, season.runner, season.meet)
+  means = np.full(len(runner_ids), np.nan)
+  spreads = np.full(len(runner_ids), np.nan)
+  stale = []
+  for j, (runner_id, code) in enumerate(zip(runner_ids, codes)):
+    if code is None:
+      continue
+    model = MODELS.get((runner_id, season.meet_ids[last[code]], version))
+    if model is None:
+      stale.append(j)
+    else:
+      means[j], spreads[j] = model
+  if stale:
+    fitted = fit_runners(season, np.array([codes[j] for j in stale]),
+        factors)
+    for j, mean, spread, meet in zip(stale, *fitted):
+      means[j], spreads[j] = mean, spread
+      MODELS.put((runner_ids[j], season.meet_ids[meet], version),
+          (mean, spread))
+  return means, spreads
+
+def simulate(means, spreads, teams, team_count, simulations, seed = None):
+  """Runs simulations of one race and returns (wins, podiums, total
+  team places) as arrays by team code
+  """
+  random = np.random.RandomState(seed)
+  wins = np.zeros(team_count, dtype = int)
+  podiums = np.zeros(team_count, dtype = int)
+  places = np.zeros(team_count)
+  for start in range(0, simulations, CHUNK):
+    size = min(CHUNK, simulations - start)
+    times = means*(1 + spreads*random.standard_normal((size, len(means))))
+    standings = scoring.score_races(teams[np.argsort(times, axis = 1)],
+        team_count).standings()
+    if not standings.shape[1]:
+      break
+    wins += np.bincount(standings[:, 0][standings[:, 0] >= 0],
+        minlength = team_count)
+    podium = standings[:, :3].ravel()
+    podiums += np.bincount(podium[podium >= 0], minlength = team_count)
+    ranked = standings >= 0
+    places += np.bincount(standings[ranked],
+        np.nonzero(ranked)[1] + 1., minlength = team_count)
+  return wins, podiums, places
+
+def simulate_chunk(args):
+  """simulate for a process pool, which passes one argument
+  """
+  return simulate(*args)
+
+def team_entries(season, team_ids, size = TEAM_SIZE):
+  """Returns [(runner_id, team_id)] entries of each team's runners
+  with the best average times in the season
+  """
+  entries = []
+  for team_id in team_ids:
+    code = season.team_code(team_id)
+    if code is None:
+      continue
+    rows = season.team == code
+    runners, runner = np.unique(season.runner[rows], return_inverse = True)
+    average = np.bincount(runner, season.seconds[rows])/np.bincount(runner)
+    entries.extend((columnar.unpack_id(season.runners[code]), team_id) for
+        code in runners[np.argsort(average)][:size])
+  return entries
+
+def predict_meet(meet_id, **kwargs):
+  """Predicts a stored meet again from its finishers, course and
+  date, using only results from before it.  Returns None if the meet
+  has no results
+  """
+  meets = columnar.load_meet_columns([meet_id])
+  if not meets:
+    return None
+  entries = [(columnar.unpack_id(runner), columnar.unpack_id(team)) for
+      runner, team in zip(meets[0].runner_ids, meets[0].team_ids)]
+  return predict(entries, mongo_utilities.to_date(meets[0].date),
+      meets[0].course_id, **kwargs)
+
+def predict(entries, date, course_id = None, simulations = SIMULATIONS,
+    processes = 1, seed = None, season = None):
+  """Predicts a meet on date between entries, a list of (runner_id,
+  team_id).  Returns {"teams": [{team_id, win, podium, place}] most
+  likely winner first, "runners": [{runner_id, team_id, seconds,
+  spread}], "unrated": [runner_id], "simulations": count}
+  """
+  if season is None:
+    season = load_season(date)
+  model = course_model.CourseModel.load()
+  factors = model.factors()
+  runner_ids = [runner_id for runner_id, _ in entries]
+  means, spreads = runner_models(season, runner_ids, factors, model.version)
+  means = means*factors.get(course_id, 1.)
+  rated = ~np.isnan(means)
+
+  team_ids, teams = scoring.team_codes([{"team_id": team_id} for
+    _, team_id in entries])
+
+  args = (means[rated], spreads[rated], teams[rated], len(team_ids))
+  if processes > 1:
+    seeds = np.random.RandomState(seed).randint(2**31, size = processes)
+    sizes = [simulations//processes + (j < simulations % processes) for
+        j in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+      counts = pool.map(simulate_chunk, [args + (size, int(chunk_seed)) for
+        size, chunk_seed in zip(sizes, seeds)])
+    finally:
+      pool.close()
+    wins, podiums, places = [sum(count) for count in zip(*counts)]
+  else:
+    wins, podiums, places = simulate(*(args + (simulations, seed)))
+
+  # Teams without five rated runners never score
+  standings = [{
+    "team_id": team_id,
+    "win": wins[code]/float(simulations),
+    "podium": podiums[code]/float(simulations),
+    "place": places[code]/float(simulations) if places[code] else None} for
+    code, team_id in enumerate(team_ids)]
+  standings.sort(key = lambda team: (-team["win"], -team["podium"]))
+  return {
+      "teams": standings,
+      "runners": [{
+        "runner_id": runner_id,
+        "team_id": team_id,
+        "seconds": means[j],
+        "spread": spreads[j]} for
+        j, (runner_id, team_id) in enumerate(entries) if rated[j]],
+      "unrated": [runner_id for j, (runner_id, _) in enumerate(entries) if
+        not rated[j]],
+      "simulations": simulations}
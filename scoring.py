@@ -0,0 +1,137 @@
+"""Cross country team scoring.
+
+A team's score is the sum of the team places of its first five
+finishers, lowest winning.  Only teams with at least five finishers
+score; their other runners are removed before team places are given
+out.  A team's 6th and 7th runners take team places, displacing other
+teams' runners, but do not add to its score, and anyone after a
+team's 7th is removed.  Ties go to the team whose 6th runner finished
+ahead, and a team with no 6th runner loses the tie.
+
+Races are scored as arrays of team codes in finish order, one row per
+race, so many hypothetical finishes can be scored at once.
+"""
+import numpy as np
+
+import mongo_utilities
+
+SCORERS = 5
+DISPLACERS = 2
+# Code for a finisher who runs as an individual rather than for a team
+NO_TEAM = -1
+
+class Scores:
+  """Team scores of one or more races over the same teams.  Arrays
+  are indexed [race, team code], or [race, finisher] for team_place
+  """
+  def __init__(self, score, sixth, complete, team_place):
+    self.score = score
+    self.sixth = sixth
+    self.complete = complete
+    self.team_place = team_place
+
+  def standings(self):
+    """Returns the team codes of each race's scoring teams, winner
+    first, as rows padded with NO_TEAM
+    """
+    score = np.where(self.complete, self.score, np.inf)
+    order = np.lexsort((self.sixth, score), axis = 1) if \
+        score.shape[1] else np.zeros(score.shape, dtype = int)
+    counts = self.complete.sum(axis = 1)
+    return np.where(np.arange(score.shape[1]) < counts[:, None], order,
+        NO_TEAM)
+
+  def winners(self):
+    """Returns the winning team code of each race, or NO_TEAM
+    """
+    standings = self.standings()
+    if not standings.shape[1]:
+      return np.full(len(standings), NO_TEAM, dtype = int)
+    return standings[:, 0]
+
+def score_races(codes, teams):
+  """Scores races given as a 2D array of team codes in finish order,
+  one row per race, with NO_TEAM for individuals.  A finisher can be
+  dropped from a race by giving them NO_TEAM.  teams is the number of
+  team codes
+  """
+  codes = np.atleast_2d(np.asarray(codes, dtype = int))
+  races, finishers = codes.shape
+  width = teams + 1
+  rows = np.arange(races)[:, None]
+  columns = np.arange(finishers)
+  # A stable sort of each race by team leaves every team's runners
+  # together in finish order, so a runner's rank on their team is how
+  # far they are from the start of their run of equal codes
+  order = np.argsort(codes, axis = 1, kind = "mergesort")
+  grouped = codes[rows, order]
+  starts = np.ones(codes.shape, dtype = bool)
+  starts[:, 1:] = grouped[:, 1:] != grouped[:, :-1]
+  first = np.maximum.accumulate(np.where(starts, columns, 0), axis = 1)
+  rank = np.empty(codes.shape, dtype = int)
+  rank[rows, order] = columns - first
+  rank = rank.ravel()
+  # One group per (race, team), column 0 holding the individuals
+  key = (rows*width + codes + 1).ravel()
+  counts = np.bincount(key, minlength = races*width)
+
+  placed = (codes.ravel() != NO_TEAM) & (counts[key] >= SCORERS) & \
+      (rank < SCORERS + DISPLACERS)
+  placed = placed.reshape(races, finishers)
+  team_place = np.where(placed, np.cumsum(placed, axis = 1), 0)
+
+  place = team_place.ravel()
+  scorers = placed.ravel() & (rank < SCORERS)
+  score = np.bincount(key[scorers], place[scorers], minlength = races*width)
+  sixth = np.full(races*width, np.inf)
+  sixth_runner = placed.ravel() & (rank == SCORERS)
+  sixth[key[sixth_runner]] = place[sixth_runner]
+  return Scores(
+      score.reshape(races, width)[:, 1:],
+      sixth.reshape(races, width)[:, 1:],
+      (counts >= SCORERS).reshape(races, width)[:, 1:],
+      team_place)
+
+def team_codes(rows):
+  """Returns (team ids, code of each row) for result rows
+  """
+  team_ids = []
+  codes = {}
+  for row in rows:
+    if row.get("team_id") is not None and row["team_id"] not in codes:
+      codes[row["team_id"]] = len(team_ids)
+      team_ids.append(row["team_id"])
+  return team_ids, np.array([codes.get(row.get("team_id"), NO_TEAM) for
+    row in rows], dtype = int)
+
+def score_results(rows):
+  """Scores one race from result rows in finish order, such as
+  get_meet_results returns.  Each row is given a team_place (None if
+  removed) and a list of {team_id, team, score, sixth, scorers} is
+  returned for the scoring teams, winner first
+  """
+  team_ids, codes = team_codes(rows)
+  scores = score_races(codes, len(team_ids))
+  for row, team_place in zip(rows, scores.team_place[0]):
+    row["team_place"] = int(team_place) or None
+  names = dict((row["team_id"], row.get("team")) for row in rows)
+  standings = []
+  for code in scores.standings()[0]:
+    if code == NO_TEAM:
+      break
+    team_id = team_ids[code]
+    places = [row["team_place"] for row in rows if
+        row.get("team_id") == team_id and row["team_place"]]
+    standings.append({
+      "team_id": team_id,
+      "team": names[team_id],
+      "score": int(scores.score[0, code]),
+      "sixth": places[SCORERS] if len(places) > SCORERS else None,
+      "scorers": places[:SCORERS]})
+  return standings
+
+def score_meet(meet_id):
+  """Returns (team standings, result rows) for a meet
+  """
+  rows = mongo_utilities.get_meet_results(meet_id)
+  return score_results(rows), rows
@@ -0,0 +1,129 @@
+"""String similarity and blocking keys for matching runner and team
+names that are spelled differently
+"""
+import re
+
+# Words left out of team blocking keys, since so many teams share them
+TEAM_STOPWORDS = set(["university", "college", "of", "the", "at", "xc",
+  "cross", "country", "state"])
+# Spellings of team name words that are written out before comparing
+TEAM_ABBREVIATIONS = {"univ": "university", "u": "university",
+    "coll": "college", "st": "state", "cc": "cross country"}
+SOUNDEX_CODES = dict((letter, str(code)) for code, letters in enumerate(
+  ["aeiouyhw", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"]) for
+  letter in letters)
+# Points taken off a runner match whose class years disagree
+CLASS_PENALTY = 0.1
+
+def soundex(word):
+  """Returns the American Soundex code of a word, such as R163 for
+  Robert and Rupert
+  """
+  letters = [c for c in word.lower() if c in SOUNDEX_CODES]
+  if not letters:
+    return ""
+  code = letters[0].upper()
+  last = SOUNDEX_CODES[letters[0]]
+  for letter in letters[1:]:
+    digit = SOUNDEX_CODES[letter]
+    if digit != "0" and digit != last:
+      code += digit
+    # h and w do not separate letters with the same code
+    if letter not in "hw":
+      last = digit
+  return (code + "000")[:4]
+
+def team_words(name):
+  """Returns the lowercase words of a team name with abbreviations
+  written out
+  """
+  return " ".join(TEAM_ABBREVIATIONS.get(word, word) for
+      word in re.findall(r"[a-z0-9]+", name.lower())).split()
+
+def same_team(a, b):
+  """Returns whether two team names are the same once case,
+  punctuation and abbreviations are set aside
+  """
+  return team_words(a) == team_words(b)
+
+def team_block_keys(name):
+  """Returns the blocking keys of a team name: the Soundex codes of
+  its distinctive words
+  """
+  return sorted(set(soundex(word) for word in team_words(name) if
+    word not in TEAM_STOPWORDS) - set([""]))
+
+def runner_block_keys(first_name, last_name, team_id):
+  """Returns the blocking keys of a runner: their team with the
+  Soundex code of each name, so first and last swapped still share a
+  key
+  """
+  return sorted(set("%s:%s" % (team_id, soundex(name)) for
+    name in (first_name, last_name)))
+
+def jaro_winkler(a, b):
+  """Returns the Jaro-Winkler similarity of two strings, from 0 for
+  nothing in common to 1 for equal
+  """
+  if a == b:
+    return 1.
+  if not a or not b:
+    return 0.
+  window = max(max(len(a), len(b))//2 - 1, 0)
+  used = [False]*len(b)
+  matches = []
+  for j, letter in enumerate(a):
+    for k in range(max(0, j - window), min(len(b), j + window + 1)):
+      if not used[k] and b[k] == letter:
+        used[k] = True
+        matches.append(letter)
+        break
+  if not matches:
+    return 0.
+  matched = [letter for k, letter in enumerate(b) if used[k]]
+  transpositions = sum(x != y for x, y in zip(matches, matched))/2.
+  count = float(len(matches))
+  jaro = (count/len(a) + count/len(b) + (count - transpositions)/count)/3
+  prefix = 0
+  for x, y in zip(a[:4], b[:4]):
+    if x != y:
+      break
+    prefix += 1
+  return jaro + prefix*0.1*(1 - jaro)
+
+def team_similarity(a, b):
+  """Returns how alike two team names are once abbreviations are
+  written out
+  """
+  return jaro_winkler(" ".join(team_words(a)), " ".join(team_words(b)))
+
+def runner_similarity(a, b):
+  """Returns how alike two runners are, each given as (first_name,
+  last_name, class_year) on the same team.  Swapped first and last
+  names count as a match, and differing class years count against
+  """
+  first_a, last_a = a[0].lower(), a[1].lower()
+  first_b, last_b = b[0].lower(), b[1].lower()
+  score = max(
+      (jaro_winkler(first_a, first_b) + jaro_winkler(last_a, last_b))/2,
+      (jaro_winkler(first_a, last_b) + jaro_winkler(last_a, first_b))/2)
+  if a[2] and b[2] and a[2] != b[2]:
+    score -= CLASS_PENALTY
+  return score
+
+def name_letters(name):
+  """Returns the lowercase letters and digits of a name
+  """
+  return "".join(re.findall(r"[a-z0-9]+", name.lower()))
+
+def same_runner(a, b):
+  """Returns whether two runners, each (first_name, last_name,
+  class_year) on the same team, have the same names once case, spacing
+  and punctuation are set aside, in either order, and class years
+  that do not disagree
+  """
+  if a[2] and b[2] and a[2] != b[2]:
+    return False
+  first_a, last_a = name_letters(a[0]), name_letters(a[1])
+  return (first_a, last_a) in ((name_letters(b[0]), name_letters(b[1])),
+      (name_letters(b[1]), name_letters(b[0])))
@@ -1,7 +1,55 @@
 """Unit tests
 """
 import app
+import columnar
+import course_model
+import datetime
+import dedup
+import fixed_width
+import hooks
+import identity_cache
+import instrumentation
+import layout
+import os
+import shutil
+import tempfile
+import mongo_utilities
+import parser
+import predictions
+import scoring
+import similarity
+import threading
+import time
 import unittest
+import weakref
+import numpy as np
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from bson.objectid import ObjectId
+from fetch_cache import FetchCache
+from identity_cache import LRUCache
+from importer import Importer
+from ingestion import IngestionQueue
+from view_cache import FileBackend, MemoryBackend, ViewCache
+
+class DatabaseTest(unittest.TestCase):
+  """Runs each test against an empty database of its own
+  """
+  def setUp(self):
+    """Point the utilities at a fresh database
+    """
+    self.database = mongo_utilities.DB
+    mongo_utilities.DB = instrumentation.CountingDatabase(
+        mongo_utilities.CLIENT[mongo_utilities.DBNAME + "_test"])
+    mongo_utilities.CLIENT.drop_database(mongo_utilities.DBNAME + "_test")
+    mongo_utilities.ensure_indexes()
+    identity_cache.clear()
+
+  def tearDown(self):
+    """Drop the test database
+    """
+    mongo_utilities.CLIENT.drop_database(mongo_utilities.DBNAME + "_test")
+    mongo_utilities.DB = self.database
+    identity_cache.clear()
 
 class CrossUploadPage(unittest.TestCase):
   """Tests the upload page functionality
@@ -23,5 +71,1135 @@ class CrossUploadPage(unittest.TestCase):
     rv = self.app.get('/')
     print rv.data
 
+class IdentityCacheTest(unittest.TestCase):
+  """Tests the bounded identity cache
+  """
+  def test_eviction_and_counters(self):
+    """Least recently used entries are evicted first
+    """
+    cache = LRUCache(maxsize = 2)
+    cache.put("harvard", 1)
+    cache.put("yale", 2)
+    self.assertEqual(cache.get("harvard"), 1)
+    cache.put("brown", 3)
+    self.assertEqual(cache.get("yale"), None)
+    self.assertEqual(cache.stats()["hits"], 1)
+    self.assertEqual(cache.stats()["misses"], 1)
+    cache.discard_where(lambda key, value: value == 3)
+    self.assertEqual(cache.get("brown"), None)
+
+class ViewCacheTest(unittest.TestCase):
+  """Tests caching views by namespace
+  """
+  def check_invalidate(self, backend):
+    """Invalidating a namespace drops only what is cached in it
+    """
+    cache = ViewCache(backend, timeout = 60)
+    cache.set("teams", "page:1", "teams page")
+    cache.set("meets", "page:1", "meets page")
+    cache.invalidate("teams")
+    self.assertIsNone(cache.get("teams", "page:1"))
+    self.assertEqual(cache.get("meets", "page:1"), "meets page")
+    self.assertEqual(cache.memoize("teams", "page:1", lambda: "new page"),
+        "new page")
+    self.assertEqual(cache.get("teams", "page:1"), "new page")
+
+  def test_invalidate_memory(self):
+    """Namespaces are invalidated in memory
+    """
+    self.check_invalidate(MemoryBackend())
+
+  def test_invalidate_file(self):
+    """Namespaces are invalidated in files shared between processes
+    """
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    self.check_invalidate(FileBackend(directory))
+
+  def test_memory_bounded(self):
+    """Old generations and expired entries are dropped as entries
+    are set, but generation counters are kept
+    """
+    backend = MemoryBackend(max_entries = 3)
+    cache = ViewCache(backend, timeout = 60)
+    for page in range(3):
+      cache.set("teams", page, page)
+    cache.get("teams", 0)
+    cache.invalidate("teams")
+    cache.set("teams", 3, 3)
+    self.assertEqual(backend.entries.keys(),
+        ["teams:0:2", "teams:0:0", "teams:1:3"])
+    for page in range(10):
+      cache.set("meets", page, page)
+    self.assertEqual(len(backend.entries), 3)
+    self.assertEqual(backend.get("generation:teams"), 1)
+    backend = MemoryBackend()
+    backend.set("old", "value", -1)
+    backend.set("new", "value", 60)
+    self.assertEqual(backend.entries.keys(), ["new"])
+
+class HooksTest(unittest.TestCase):
+  """Tests registering the derived data hooks
+  """
+  def test_register(self):
+    """Each hook is registered once however often register is called
+    """
+    hooks.register()
+    hooks.register()
+    self.assertEqual(mongo_utilities.BUILD_HOOKS.count(
+      columnar.store_meet_columns), 1)
+    self.assertEqual(columnar.STORE_HOOKS, [course_model.update_model])
+
+class CodecTest(unittest.TestCase):
+  """Tests storing times and dates as numbers and datetimes
+  """
+  def test_decode_arrays(self):
+    """Rows decode to arrays, including times and dates stored as
+    strings before the migration
+    """
+    rows = [
+        {"time": 144067, "place": 1, "date": datetime.datetime(2012, 11, 3)},
+        {"time": "0:24:02.92", "place": None, "date": "2012-11-04"}]
+    arrays = mongo_utilities.decode_arrays(rows)
+    self.assertEqual(arrays["time"].tolist(), [144067, 144292])
+    self.assertEqual(arrays["place"].tolist(), [1, -1])
+    self.assertEqual(arrays["date"].astype(str).tolist(),
+        ["2012-11-03", "2012-11-04"])
+    self.assertEqual(mongo_utilities.time_to_centiseconds(
+      datetime.timedelta(minutes = 24, seconds = 0.67)), 144067)
+
+class ColumnarTest(unittest.TestCase):
+  """Tests the packed results columns
+  """
+  def test_team_averages(self):
+    """Only each team's top finishers count toward its average
+    """
+    a, b = ObjectId(), ObjectId()
+    meet = columnar.MeetColumns(ObjectId(), "2013-09-01",
+        np.array([900., 910., 920., 930., 940.]),
+        columnar.pack_ids([ObjectId() for _ in range(5)]),
+        columnar.pack_ids([a, b, a, a, b]))
+    stored = columnar.MeetColumns.from_document(meet.to_document())
+    self.assertEqual(columnar.unpack_id(stored.team_ids[1]), b)
+    season = columnar.Season([stored])
+    meets, teams, averages = columnar.team_averages(season, top = 2)
+    averages = dict(zip(teams, averages))
+    self.assertEqual(averages[season.team_code(a)], 910.)
+    self.assertEqual(averages[season.team_code(b)], 925.)
+
+class ScoringTest(unittest.TestCase):
+  """Tests cross country team scoring
+  """
+  def test_displacers_and_incomplete_teams(self):
+    """Incomplete teams and 8th runners are removed before placing,
+    and 6th runners displace without scoring
+    """
+    rows = [{"team_id": team, "team": team} for team in
+        "ABCABABACBABABABA"] + [{"team_id": None}]
+    standings = scoring.score_results(rows)
+    self.assertEqual([team["team"] for team in standings], ["A", "B"])
+    self.assertEqual(standings[0]["scorers"], [1, 3, 5, 7, 9])
+    self.assertEqual(standings[0]["score"], 25)
+    self.assertEqual(standings[1]["score"], 30)
+    self.assertEqual([row["team_place"] for row in rows if
+      row["team_id"] == "A"], [1, 3, 5, 7, 9, 11, 13, None])
+    self.assertIsNone(rows[2]["team_place"])
+    self.assertIsNone(rows[-1]["team_place"])
+
+  def test_sixth_runner_breaks_ties(self):
+    """Equal scores go to the team with the better 6th runner
+    """
+    scores = scoring.score_races([[0, 0, 1, 1, 0, 1, 1, 1, 0, 1, 0, 0]], 2)
+    self.assertEqual(list(scores.score[0]), [28., 28.])
+    self.assertEqual(list(scores.winners()), [1])
+
+class PredictionsTest(unittest.TestCase):
+  """Tests meet simulation
+  """
+  def test_simulate(self):
+    """A much faster team wins nearly every simulated race
+    """
+    means = np.r_[np.full(5, 900.), np.full(5, 1000.), np.full(5, 1005.)]
+    teams = np.repeat(np.arange(3), 5)
+    wins, podiums, places = predictions.simulate(means, np.full(15, .01),
+        teams, 3, 2000, seed = 1)
+    self.assertEqual(wins[0], 2000)
+    self.assertEqual(list(podiums), [2000]*3)
+    self.assertTrue(places[1] < places[2])
+    self.assertEqual(places.sum(), 2000*6)
+
+  def test_models_follow_course_model(self):
+    """Cached runner models are fitted again once the course model
+    changes
+    """
+    course_id = ObjectId()
+    runner_ids = [ObjectId() for _ in range(2)]
+    season = columnar.Season([columnar.MeetColumns(ObjectId(),
+      "2013-09-01", np.array([900., 930.]), columnar.pack_ids(runner_ids),
+      columnar.pack_ids([ObjectId()]*2), course_id)])
+    means, _ = predictions.runner_models(season, runner_ids, {}, 1)
+    self.assertEqual(list(means), [900., 930.])
+    means, _ = predictions.runner_models(season, runner_ids,
+        {course_id: 1.5}, 2)
+    self.assertEqual(list(means), [600., 620.])
+
+class CourseModelTest(unittest.TestCase):
+  """Tests the course difficulty model
+  """
+  def test_offsets_and_updates(self):
+    """Shared runners relate courses, and replacing a meet's results
+    undoes its old contribution
+    """
+    flat, hilly = ObjectId(), ObjectId()
+    runners = columnar.pack_ids([ObjectId() for _ in range(3)])
+    teams = columnar.pack_ids([ObjectId()]*3)
+    seconds = np.array([900., 930., 960.])
+    model = course_model.CourseModel()
+    model.update([], [
+      columnar.MeetColumns(ObjectId(), "2013-09-01", seconds, runners,
+        teams, flat),
+      columnar.MeetColumns(ObjectId(), "2013-09-08", seconds*1.1, runners,
+        teams, hilly)])
+    factors = model.factors(ridge = 1e-9)
+    self.assertAlmostEqual(factors[hilly]/factors[flat], 1.1)
+    meet = columnar.MeetColumns(ObjectId(), "2013-09-15", seconds*1.2,
+        runners, teams, hilly)
+    model.update([], [meet])
+    model.update([meet], [])
+    self.assertAlmostEqual(model.factors(ridge = 1e-9)[hilly]/
+        model.factors(ridge = 1e-9)[flat], 1.1)
+
+class SimilarityTest(unittest.TestCase):
+  """Tests name matching for duplicate runners and teams
+  """
+  def test_blocking_keys(self):
+    """Spelling variants and swapped names share a blocking key
+    """
+    self.assertEqual(similarity.soundex("Robert"), "R163")
+    self.assertEqual(similarity.soundex("Rupert"), "R163")
+    self.assertEqual(similarity.team_block_keys("Brown Univ."),
+        similarity.team_block_keys("Brown University"))
+    self.assertEqual(similarity.runner_block_keys("Nick", "King", 1),
+        similarity.runner_block_keys("King", "Nick", 1))
+
+  def test_scores(self):
+    """Swaps and misspellings score high, other names and class
+    years lower
+    """
+    self.assertEqual(similarity.runner_similarity(("Nick", "King", 2015),
+      ("King", "Nick", 2015)), 1.)
+    self.assertTrue(similarity.runner_similarity(("Nik", "King", 2015),
+      ("Nick", "King", 2015)) > 0.95)
+    self.assertTrue(similarity.runner_similarity(("Nick", "King", 2015),
+      ("Nick", "King", 2016)) < 0.95)
+    self.assertTrue(similarity.runner_similarity(("Dan", "Hill", 2015),
+      ("Sam", "Hill", 2015)) < 0.85)
+    self.assertEqual(similarity.team_similarity("Brown Univ",
+      "Brown University"), 1.)
+    self.assertTrue(similarity.team_similarity("Boston College",
+      "Boston University") < 0.85)
+
+  def test_same(self):
+    """Only differences of case, punctuation, abbreviation and name
+    order make the same runner or team
+    """
+    self.assertTrue(similarity.same_runner(("Jo", "O'Brien", 2014),
+      ("obrien", "jo", None)))
+    self.assertFalse(similarity.same_runner(("Chris", "Hill", None),
+      ("Christine", "Hill", None)))
+    self.assertFalse(similarity.same_runner(("Jo", "Hill", 2014),
+      ("Jo", "Hill", 2015)))
+    self.assertTrue(similarity.same_team("Brown Univ.", "brown university"))
+    self.assertFalse(similarity.same_team("Boston University B",
+      "Boston University"))
+
+class InstrumentationTest(unittest.TestCase):
+  """Tests spans and mongo call counts
+  """
+  def test_trace(self):
+    """A trace collects the spans and collection calls made in it
+    """
+    database = mongo_utilities.DB
+    database["things"].remove()
+    with instrumentation.trace("test") as trace:
+      with instrumentation.span("insert"):
+        database["things"].insert([{"a": 1}, {"a": 2}])
+      database["things"].find_one({"a": 2})
+      database["things"].find_one({"a": 3})
+    report = trace.report()
+    self.assertEqual(report["mongo"], {"things": {"insert": 1,
+      "find_one": 2}})
+    self.assertEqual(report["spans"].keys(), ["insert"])
+    self.assertTrue(report["seconds"] >= report["spans"]["insert"])
+    self.assertIsNone(instrumentation.current())
+    database["things"].drop()
+
+class SplitRacesTest(unittest.TestCase):
+  """Tests finding every race in a combined result file
+  """
+  def test_split_races(self):
+    """Places restarting at 1 start a new race, and team scores and
+    short runs are left out
+    """
+    def race(count, name):
+      return ["%d %s runner%d team%d 2%d:00" % (place, name, place,
+        place % 3, place % 10) for place in range(1, count + 1)]
+    lines = (["Men's 8K", "Pl Name Team Time", "== ==== ==== ===="] +
+        race(20, "joe") +
+        ["Team Scores"] + race(15, "team") +
+        ["Open Race"] + race(5, "sam") +
+        ["Women's 6K"] + race(parser.RUN_LENGTH, "ann"))
+    races = list(parser.split_races(lines, parser.LineTokens))
+    self.assertEqual([(title, len(results)) for
+      title, _, results in races],
+      [("men's 8k", 20), ("women's 6k", parser.RUN_LENGTH)])
+    self.assertEqual(races[0][1], ["pl name team time", "== ==== ==== ===="])
+    self.assertEqual(parser.race_name("ECAC", races[0][0], 1),
+        "ECAC - Men's 8k")
+
+  def test_titles(self):
+    """A race without a title of its own does not take the one before
+    it, and titles that repeat are numbered
+    """
+    def race(name):
+      return ["%d %s runner%d 2%d:00" % (place, name, place, place % 10) for
+          place in range(1, parser.RUN_LENGTH + 1)]
+    lines = (["5K Run"] + race("joe") + race("sam") + ["5K Run"] +
+        race("ann"))
+    races = list(parser.split_races(lines, parser.LineTokens))
+    self.assertEqual([title for title, _, _ in races],
+        ["5k run", None, "5k run"])
+    self.assertEqual([name for name, _, _, _ in
+      parser.named_races("Opener", races)],
+        ["Opener - 5k Run", "Opener - Race 2", "Opener - 5k Run (2)"])
+    self.assertEqual([name for name, _, _, _ in
+      parser.named_races("Opener", races[1:2])], ["Opener"])
+
+def store_meet(name, date, rows):
+  """Stores a meet of (first_name, last_name, team, seconds) rows in
+  finishing order and builds its results documents.  Returns the meet
+  id and the runner ids
+  """
+  meet_id = mongo_utilities.create_meet(name, date = date)
+  ids = mongo_utilities.create_runners([(first_name, last_name, team,
+    2014) for first_name, last_name, team, _ in rows])
+  mongo_utilities.add_results(*[{"meet_id": meet_id, "runner_id": runner_id,
+    "team_id": team_id, "place": place, "date": date,
+    "time": datetime.timedelta(seconds = row[3]),
+    "raw_data": "%d %s %s" % (place, row[0], row[1])} for
+    place, (row, (runner_id, team_id)) in enumerate(zip(rows, ids), 1)])
+  mongo_utilities.build_meet_results(meet_id)
+  return meet_id, [runner_id for runner_id, _ in ids]
+
+def meet_lines(titles = ("Men", "Women", "JV")):
+  """Returns the lines of a result file with a race for each title
+  """
+  lines = []
+  for title, team in zip(titles, ["harvard", "yale", "brown"]):
+    lines.append(title)
+    lines.extend("%2d %-12s %-8s 2%d:1%d" % (place, ["sam", "jo", "ann",
+      "tim"][place % 4] + " " + ["hill", "king", "cook", "li"][place % 3],
+      team, place % 10, place % 7) for
+      place in range(1, parser.RUN_LENGTH + 1))
+  return lines
+
+class MeetResultsTest(DatabaseTest):
+  """Tests the denormalized results document of each meet
+  """
+  def test_build_and_merge(self):
+    """Rows are in place order with names filled in, and follow
+    runners and teams through merges
+    """
+    date = datetime.date(2013, 9, 7)
+    meet_id, (joe_id, sam_id, joey_id) = store_meet("Opener", date,
+        [("joe", "smith", "Harvard", 900), ("sam", "hill", "Yale", 910),
+          ("joey", "smith", "Harvard Univ", 920)])
+    rows = mongo_utilities.get_meet_results(meet_id)
+    self.assertEqual([(row["place"], row["runner"], row["team"],
+      row["time"], row["date"]) for row in rows],
+      [(1, "Joe Smith", "Harvard", 90000, date),
+        (2, "Sam Hill", "Yale", 91000, date),
+        (3, "Joey Smith", "Harvard Univ", 92000, date)])
+    mongo_utilities.merge_runners(joe_id, joey_id)
+    mongo_utilities.merge_teams(rows[0]["team_id"], rows[2]["team_id"])
+    rows = mongo_utilities.get_meet_results(meet_id)
+    self.assertEqual([(row["runner_id"], row["team"]) for row in rows],
+        [(joe_id, "Harvard"), (sam_id, "Yale"), (joe_id, "Harvard")])
+    mongo_utilities.update_runner(sam_id, display_name = "Samuel Hill")
+    self.assertEqual(mongo_utilities.get_meet_results(meet_id)[1]["runner"],
+        "Samuel Hill")
+
+  def test_built_on_read(self):
+    """A meet whose document is missing is built when it is read
+    """
+    meet_id, _ = store_meet("Opener", datetime.date(2013, 9, 7),
+        [("joe", "smith", "Harvard", 900)])
+    mongo_utilities.DB["meet_results"].remove()
+    self.assertEqual([row["runner"] for row in
+      mongo_utilities.get_meet_results(meet_id)], ["Joe Smith"])
+    self.assertEqual(mongo_utilities.get_meet_results(ObjectId()), [])
+
+class RunnerHistoryTest(DatabaseTest):
+  """Tests the history document of each runner
+  """
+  def test_build_and_merge(self):
+    """Races are in date order with rolling averages and bests by
+    season, and a merged runner's races join the kept runner's
+    """
+    joe = ("joe", "smith", "Harvard")
+    for date, seconds in ((datetime.date(2013, 9, 21), 930),
+        (datetime.date(2012, 10, 6), 960), (datetime.date(2013, 9, 7), 900),
+        (datetime.date(2013, 10, 5), 990)):
+      _, (joe_id,) = store_meet("Meet %s" % date, date,
+          [joe + (seconds,)])
+    history = mongo_utilities.get_runner_history(joe_id)
+    self.assertEqual([(race["date"].date(), race["seconds"], race["rolling"])
+      for race in history["races"]],
+      [(datetime.date(2012, 10, 6), 960, 960),
+        (datetime.date(2013, 9, 7), 900, 930),
+        (datetime.date(2013, 9, 21), 930, 930),
+        (datetime.date(2013, 10, 5), 990, 940)])
+    self.assertEqual(history["season_bests"], [
+      {"season": "2012", "seconds": 960}, {"season": "2013", "seconds": 900}])
+    self.assertEqual((history["name"], history["team"], history["best"]),
+        ("Joe Smith", "Harvard", 900))
+
+    _, (joey_id,) = store_meet("Late", datetime.date(2013, 11, 2),
+        [("joey", "smith", "Harvard", 880)])
+    mongo_utilities.merge_runners(joe_id, joey_id)
+    history = mongo_utilities.get_runner_history(joe_id)
+    self.assertEqual([race["meet"] for race in history["races"]][-1], "Late")
+    self.assertEqual(history["best"], 880)
+    self.assertIsNone(mongo_utilities.DB["runner_history"].find_one(
+      {"_id": joey_id}))
+
+class DedupTest(DatabaseTest):
+  """Tests merging stored duplicates
+  """
+  def rename_runner(self, runner_id, first_name):
+    """Renames a stored runner without resolving it again, as data
+    stored before names were matched can hold
+    """
+    runner = mongo_utilities.DB[mongo_utilities.RUNNER_COLLECTION].find_one(
+        runner_id)
+    mongo_utilities.DB[mongo_utilities.RUNNER_COLLECTION].update(
+        {"_id": runner_id}, {"$set": {"first_name": first_name,
+          "block_keys": similarity.runner_block_keys(first_name,
+            runner["last_name"], runner["team_id"])}})
+
+  def team_id(self, runner_id):
+    """Returns the team of a stored runner
+    """
+    return mongo_utilities.DB[mongo_utilities.RUNNER_COLLECTION].find_one(
+        runner_id)["team_id"]
+
+  def rename_team(self, team_id, name):
+    """Renames a stored team without resolving it again
+    """
+    mongo_utilities.DB[mongo_utilities.TEAM_COLLECTION].update(
+        {"_id": team_id}, {"$set": {"alias": [name],
+          "block_keys": similarity.team_block_keys(name)}})
+
+  def test_merge_rebuilds_columns(self):
+    """Runners merged by dedup are merged in the stored meet columns
+    too once the hooks are registered
+    """
+    hooks.register()
+    first_id, (jonathan_id,) = store_meet("Opener",
+        datetime.date(2013, 9, 7), [("jonathan", "smith", "Bates", 900)])
+    second_id, (other_id,) = store_meet("Invite",
+        datetime.date(2013, 9, 14), [("jon", "smith", "Bates", 910)])
+    self.rename_runner(other_id, "Jonathan.")
+    self.assertEqual(dedup.dedup_runners(), (1, 0))
+    self.assertEqual([columnar.unpack_id(meet.runner_ids[0]) for meet in
+      columnar.load_meet_columns([first_id, second_id])],
+      [jonathan_id, jonathan_id])
+
+  def test_alike_runners_queued(self):
+    """Runners whose names are only alike are queued, not merged, and
+    the queue keeps them
+    """
+    _, (alex_id,) = store_meet("Opener", datetime.date(2013, 9, 7),
+        [("alex", "johnson", "Bates", 900)])
+    _, (other_id,) = store_meet("Invite", datetime.date(2013, 9, 14),
+        [("sam", "johnson", "Bates", 910)])
+    self.rename_runner(other_id, "alexa")
+    mongo_utilities.DB[mongo_utilities.MERGE_QUEUE_COLLECTION].remove()
+    self.assertEqual(dedup.dedup_runners(), (0, 1))
+    self.assertEqual(dedup.dedup_runners(), (0, 0))
+    self.assertEqual(mongo_utilities.DB[
+      mongo_utilities.RUNNER_COLLECTION].find(
+        {"_id": {"$in": [alex_id, other_id]}}).count(), 2)
+    self.assertEqual([(merge["keep_id"], merge["drop_id"]) for merge in
+      mongo_utilities.get_merge_queue()], [(alex_id, other_id)])
+
+  def test_alike_teams_queued(self):
+    """A team that differs by a letter is queued, not merged
+    """
+    _, (first_id,) = store_meet("Opener", datetime.date(2013, 9, 7),
+        [("alex", "johnson", "Boston University", 900)])
+    _, (second_id,) = store_meet("Invite", datetime.date(2013, 9, 14),
+        [("sam", "hill", "Colby", 910)])
+    university_id = self.team_id(first_id)
+    b_id = self.team_id(second_id)
+    self.rename_team(b_id, "Boston University B")
+    self.assertEqual(dedup.dedup_teams(), (0, 1))
+    self.assertEqual([(merge["keep_id"], merge["drop_id"]) for merge in
+      mongo_utilities.get_merge_queue()], [(university_id, b_id)])
+
+  def test_teams_in_one_meet(self):
+    """Teams with the same name are not merged if both raced in one
+    meet, and are queued instead
+    """
+    _, (first_id, second_id) = store_meet("Opener",
+        datetime.date(2013, 9, 7), [("alex", "johnson", "Bates", 900),
+          ("sam", "hill", "Colby", 910)])
+    bates_id = self.team_id(first_id)
+    colby_id = self.team_id(second_id)
+    self.rename_team(colby_id, "BATES.")
+    self.assertEqual(dedup.dedup_teams(), (0, 1))
+    self.assertEqual(mongo_utilities.DB[
+      mongo_utilities.TEAM_COLLECTION].find(
+        {"_id": {"$in": [bates_id, colby_id]}}).count(), 2)
+
+class PageTest(DatabaseTest):
+  """Tests keyset pagination
+  """
+  def pages(self, get_page, limit):
+    """Returns every page from get_page(after, limit)
+    """
+    pages = []
+    after = None
+    while True:
+      page, after = get_page(after, limit)
+      pages.append(page)
+      if after is None:
+        return pages
+
+  def test_equal_sort_keys(self):
+    """Documents with equal sort values on either side of a page
+    boundary are each listed once, ordered by id
+    """
+    team_ids = [mongo_utilities.DB["teams"].insert({"name": name,
+      "alias": [name.lower() + str(j)]}) for
+      j, name in enumerate(["Yale", "Bates", "Yale", "Bates", "Yale"])]
+    pages = self.pages(mongo_utilities.get_teams_page, 2)
+    self.assertEqual([[team["_id"] for team in page] for page in pages],
+        [[team_ids[1], team_ids[3]], [team_ids[0], team_ids[2]],
+          [team_ids[4]]])
+
+  def test_descending_dates(self):
+    """Meets are listed newest first, meets on the same day newest
+    added first, and a last full page has no next token
+    """
+    dates = [datetime.date(2013, 9, day) for day in (7, 14, 14, 14)]
+    meet_ids = [mongo_utilities.create_meet("Meet", date = date) for
+        date in dates]
+    pages = self.pages(mongo_utilities.get_meets_page, 2)
+    self.assertEqual([[meet["_id"] for meet in page] for page in pages],
+        [[meet_ids[3], meet_ids[2]], [meet_ids[1], meet_ids[0]]])
+    self.assertEqual(pages[1][1]["date"], dates[0])
+
+  def test_bad_token(self):
+    """A malformed token starts from the first page
+    """
+    team_id = mongo_utilities.DB["teams"].insert({"name": "Bates",
+      "alias": ["bates"]})
+    page, after = mongo_utilities.get_teams_page("not a token", 2)
+    self.assertEqual([team["_id"] for team in page], [team_id])
+    self.assertIsNone(after)
+
+class ResolveRunnersTest(DatabaseTest):
+  """Tests resolving the runners of a race in bulk
+  """
+  def test_create_runners(self):
+    """Runners and teams resolve to the same ids on every upload,
+    with or without the identity caches
+    """
+    runners = [("joe", "smith", "Harvard", 2014),
+        ("sam", "hill", "Yale", None), ("ann", "ward", "harvard", 2015)]
+    ids = mongo_utilities.create_runners(runners)
+    self.assertEqual(ids[0][1], ids[2][1])
+    self.assertEqual(len(set(ids)), 3)
+    identity_cache.clear()
+    self.assertEqual(mongo_utilities.create_runners(runners[::-1]),
+        ids[::-1])
+    self.assertEqual(mongo_utilities.DB["runners"].count(), 3)
+    self.assertEqual(mongo_utilities.DB["teams"].count(), 2)
+
+  def test_only_same_names_merged(self):
+    """New names are merged with stored ones only if they differ in
+    spelling or order, and alike names are queued for review
+    """
+    (alex_id, bu_id), = mongo_utilities.create_runners(
+        [("alex", "johnson", "Boston University", 2014)])
+    identity_cache.clear()
+    ids = mongo_utilities.create_runners([("johnson", "alex", "boston univ.",
+      2014), ("alexa", "johnson", "Boston University", 2014),
+      ("alex", "johnson", "Boston University B", 2014)])
+    self.assertEqual(ids[0], (alex_id, bu_id))
+    self.assertNotEqual(ids[1][0], alex_id)
+    self.assertNotEqual(ids[2][1], bu_id)
+    queued = [(merge["keep_id"], merge["drop_id"]) for
+        merge in mongo_utilities.get_merge_queue()]
+    self.assertIn((alex_id, ids[1][0]), queued)
+    self.assertIn((bu_id, ids[2][1]), queued)
+
+  def test_merge_in_other_process(self):
+    """Cached ids are dropped once another process merges runners
+    """
+    (keep_id, _), (drop_id, _) = mongo_utilities.create_runners(
+        [("sam", "hill", "Bates", 2014), ("samuel", "hill", "Bates", 2014)])
+    # As another process would: merge without touching our caches
+    mongo_utilities.DB["runners"].remove({"_id": drop_id})
+    mongo_utilities.DB["runners"].update({"_id": keep_id},
+        {"$set": {"first_name": "Samuel"}})
+    mongo_utilities.bump_identity_generation()
+    self.assertEqual(mongo_utilities.create_runners(
+      [("samuel", "hill", "Bates", 2014)])[0][0], keep_id)
+
+  def test_cached_lookups(self):
+    """Cached runners and teams resolve without a database call, and
+    the identity generation is only read again once it is stale
+    """
+    rows = [(first, last, team, 2014) for first, last, team in [
+      ("sam", "hill", "Bates"), ("jo", "king", "Colby"),
+      ("ann", "cook", "Bates"), ("tim", "ward", "Bowdoin"),
+      ("liz", "moss", "Colby")]]
+    ids = mongo_utilities.create_runners(rows)
+    with instrumentation.trace("test") as trace:
+      for _ in range(2):
+        self.assertEqual([(mongo_utilities.create_runner(*row),
+          mongo_utilities.create_team(row[2])) for row in rows], ids)
+    self.assertEqual(trace.report()["mongo"], {})
+    identity_cache.GENERATION["checked"] = 0.
+    with instrumentation.trace("test") as trace:
+      for row in rows:
+        mongo_utilities.create_runner(*row)
+    self.assertEqual(trace.report()["mongo"], {"counters": {"find_one": 1}})
+
+  def test_insert_new_after_race(self):
+    """A runner another worker inserted first is looked up instead
+    of failing the batch
+    """
+    team_id = mongo_utilities.create_team("Bates")
+    def runner(first_name):
+      return {"first_name": first_name, "last_name": "Hill",
+          "team_id": team_id, "class_year": 2014}
+    def query(doc):
+      return dict((field, doc[field]) for field in
+          ["first_name", "last_name", "team_id", "class_year"])
+    stored_id = mongo_utilities.DB["runners"].insert(runner("Sam"))
+    ids = mongo_utilities.insert_new("runners",
+        [runner("Sam"), runner("Jo")], query)
+    self.assertEqual(ids[0], stored_id)
+    self.assertEqual(mongo_utilities.DB["runners"].find_one(
+      {"_id": ids[1]})["first_name"], "Jo")
+    self.assertEqual(mongo_utilities.DB["runners"].count(), 2)
+
+class IndexTest(DatabaseTest):
+  """Tests creating the indexes
+  """
+  def test_duplicates_reported(self):
+    """A unique index over duplicates is reported, not raised, and
+    the other indexes are still created
+    """
+    mongo_utilities.CLIENT.drop_database(mongo_utilities.DBNAME + "_test")
+    team_id = ObjectId()
+    for _ in range(2):
+      mongo_utilities.DB["runners"].insert({"first_name": "Sam",
+        "last_name": "Hill", "team_id": team_id, "class_year": 2014})
+    report = mongo_utilities.ensure_indexes()["runners"]
+    self.assertEqual([name for name, _ in report["failed"]],
+        ["team_id_1_last_name_1_first_name_1_class_year_1"])
+    self.assertEqual(report["created"], ["block_keys_1"])
+
+class IngestionQueueTest(DatabaseTest):
+  """Tests picking up ingestion jobs after a restart
+  """
+  def test_recover(self):
+    """Queued and interrupted jobs are queued again once, and jobs
+    whose upload is gone fail
+    """
+    buff, path = tempfile.mkstemp()
+    os.close(buff)
+    self.addCleanup(os.remove, path)
+    date = datetime.date(2012, 11, 3)
+    queued_id = mongo_utilities.create_job(meetname = "a", date = date,
+        path = path)
+    running_id = mongo_utilities.create_job(meetname = "b", date = date,
+        url = "http://example.com", status = "running")
+    missing_id = mongo_utilities.create_job(meetname = "c", date = date,
+        path = path + ".gone")
+    queue = IngestionQueue(workers = 0)
+    self.assertEqual(queue.recover(), 2)
+    self.assertEqual([queue.queue.get(), queue.queue.get()],
+        [queued_id, running_id])
+    self.assertEqual(mongo_utilities.get_job(missing_id)["status"], "failed")
+    self.assertEqual(mongo_utilities.claim_job(running_id)["status"],
+        "running")
+    self.assertIsNone(mongo_utilities.claim_job(running_id))
+
+  def test_worker_survives(self):
+    """A job failing outside the parse is marked failed, and the
+    worker goes on to the next job
+    """
+    paths = []
+    for _ in range(2):
+      buff, path = tempfile.mkstemp()
+      os.write(buff, "\n".join(meet_lines()))
+      os.close(buff)
+      self.addCleanup(os.remove, path)
+      paths.append(path)
+    set_ingestion_report = mongo_utilities.set_ingestion_report
+    def fail_once(meet_ids, report):
+      """Fails the first report and saves the others
+      """
+      mongo_utilities.set_ingestion_report = set_ingestion_report
+      raise RuntimeError("report failed")
+    mongo_utilities.set_ingestion_report = fail_once
+    self.addCleanup(setattr, mongo_utilities, "set_ingestion_report",
+        set_ingestion_report)
+    date = datetime.date(2012, 11, 3)
+    queue = IngestionQueue(workers = 1)
+    first_id = queue.submit("Opener", date, path = paths[0])
+    second_id = queue.submit("Invite", date, path = paths[1])
+    queue.queue.join()
+    self.assertEqual(mongo_utilities.get_job(first_id)["status"], "failed")
+    self.assertEqual(mongo_utilities.get_job(first_id)["error"],
+        "report failed")
+    self.assertEqual(mongo_utilities.get_job(second_id)["status"], "done")
+
+class MeetParserTest(DatabaseTest):
+  """Tests saving the races of a file as meets
+  """
+  date = datetime.date(2012, 11, 3)
+
+  def setUp(self):
+    """Save the races two to a batch
+    """
+    DatabaseTest.setUp(self)
+    batch_lines = parser.BATCH_LINES
+    parser.BATCH_LINES = 2*parser.RUN_LENGTH
+    self.addCleanup(setattr, parser, "BATCH_LINES", batch_lines)
+
+  def test_batches(self):
+    """Races saved a batch at a time in a pool are all stored and
+    written out, and an identical upload changes nothing
+    """
+    buff, path = tempfile.mkstemp()
+    os.close(buff)
+    self.addCleanup(os.remove, path)
+    meet = parser.MeetParser("Opener", self.date, lines = meet_lines(),
+        processes = 2, output = path)
+    self.assertEqual([name for name, _ in meet.races],
+        ["Opener - Men", "Opener - Women", "Opener - Jv"])
+    self.assertEqual(meet.saved, 3*parser.RUN_LENGTH)
+    self.assertEqual(len(set(meet.saved_ids)), 3)
+    with open(path) as output:
+      self.assertEqual(output.read().count("Result:"), 3*parser.RUN_LENGTH)
+    again = parser.MeetParser("Opener", self.date, lines = meet_lines())
+    self.assertEqual(again.get_ids(), meet.get_ids())
+    self.assertEqual(again.saved, 0)
+    self.assertEqual([change["status"] for change in again.changes],
+        ["unchanged"]*3)
+
+  def test_reads_lazily(self):
+    """A batch of races is saved before the rest of the file is read
+    """
+    stored = []
+    def lines():
+      """Yields the lines of a file, noting the results stored so far
+      """
+      for line in meet_lines():
+        stored.append(mongo_utilities.DB[
+          mongo_utilities.RESULT_COLLECTION].find().count())
+        yield line
+    meet = parser.MeetParser("Opener", self.date, lines = lines())
+    self.assertEqual(max(stored), 2*parser.RUN_LENGTH)
+    self.assertEqual(meet.saved, 3*parser.RUN_LENGTH)
+
+  def test_repeated_titles(self):
+    """Races with the same title are saved as separate meets, and
+    uploading them again changes nothing
+    """
+    titles = ["5K Run", "5K Run", "5K Run (2)"]
+    meet = parser.MeetParser("Opener", self.date, lines = meet_lines(titles))
+    self.assertEqual([name for name, _ in meet.races], ["Opener - 5k Run",
+      "Opener - 5k Run (2)", "Opener - 5k Run (2) (2)"])
+    self.assertEqual([len(mongo_utilities.get_result_lines(meet_id)) for
+      meet_id in meet.get_ids()], [parser.RUN_LENGTH]*3)
+    again = parser.MeetParser("Opener", self.date,
+        lines = meet_lines(titles))
+    self.assertEqual(again.get_ids(), meet.get_ids())
+    self.assertEqual(again.saved, 0)
+
+  def test_stored_twice(self):
+    """A name stored as two meets is matched to the older one
+    """
+    older = mongo_utilities.create_meet("Opener - Men", date = self.date)
+    mongo_utilities.create_meet("Opener - Men", date = self.date)
+    meet = parser.MeetParser("Opener", self.date, lines = meet_lines())
+    self.assertEqual(meet.get_id(), older)
+    self.assertEqual(meet.changes[0]["status"], "updated")
+
+  def test_failed_save(self):
+    """A race whose read models fail to build is saved again by the
+    next upload rather than found unchanged
+    """
+    def fail(*meet_ids):
+      raise RuntimeError("build failed")
+    build_meet_results = mongo_utilities.build_meet_results
+    mongo_utilities.build_meet_results = fail
+    try:
+      self.assertRaises(RuntimeError, parser.MeetParser, "Opener",
+          self.date, lines = meet_lines())
+    finally:
+      mongo_utilities.build_meet_results = build_meet_results
+    meet = parser.MeetParser("Opener", self.date, lines = meet_lines())
+    # The first batch failed, so the last race was never stored
+    self.assertEqual([change["status"] for change in meet.changes],
+        ["updated", "updated", "created"])
+    self.assertEqual(meet.saved, parser.RUN_LENGTH)
+    self.assertIsNotNone(mongo_utilities.DB[
+      mongo_utilities.MEET_RESULT_COLLECTION].find_one(meet.get_id()))
+
+class StreamingParserTest(DatabaseTest):
+  """Tests parsing a result file in two passes
+  """
+  date = datetime.date(2012, 11, 3)
+
+  def test_saved_in_batches(self):
+    """Every result of a line iterator is saved and written out, and
+    results are only kept a batch at a time
+    """
+    count = 40
+    lines = ["Results"] + ["%2d %-12s %-8s 2%d:1%d" % (place, ["sam", "jo",
+      "ann", "tim"][place % 4] + " " + ["hill", "king", "cook"][place % 3],
+      ["bates", "colby"][place % 2], place % 10, place % 7) for
+      place in range(1, count + 1)]
+    buff, path = tempfile.mkstemp()
+    os.close(buff)
+    self.addCleanup(os.remove, path)
+    streaming = parser.StreamingParser("Opener", self.date, iter(lines),
+        path = path, batch_size = 5)
+    self.assertEqual(len(mongo_utilities.get_meet_results(
+      streaming.get_id())), count)
+    with open(path) as output:
+      saved = output.read()
+    self.assertEqual(saved.count("Result:"), count)
+    streaming.write(path)
+    with open(path) as output:
+      self.assertEqual(output.read(), saved)
+    alive = []
+    kept = 0
+    for result in streaming.iter_results():
+      alive = [ref for ref in alive if ref() is not None]
+      alive.append(weakref.ref(result))
+      kept = max(kept, len(alive))
+    self.assertLessEqual(kept, 2*5)
+
+class DiffLinesTest(unittest.TestCase):
+  """Tests diffing a revised race against its stored results
+  """
+  def test_diff_lines(self):
+    """Only changed lines are added or removed, ignoring spacing
+    """
+    stored = [(1, "1 joe smith  24:00"), (2, "2 sam hill 24:10"),
+        (3, "2 sam hill 24:10")]
+    added, removed = parser.diff_lines(stored,
+        ["1 joe   smith 24:00", "2 sam hill 24:10", "3 dan hill 24:20"])
+    self.assertEqual(added, ["3 dan hill 24:20"])
+    self.assertEqual(removed, [3])
+
+class LayoutTest(unittest.TestCase):
+  """Tests learning a race's column layout
+  """
+  def test_learn_and_extract(self):
+    """A layout agreeing with the heuristic parser is learned, and
+    reads fields that run over into the next column
+    """
+    header = ["pl name                yr team          time",
+        "== =================== == ============= ======="]
+    lines = ["%2d %-19s %-2s %-13s %7s" % (place, "sam " + ["hill",
+      "king", "cook", "ward"][place % 4], ["fr", "so", "jr", "sr"][
+        place % 4], "bates college", "2%d:1%d.0" % (place % 10,
+          place % 10)) for place in range(1, 21)]
+    date = datetime.date(2012, 11, 3)
+    race_layout = layout.Layout.from_header(header)
+    _, _, learned = parser.parse_race((date, lines, None, race_layout))
+    self.assertIs(learned, race_layout)
+    self.assertEqual(learned.name_format, "first_last")
+    self.assertEqual(learned.extract("21 %-19s jr %s 25:10.0" % (
+      "sam hill", "boston university"), parser.class_year_words(date))[2],
+      ("sam", "hill", "boston university", 2014))
+
+class FixedWidthTest(unittest.TestCase):
+  """Tests finding columns from how result lines line up
+  """
+  date = datetime.date(2012, 11, 3)
+
+  def lines(self):
+    """Returns the lines of a race whose teams run past their column
+    """
+    names = ["hill, sam", "o'brien, jo", "king, alexander", "li, ann",
+        "ward, tim"]
+    teams = ["bates", "holy cross", "boston university"]
+    return ["%3d %-16s %-2s %-14s %7s %6s" % (place, names[place % 5],
+      ["fr", "so", "jr", "sr"][place % 4], teams[place % 3],
+      "2%d:1%d.0" % (place % 10, place % 10), "4:5%d.1" % (place % 10))
+      for place in range(1, layout.VERIFY_SAMPLE + 2)]
+
+  def test_detect_and_fields(self):
+    """Columns after a team that runs long are found from the end
+    of the line, and each column gets its role from its values
+    """
+    lines = self.lines()
+    columns = fixed_width.Columns.detect(lines,
+        parser.class_year_words(self.date))
+    self.assertEqual(columns.roles,
+        ["place", "name", "class", "team", "time", "split"])
+    fields = columns.fields(lines[1])
+    self.assertEqual((fields["place"], fields["firstname"],
+      fields["lastname"], fields["team"], fields["class_year"]),
+      (2, "alexander", "king", "boston university", 2014))
+    self.assertEqual(fields["time"], datetime.timedelta(0, 1332))
+    self.assertEqual(fields["splits"], [datetime.timedelta(0, 292.1)])
+
+  def test_race_parser(self):
+    """RaceParser reads a race by its columns without analyzing it,
+    and gets what the heuristic parser does
+    """
+    race = parser.RaceParser(self.date, self.lines())
+    self.assertIsNotNone(race.columns)
+    results, runners = race.parse()
+    self.assertFalse(race.analyzed)
+    heuristic_results, heuristic_runners = parser.RaceParser(self.date,
+        self.lines(), detect = False).parse()
+    self.assertEqual(runners, heuristic_runners)
+    self.assertEqual([(result.data["place"], result.data["time"]) for
+      result in results], [(result.data["place"], result.data["time"]) for
+        result in heuristic_results])
+
+class ResultTextExtractorTest(unittest.TestCase):
+  """Tests pulling result lines out of html as it streams in
+  """
+  PAGE = (u"<html><head><script>var s = '<pre>1 no one 9:00</pre>';"
+      u"</script><style>pre {}</style></head><body>Results<br>"
+      u"Ladies &amp; Gents<pre>\n 1 Jo O&#39;Brien  Bates &amp; Co 24:10\n"
+      u" 2 Sam Hill     Yale 24:12\n</pre><p>notes</p><pre>\n"
+      u" 1 Ann Lee      Tufts 18:00\n</pre></body></html>")
+
+  def test_pre_blocks(self):
+    """Only <pre> blocks are kept once there is one, with scripts left
+    out and entities written out
+    """
+    self.assertEqual([line for line in parser.iter_lines([self.PAGE]) if
+      line], [u" 1 Jo O'Brien  Bates & Co 24:10",
+        u" 2 Sam Hill     Yale 24:12", u" 1 Ann Lee      Tufts 18:00"])
+
+  def test_chunk_boundaries(self):
+    """Tags, entities and lines split between chunks read the same as
+    the whole page
+    """
+    whole = list(parser.iter_lines([self.PAGE]))
+    for size in (1, 2, 5):
+      self.assertEqual(list(parser.iter_lines(self.PAGE[j:j + size] for
+        j in range(0, len(self.PAGE), size))), whole)
+
+  def test_br_lines(self):
+    """Pages without <pre> blocks are split on <br> tags
+    """
+    page = u"1 jo hill 24:10<br>2 sam&nbsp;ward 24:11<br/>3 ann lee 25:00"
+    self.assertEqual(list(parser.iter_lines(page[j:j + 3] for
+      j in range(0, len(page), 3))),
+      [u"1 jo hill 24:10", u"2 sam\xa0ward 24:11", u"3 ann lee 25:00"])
+
+  def test_malformed_markup(self):
+    """Marked sections HTMLParser cannot read and a reference cut off
+    by the end of the page are skipped, whole or in chunks
+    """
+    page = (u"<html><![foo[ x ]]><body><![ [x]]>Results<pre>\n"
+        u" 1 Jo Hill  Bates 24:10\n</pre><p>&a")
+    for size in (len(page), 1, 4):
+      self.assertEqual([line for line in parser.iter_lines(page[j:j + size]
+        for j in range(0, len(page), size)) if line],
+        [u" 1 Jo Hill  Bates 24:10"])
+
+class ResultPageHandler(BaseHTTPRequestHandler):
+  """Serves result pages for the importer tests.  /flaky fails
+  once before it works
+  """
+  requests = {}
+
+  def do_GET(self):
+    """Answers a request
+    """
+    count = self.requests[self.path] = self.requests.get(self.path, 0) + 1
+    if self.path == "/missing" or (self.path == "/flaky" and count == 1):
+      self.send_response(404 if self.path == "/missing" else 503)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html")
+    self.end_headers()
+    self.wfile.write("<html><pre>1 john smith harvard 24:10</pre></html>")
+
+  def log_message(self, *args):
+    """Keeps test output quiet
+    """
+    pass
+
+class ImporterTest(unittest.TestCase):
+  """Tests fetching result pages from a local server
+  """
+  def setUp(self):
+    """Start a server on a free port
+    """
+    ResultPageHandler.requests = {}
+    self.server = HTTPServer(("127.0.0.1", 0), ResultPageHandler)
+    self.url = "http://127.0.0.1:%d" % self.server.server_port
+    thread = threading.Thread(target = self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self):
+    """Stop the server
+    """
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_fetch_all(self):
+    """Server errors are retried and client errors are reported
+    """
+    importer = Importer(workers = 3, per_host = 2, backoff = 0)
+    reports = {report["url"].rsplit("/", 1)[1]: report for report in
+        importer.fetch_all(self.url + path for
+          path in ["/ok", "/flaky", "/missing"])}
+    self.assertEqual(reports["ok"]["lines"], ["1 john smith harvard 24:10"])
+    self.assertEqual(reports["flaky"]["attempts"], 2)
+    self.assertEqual(reports["flaky"]["lines"], reports["ok"]["lines"])
+    self.assertIsNone(reports["missing"]["lines"])
+    self.assertEqual(reports["missing"]["attempts"], 1)
+
+  def test_fetch_error(self):
+    """A page failing with something other than a request error is
+    reported, and the other pages still arrive
+    """
+    class BrokenCache:
+      """Fails to read /bad
+      """
+      def fetch(self, url, extract, session, timeout):
+        """Fetches url, raising for /bad
+        """
+        if url.endswith("/bad"):
+          raise ValueError("unreadable page")
+        return parser.fetch_lines(url, session, timeout)
+    importer = Importer(workers = 1, backoff = 0, cache = BrokenCache())
+    reports = {report["url"].rsplit("/", 1)[1]: report for report in
+        importer.fetch_all(self.url + path for path in ["/bad", "/ok"])}
+    self.assertEqual(reports["bad"]["error"],
+        "fetch failed: unreadable page")
+    self.assertEqual(reports["bad"]["attempts"], 1)
+    self.assertEqual(reports["ok"]["lines"], ["1 john smith harvard 24:10"])
+
+class VersionedPageHandler(BaseHTTPRequestHandler):
+  """Serves a page for each path with an ETag of its version,
+  answering 304 when the client has it
+  """
+  versions = {}
+  requests = []
+
+  def do_GET(self):
+    """Answers a request
+    """
+    self.requests.append((self.path, self.headers.get("If-None-Match")))
+    etag = '"%d"' % self.versions.get(self.path, 1)
+    if self.headers.get("If-None-Match") == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html; charset=utf-8")
+    self.send_header("ETag", etag)
+    self.end_headers()
+    self.wfile.write("<pre>%s\n1 jo hill 24:10 %s</pre>" % (self.path,
+      "x"*100))
+
+  def log_message(self, *args):
+    """Keeps test output quiet
+    """
+    pass
+
+class FetchCacheTest(unittest.TestCase):
+  """Tests caching extracted result pages on disk
+  """
+  def setUp(self):
+    """Start a server on a free port and make a cache directory
+    """
+    VersionedPageHandler.versions = {}
+    VersionedPageHandler.requests = []
+    self.server = HTTPServer(("127.0.0.1", 0), VersionedPageHandler)
+    self.url = "http://127.0.0.1:%d" % self.server.server_port
+    thread = threading.Thread(target = self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    """Stop the server and remove the cache
+    """
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def fetch(self, cache, path):
+    """Returns the lines of a page read through cache
+    """
+    return list(cache.fetch(self.url + path, parser.iter_lines))
+
+  def test_revalidate(self):
+    """Stale pages are revalidated with their ETag, fresh ones are
+    not requested, and changed ones are fetched again
+    """
+    cache = FetchCache(self.directory)
+    lines = self.fetch(cache, "/a")
+    self.assertEqual(lines[1][:15], "1 jo hill 24:10")
+    self.assertEqual(self.fetch(cache, "/a"), lines)
+    VersionedPageHandler.versions["/a"] = 2
+    self.fetch(cache, "/a")
+    self.fetch(cache, "/a")
+    self.assertEqual(VersionedPageHandler.requests, [("/a", None),
+      ("/a", '"1"'), ("/a", '"1"'), ("/a", '"2"')])
+    self.assertEqual(cache.stats(),
+        {"hits": 0, "revalidated": 2, "misses": 2})
+    cache.max_age = 60
+    self.assertEqual(self.fetch(cache, "/a"), lines)
+    self.assertEqual(len(VersionedPageHandler.requests), 4)
+    self.assertEqual(cache.stats()["hits"], 1)
+
+  def test_partial_read(self):
+    """A page read only in part is not cached
+    """
+    cache = FetchCache(self.directory)
+    next(cache.fetch(self.url + "/a", parser.iter_lines))
+    self.assertEqual(cache.load(self.url + "/a"), (None, None))
+    self.assertEqual(os.listdir(self.directory), [])
+
+  def test_evict(self):
+    """The least recently used pages are evicted past max_bytes
+    """
+    cache = FetchCache(self.directory, max_bytes = 500)
+    for path in ("/a", "/b", "/c"):
+      self.fetch(cache, path)
+      time.sleep(0.01)
+    self.assertEqual(cache.load(self.url + "/a"), (None, None))
+    cache.max_age = 60
+    self.fetch(cache, "/b")
+    time.sleep(0.01)
+    self.fetch(cache, "/d")
+    self.assertIsNotNone(cache.load(self.url + "/b")[0])
+    self.assertEqual(cache.load(self.url + "/c"), (None, None))
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,217 @@
+"""Caching for rendered pages and query results.  Entries live in
+namespaces that are invalidated as a whole when the data behind
+them changes
+"""
+import cPickle as pickle
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+
+class MemoryBackend:
+  """Keeps entries in this process, dropping the least recently used
+  once there are more than max_entries and the expired ones at the
+  front as entries are set.  Counters are kept apart so they are
+  never dropped
+  """
+  def __init__(self, max_entries = 10000):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.counters = {}
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the value for key, or None if missing or expired
+    """
+    with self.lock:
+      if key in self.counters:
+        return self.counters[key]
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        return None
+      expires, value = entry
+      if expires < time.time():
+        return None
+      self.entries[key] = entry
+      return value
+
+  def set(self, key, value, timeout):
+    """Stores value under key for timeout seconds
+    """
+    now = time.time()
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (now + timeout, value)
+      while self.entries:
+        oldest, (expires, _) = next(self.entries.iteritems())
+        if expires >= now and len(self.entries) <= self.max_entries:
+          break
+        del self.entries[oldest]
+
+  def incr(self, key):
+    """Increments a counter that never expires, returning its value
+    """
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + 1
+      return self.counters[key]
+
+  def clear_expired(self):
+    """Drops entries that have expired
+    """
+    now = time.time()
+    with self.lock:
+      for key, (expires, _) in self.entries.items():
+        if expires < now:
+          del self.entries[key]
+
+class FileBackend:
+  """Keeps entries as files in a directory, so every process on
+  the host shares them.  Expired files are removed every
+  prune_every entries set
+  """
+  def __init__(self, directory, prune_every = 1000):
+    self.directory = directory
+    self.prune_every = prune_every
+    self.sets = 0
+    # incr holds it while it sets the counter
+    self.lock = threading.RLock()
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def path(self, key):
+    """Returns the file for a key
+    """
+    return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+  def get(self, key):
+    """Returns the value for key, or None if missing or expired
+    """
+    try:
+      with open(self.path(key), "rb") as buff:
+        expires, value = pickle.load(buff)
+    except (IOError, EOFError, pickle.UnpicklingError):
+      return None
+    if expires < time.time():
+      return None
+    return value
+
+  def set(self, key, value, timeout):
+    """Stores value under key for timeout seconds
+    """
+    path = self.path(key)
+    temp_path = "%s.%d.%d.tmp" % (path, os.getpid(),
+        threading.current_thread().ident)
+    with open(temp_path, "wb") as buff:
+      pickle.dump((time.time() + timeout, value), buff,
+          pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+    with self.lock:
+      self.sets += 1
+      prune = self.sets % self.prune_every == 0
+    if prune:
+      self.clear_expired()
+
+  def incr(self, key):
+    """Increments a counter that never expires, returning its value.
+    Counters only have to change, not count exactly, so races
+    between processes are harmless
+    """
+    with self.lock:
+      value = (self.get(key) or 0) + 1
+      self.set(key, value, float("inf"))
+      return value
+
+  def clear_expired(self):
+    """Removes files for entries that have expired
+    """
+    now = time.time()
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        with open(path, "rb") as buff:
+          expires, _ = pickle.load(buff)
+        if expires < now:
+          os.remove(path)
+      except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+class ViewCache:
+  """Caches rendered views and query results by namespace.  Each
+  namespace has a generation number that is part of every key, so
+  invalidating a namespace is a single increment
+  """
+  def __init__(self, backend = None, timeout = 300):
+    self.backend = backend or MemoryBackend()
+    self.timeout = timeout
+    self.hits = {}
+    self.misses = {}
+
+  def key(self, namespace, key):
+    """Returns the backend key for key in namespace
+    """
+    generation = self.backend.get("generation:%s" % namespace) or 0
+    return "%s:%d:%s" % (namespace, generation, key)
+
+  def get(self, namespace, key):
+    """Returns a cached value, or None, counting hits and misses
+    """
+    value = self.backend.get(self.key(namespace, key))
+    counts = self.misses if value is None else self.hits
+    counts[namespace] = counts.get(namespace, 0) + 1
+    return value
+
+  def set(self, namespace, key, value):
+    """Caches a value
+    """
+    self.backend.set(self.key(namespace, key), value, self.timeout)
+
+  def memoize(self, namespace, key, func, *args, **kwargs):
+    """Returns the cached result of func(*args, **kwargs), calling
+    it on a miss
+    """
+    value = self.get(namespace, key)
+    if value is None:
+      value = func(*args, **kwargs)
+      self.set(namespace, key, value)
+    return value
+
+  def cached(self, namespace):
+    """Decorator that caches the page a view renders for each url
+    """
+    def decorator(view):
+      @wraps(view)
+      def cached_view(*args, **kwargs):
+        if request.method != "GET":
+          return view(*args, **kwargs)
+        page = self.get(namespace, request.full_path)
+        if page is None:
+          page = view(*args, **kwargs)
+          if not isinstance(page, basestring):
+            return page
+          self.set(namespace, request.full_path, page)
+        return page
+      return cached_view
+    return decorator
+
+  def invalidate(self, *namespaces):
+    """Drops everything cached in namespaces
+    """
+    for namespace in namespaces:
+      self.backend.incr("generation:%s" % namespace)
+
+  def stats(self):
+    """Returns hit and miss counts and the hit rate by namespace
+    """
+    stats = {}
+    for namespace in set(self.hits) | set(self.misses):
+      hits = self.hits.get(namespace, 0)
+      misses = self.misses.get(namespace, 0)
+      stats[namespace] = {
+          "hits": hits,
+          "misses": misses,
+          "hit_rate": hits/float(hits + misses)}
+    return stats